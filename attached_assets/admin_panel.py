@@ -12,14 +12,24 @@ from flask import (
 )
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 
 from app import app, db
 from models import (
     Admin, TelegramUser, VPNConfig, Product, 
-    Order, PaymentMethod, Settings
+    Order, PaymentMethod, Settings, Broadcast
 )
 from x_ui_client import XUIClient, XUIClientError
 from vpn_utils import generate_config, format_config_for_user
+from cache_bus import invalidate_products, invalidate_user_block, invalidate_user_configs
+import settings_snapshot
+from expiry_sweeper import sweeper as expiry_sweeper
+from pagination import keyset_paginate, page_size_from
+import stats_rollup
+from exports import export_response
+import broadcast as broadcast_service
+import notification_outbox
 
 # Initialize XUI client
 xui_client = XUIClient(
@@ -61,32 +71,21 @@ def admin_logout():
 @login_required
 def admin_dashboard():
     """Admin dashboard with statistics"""
-    # Get counts
-    user_count = TelegramUser.query.count()
-    active_configs = VPNConfig.query.filter_by(is_active=True).count()
+    # Готовые счетчики из таблицы статистики
+    counters = stats_rollup.dashboard_counters()
+    
+    # Истекшие, но еще активные - зависит от текущего времени, считаем по индексу
     expired_configs = VPNConfig.query.filter(
         VPNConfig.valid_until < datetime.utcnow(),
         VPNConfig.is_active == True
     ).count()
     
     # Get recent orders
-    recent_orders = Order.query.order_by(Order.created_at.desc()).limit(5).all()
+    recent_orders = Order.query.options(joinedload(Order.user)).order_by(Order.created_at.desc()).limit(5).all()
     
     # Get recent users
     recent_users = TelegramUser.query.order_by(TelegramUser.registration_date.desc()).limit(5).all()
     
-    # Calculate revenue
-    total_revenue = db.session.query(db.func.sum(Order.amount)).filter(
-        Order.status == 'completed'
-    ).scalar() or 0
-    
-    # Monthly revenue
-    start_of_month = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    monthly_revenue = db.session.query(db.func.sum(Order.amount)).filter(
-        Order.status == 'completed',
-        Order.paid_at >= start_of_month
-    ).scalar() or 0
-    
     # Try to get system stats from 3x-ui
     try:
         system_stats = xui_client.get_stats()
@@ -96,22 +95,67 @@ def admin_dashboard():
     
     return render_template(
         'admin/dashboard.html',
-        user_count=user_count,
-        active_configs=active_configs,
+        user_count=counters['user_count'],
+        active_configs=counters['active_configs'],
         expired_configs=expired_configs,
-        total_revenue=total_revenue,
-        monthly_revenue=monthly_revenue,
+        total_revenue=counters['total_revenue'],
+        monthly_revenue=counters['monthly_revenue'],
         recent_orders=recent_orders,
         recent_users=recent_users,
-        system_stats=system_stats
+        system_stats=system_stats,
+        sweep_stats=expiry_sweeper.last_run
     )
 
 @app.route('/admin/users')
 @login_required
 def admin_users():
     """Admin user management"""
-    users = TelegramUser.query.order_by(TelegramUser.registration_date.desc()).all()
-    return render_template('admin/users.html', users=users)
+    page = keyset_paginate(
+        TelegramUser.query,
+        TelegramUser.registration_date, TelegramUser.id,
+        descending=True,
+        per_page=page_size_from(request.args),
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
+    
+    # Count configs and orders for the whole page in two grouped queries
+    user_ids = [user.id for user in page]
+    config_counts = dict(
+        db.session.query(VPNConfig.user_id, func.count(VPNConfig.id))
+        .filter(VPNConfig.user_id.in_(user_ids))
+        .group_by(VPNConfig.user_id)
+        .all()
+    ) if user_ids else {}
+    order_counts = dict(
+        db.session.query(Order.user_id, func.count(Order.id))
+        .filter(Order.user_id.in_(user_ids))
+        .group_by(Order.user_id)
+        .all()
+    ) if user_ids else {}
+    
+    return render_template(
+        'admin/users.html',
+        users=page,
+        config_counts=config_counts,
+        order_counts=order_counts,
+        page=page,
+        page_endpoint='admin_users',
+        page_args={}
+    )
+
+@app.route('/admin/users/export')
+@login_required
+def admin_users_export():
+    """Потоковая выгрузка пользователей (CSV или JSON Lines)"""
+    stmt = db.select(
+        TelegramUser.id, TelegramUser.telegram_id, TelegramUser.username,
+        TelegramUser.first_name, TelegramUser.last_name,
+        TelegramUser.registration_date, TelegramUser.is_blocked
+    ).order_by(TelegramUser.registration_date.desc(), TelegramUser.id.desc())
+    fieldnames = ['id', 'telegram_id', 'username', 'first_name', 'last_name',
+                  'registration_date', 'is_blocked']
+    return export_response(stmt, fieldnames, request.args.get('format', 'csv'), 'users')
 
 @app.route('/admin/user/<int:user_id>', methods=['GET', 'POST'])
 @login_required
@@ -119,7 +163,7 @@ def admin_user_detail(user_id):
     """Admin user detail page"""
     user = TelegramUser.query.get_or_404(user_id)
     configs = VPNConfig.query.filter_by(user_id=user.id).all()
-    orders = Order.query.filter_by(user_id=user.id).order_by(Order.created_at.desc()).all()
+    orders = Order.query.options(joinedload(Order.product)).filter_by(user_id=user.id).order_by(Order.created_at.desc()).all()
     
     if request.method == 'POST':
         action = request.form.get('action')
@@ -129,6 +173,9 @@ def admin_user_detail(user_id):
             user.is_blocked = not user.is_blocked
             db.session.commit()
             
+            # Бот кэширует статус блокировки - сбрасываем его
+            invalidate_user_block(user.telegram_id)
+            
             status = "заблокирован" if user.is_blocked else "разблокирован"
             flash(f'Пользователь {user.first_name} успешно {status}', 'success')
             
@@ -182,8 +229,35 @@ def admin_user_detail(user_id):
 @login_required
 def admin_configs():
     """Admin VPN configuration management"""
-    configs = VPNConfig.query.order_by(VPNConfig.created_at.desc()).all()
-    return render_template('admin/configs.html', configs=configs)
+    page = keyset_paginate(
+        VPNConfig.query.options(joinedload(VPNConfig.owner)),
+        VPNConfig.created_at, VPNConfig.id,
+        descending=True,
+        per_page=page_size_from(request.args),
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
+    return render_template(
+        'admin/configs.html',
+        configs=page,
+        page=page,
+        page_endpoint='admin_configs',
+        page_args={}
+    )
+
+@app.route('/admin/configs/export')
+@login_required
+def admin_configs_export():
+    """Потоковая выгрузка VPN-конфигураций без ключевых данных (CSV или JSON Lines)"""
+    stmt = db.select(
+        VPNConfig.id, VPNConfig.user_id, TelegramUser.telegram_id, VPNConfig.config_type,
+        VPNConfig.name, VPNConfig.is_active, VPNConfig.valid_until, VPNConfig.created_at
+    ).join(TelegramUser, VPNConfig.user_id == TelegramUser.id).order_by(
+        VPNConfig.created_at.desc(), VPNConfig.id.desc()
+    )
+    fieldnames = ['id', 'user_id', 'telegram_id', 'config_type', 'name', 'is_active',
+                  'valid_until', 'created_at']
+    return export_response(stmt, fieldnames, request.args.get('format', 'csv'), 'configs')
 
 @app.route('/admin/config/<int:config_id>', methods=['GET', 'POST'])
 @login_required
@@ -193,6 +267,9 @@ def admin_config_detail(config_id):
     
     if request.method == 'POST':
         action = request.form.get('action')
+        # Владельца загружаем до изменений: автосброс при ленивой загрузке
+        # заблокировал бы строку конфигурации на время запроса к x-ui
+        telegram_id = config.owner.telegram_id
         
         if action == 'toggle_status':
             # Изменяем статус активности VPN-конфигурации
@@ -201,25 +278,25 @@ def admin_config_detail(config_id):
             # Если есть подключение к x-ui, обновляем статус клиента там тоже
             try:
                 if config.x_ui_client_id:
-                    # Получаем все инбаунды
-                    inbounds = xui_client.get_inbounds()
+                    # Находим инбаунд, соответствующий типу конфигурации (из каталога)
+                    inbound = xui_client.find_inbound(config.config_type)
                     
-                    # Находим инбаунд, соответствующий типу конфигурации
-                    matching_inbounds = [inb for inb in inbounds if inb.get("protocol") == config.config_type]
-                    
-                    if matching_inbounds:
-                        inbound_id = matching_inbounds[0].get("id")
+                    if inbound:
+                        inbound_id = inbound.get("id")
                         
                         # Обновляем статус клиента в x-ui
                         xui_client.update_client(
                             inbound_id=inbound_id,
-                            email=f"tguser_{config.owner.telegram_id}_{config.created_at.strftime('%Y%m%d%H%M%S')}",
+                            email=f"tguser_{telegram_id}_{config.created_at.strftime('%Y%m%d%H%M%S')}",
                             enable=config.is_active
                         )
             except Exception as e:
                 flash(f'Не удалось обновить статус в X-UI: {str(e)}', 'warning')
             
+            # Счетчик обновляем после запроса к x-ui, чтобы не держать его строку заблокированной
+            stats_rollup.bump(stats_rollup.CONFIGS_ACTIVE, 1 if config.is_active else -1)
             db.session.commit()
+            invalidate_user_configs(telegram_id)
             status = "активирована" if config.is_active else "деактивирована"
             flash(f'VPN-конфигурация успешно {status}', 'success')
             
@@ -235,32 +312,32 @@ def admin_config_detail(config_id):
                 config.valid_until = config.valid_until + timedelta(days=days)
             
             # Активируем конфигурацию, если она неактивна
-            if not config.is_active:
-                config.is_active = True
+            activated = not config.is_active
+            config.is_active = True
             
             # Если есть подключение к x-ui, обновляем там тоже
             try:
                 if config.x_ui_client_id:
-                    # Получаем все инбаунды
-                    inbounds = xui_client.get_inbounds()
-                    
-                    # Находим инбаунд, соответствующий типу конфигурации
-                    matching_inbounds = [inb for inb in inbounds if inb.get("protocol") == config.config_type]
+                    # Находим инбаунд, соответствующий типу конфигурации (из каталога)
+                    inbound = xui_client.find_inbound(config.config_type)
                     
-                    if matching_inbounds:
-                        inbound_id = matching_inbounds[0].get("id")
+                    if inbound:
+                        inbound_id = inbound.get("id")
                         
                         # Обновляем срок действия клиента в x-ui
                         xui_client.update_client(
                             inbound_id=inbound_id,
-                            email=f"tguser_{config.owner.telegram_id}_{config.created_at.strftime('%Y%m%d%H%M%S')}",
+                            email=f"tguser_{telegram_id}_{config.created_at.strftime('%Y%m%d%H%M%S')}",
                             new_expiry_days=days,
                             enable=True
                         )
             except Exception as e:
                 flash(f'Не удалось обновить срок действия в X-UI: {str(e)}', 'warning')
             
+            if activated:
+                stats_rollup.bump(stats_rollup.CONFIGS_ACTIVE)
             db.session.commit()
+            invalidate_user_configs(telegram_id)
             flash(f'Срок действия VPN-конфигурации продлен на {days} дней', 'success')
     
     formatted_config = format_config_for_user(config)
@@ -296,8 +373,7 @@ def admin_products():
         db.session.commit()
         
         # Очищаем кэш продуктов, чтобы пользователи видели актуальные данные
-        from main import clear_products_cache
-        if clear_products_cache():
+        if invalidate_products():
             flash('Product added successfully and cache cleared', 'success')
         else:
             flash('Product added successfully, but cache clearing failed', 'warning')
@@ -315,8 +391,7 @@ def admin_product_delete(product_id):
     db.session.commit()
     
     # Очищаем кэш продуктов, чтобы пользователи видели актуальные данные
-    from main import clear_products_cache
-    if clear_products_cache():
+    if invalidate_products():
         flash('Product deleted successfully and cache cleared', 'success')
     else:
         flash('Product deleted successfully, but cache clearing failed', 'warning')
@@ -339,8 +414,7 @@ def admin_product_edit(product_id):
         db.session.commit()
         
         # Очищаем кэш продуктов, чтобы пользователи видели актуальные данные
-        from main import clear_products_cache
-        if clear_products_cache():
+        if invalidate_products():
             flash('Продукт успешно обновлен и кэш очищен', 'success')
         else:
             flash('Продукт успешно обновлен, но очистка кэша не удалась', 'warning')
@@ -364,48 +438,85 @@ def admin_product_json(product_id):
         'is_active': product.is_active
     })
 
-@app.route('/admin/orders')
-@login_required
-def admin_orders():
-    """Admin order management"""
-    # Получаем параметры фильтрации
+def _order_list_params():
+    """
+    Parse the order list filter and sort from the request
+    
+    Returns:
+        tuple: (status_filter, sort_by, filters, sort_column, descending)
+    """
     status_filter = request.args.get('status', 'all')
     sort_by = request.args.get('sort', 'date_desc')
     
-    # Базовый запрос
-    query = Order.query
-    
-    # Применяем фильтр по статусу
+    # Фильтр по статусу
+    filters = []
     if status_filter != 'all':
-        query = query.filter(Order.status == status_filter)
-    
-    # Применяем сортировку
-    if sort_by == 'date_asc':
-        query = query.order_by(Order.created_at.asc())
-    elif sort_by == 'date_desc':
-        query = query.order_by(Order.created_at.desc())
-    elif sort_by == 'amount_asc':
-        query = query.order_by(Order.amount.asc())
-    elif sort_by == 'amount_desc':
-        query = query.order_by(Order.amount.desc())
-    else:
-        query = query.order_by(Order.created_at.desc())
-    
-    # Получаем заказы
-    orders = query.all()
+        filters.append(Order.status == status_filter)
+    
+    # Сортировка: (колонка, по убыванию), id - дополнительный ключ
+    sort_options = {
+        'date_asc': (Order.created_at, False),
+        'date_desc': (Order.created_at, True),
+        'amount_asc': (Order.amount, False),
+        'amount_desc': (Order.amount, True),
+    }
+    if sort_by not in sort_options:
+        sort_by = 'date_desc'
+    sort_column, descending = sort_options[sort_by]
+    
+    return status_filter, sort_by, filters, sort_column, descending
+
+@app.route('/admin/orders')
+@login_required
+def admin_orders():
+    """Admin order management"""
+    status_filter, sort_by, filters, sort_column, descending = _order_list_params()
+    
+    # Получаем страницу заказов
+    page = keyset_paginate(
+        Order.query.options(joinedload(Order.user), joinedload(Order.product)).filter(*filters),
+        sort_column, Order.id,
+        descending=descending,
+        per_page=page_size_from(request.args),
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
     
     return render_template(
         'admin/orders.html', 
-        orders=orders,
+        orders=page,
         status_filter=status_filter,
-        sort_by=sort_by
+        sort_by=sort_by,
+        page=page,
+        page_endpoint='admin_orders',
+        page_args={'status': status_filter, 'sort': sort_by}
     )
 
+@app.route('/admin/orders/export')
+@login_required
+def admin_orders_export():
+    """Потоковая выгрузка заказов с теми же фильтрами, что и список (CSV или JSON Lines)"""
+    status_filter, sort_by, filters, sort_column, descending = _order_list_params()
+    order_by = (sort_column.desc(), Order.id.desc()) if descending else (sort_column.asc(), Order.id.asc())
+    
+    stmt = db.select(
+        Order.id, Order.user_id, TelegramUser.telegram_id, TelegramUser.username,
+        Order.product_id, Product.name, Order.amount, Order.status,
+        Order.created_at, Order.paid_at, Order.config_id
+    ).join(TelegramUser, Order.user_id == TelegramUser.id).outerjoin(
+        Product, Order.product_id == Product.id
+    ).filter(*filters).order_by(*order_by)
+    fieldnames = ['id', 'user_id', 'telegram_id', 'username', 'product_id', 'product_name',
+                  'amount', 'status', 'created_at', 'paid_at', 'config_id']
+    return export_response(stmt, fieldnames, request.args.get('format', 'csv'), 'orders')
+
 @app.route('/admin/order/<int:order_id>')
 @login_required
 def admin_order_detail(order_id):
     """Admin order detail page"""
-    order = Order.query.get_or_404(order_id)
+    order = Order.query.options(
+        joinedload(Order.user), joinedload(Order.product)
+    ).filter_by(id=order_id).first_or_404()
     return render_template('admin/order_detail.html', order=order)
 
 @app.route('/admin/order/<int:order_id>/complete', methods=['GET', 'POST'])
@@ -419,6 +530,7 @@ def admin_order_complete(order_id):
         return redirect(url_for('admin_order_detail', order_id=order.id))
     
     # Mark order as completed
+    previous_status = order.status
     order.status = 'completed'
     order.paid_at = datetime.utcnow()
     
@@ -433,15 +545,12 @@ def admin_order_complete(order_id):
         # Create a user identifier
         user_email = f"tguser_{user.telegram_id}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
         
-        # Get inbounds that match the product type
-        inbounds = xui_client.get_inbounds()
-        matching_inbounds = [inb for inb in inbounds if inb.get("protocol") == product.config_type]
+        # Get the inbound that matches the product type from the cached catalog
+        inbound = xui_client.find_inbound(product.config_type)
         
-        if not matching_inbounds:
+        if not inbound:
             raise ValueError(f"No inbound found for protocol: {product.config_type}")
         
-        # Use the first matching inbound
-        inbound = matching_inbounds[0]
         inbound_id = inbound.get("id")
         
         # Add client to 3x-ui
@@ -476,8 +585,20 @@ def admin_order_complete(order_id):
         )
         
         db.session.add(config)
+        db.session.flush()
         order.config_id = config.id
+        
+        # Notify the user through the outbox, committed with the order
+        notification_outbox.enqueue_order_completed(order, user.telegram_id, config.id, config.valid_until)
+        
+        # Update dashboard counters in the same transaction
+        if previous_status == 'cancelled':
+            stats_rollup.bump(stats_rollup.ORDERS_CANCELLED, -1, when=order.created_at)
+        stats_rollup.bump(stats_rollup.ORDERS_COMPLETED, amount=order.amount, when=order.paid_at)
+        stats_rollup.bump(stats_rollup.CONFIGS_CREATED, when=order.paid_at)
+        stats_rollup.bump(stats_rollup.CONFIGS_ACTIVE)
         db.session.commit()
+        invalidate_user_configs(user.telegram_id)
         
         flash('Order completed and VPN configuration generated successfully', 'success')
     
@@ -496,12 +617,83 @@ def admin_order_cancel(order_id):
     if order.status == 'completed':
         flash('Cannot cancel a completed order', 'danger')
     else:
+        if order.status != 'cancelled':
+            stats_rollup.bump(stats_rollup.ORDERS_CANCELLED, when=order.created_at)
+            notification_outbox.enqueue_order_cancelled(order, order.user.telegram_id)
         order.status = 'cancelled'
         db.session.commit()
         flash('Order cancelled successfully', 'success')
     
     return redirect(url_for('admin_order_detail', order_id=order.id))
 
+@app.route('/admin/broadcasts', methods=['GET', 'POST'])
+@login_required
+def admin_broadcasts():
+    """Массовые рассылки через бота"""
+    if request.method == 'POST':
+        text = (request.form.get('text') or '').strip()
+        segment = request.form.get('segment', 'all')
+        
+        if not text:
+            flash('Текст рассылки не может быть пустым', 'danger')
+        elif segment not in broadcast_service.SEGMENTS:
+            flash('Неизвестный сегмент получателей', 'danger')
+        else:
+            broadcast = broadcast_service.create_broadcast(
+                text=text,
+                segment=segment,
+                expiring_days=request.form.get('expiring_days', 3, type=int),
+                parse_mode='Markdown' if request.form.get('markdown') else None
+            )
+            flash(f'Рассылка #{broadcast.id} поставлена в очередь ({broadcast.total} получателей)', 'success')
+        return redirect(url_for('admin_broadcasts'))
+    
+    broadcasts = Broadcast.query.order_by(Broadcast.id.desc()).limit(50).all()
+    return render_template(
+        'admin/broadcasts.html',
+        broadcasts=broadcasts,
+        segments=broadcast_service.SEGMENTS
+    )
+
+@app.route('/admin/broadcast/<int:broadcast_id>/<action>', methods=['POST'])
+@login_required
+def admin_broadcast_action(broadcast_id, action):
+    """Приостановить, продолжить или отменить рассылку"""
+    broadcast = Broadcast.query.get_or_404(broadcast_id)
+    
+    transitions = {
+        'pause': (('pending', 'running'), 'paused'),
+        'resume': (('paused',), 'running'),
+        'cancel': (('pending', 'running', 'paused'), 'cancelled'),
+    }
+    if action not in transitions or broadcast.status not in transitions[action][0]:
+        flash('Действие недоступно для этой рассылки', 'warning')
+    else:
+        broadcast.status = transitions[action][1]
+        if broadcast.status == 'cancelled':
+            broadcast.finished_at = datetime.utcnow()
+        db.session.commit()
+        flash(f'Рассылка #{broadcast.id}: {broadcast.status}', 'success')
+    
+    return redirect(url_for('admin_broadcasts'))
+
+@app.route('/admin/broadcast/<int:broadcast_id>/progress')
+@login_required
+def admin_broadcast_progress(broadcast_id):
+    """Прогресс рассылки в JSON"""
+    broadcast = Broadcast.query.get_or_404(broadcast_id)
+    return jsonify({
+        'id': broadcast.id,
+        'status': broadcast.status,
+        'total': broadcast.total,
+        'processed': broadcast.processed,
+        'sent': broadcast.sent,
+        'failed': broadcast.failed,
+        'blocked': broadcast.blocked,
+        'progress': broadcast.progress,
+        'last_error': broadcast.last_error
+    })
+
 @app.route('/admin/payment_methods', methods=['GET', 'POST'])
 @login_required
 def admin_payment_methods():
@@ -592,11 +784,15 @@ def admin_settings():
                     db.session.add(setting)
         
         db.session.commit()
+        
+        # Обновляем снимок настроек здесь и в остальных процессах (включая бота)
+        settings_snapshot.publish_reload()
+        
         flash('Settings updated successfully', 'success')
         return redirect(url_for('admin_settings'))
     
     # Get all settings
-    settings = {setting.key: setting.value for setting in Settings.query.all()}
+    settings = settings_snapshot.get_settings().as_dict()
     
     return render_template('admin/settings.html', settings=settings)
 
@@ -672,8 +868,7 @@ def check_bot_token():
 @login_required
 def admin_clear_products_cache():
     """Очистить кэш продуктов вручную (для админов)"""
-    from main import clear_products_cache
-    result = clear_products_cache()
+    result = invalidate_products()
     
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.headers.get('Accept') == 'application/json':
         return jsonify({
@@ -688,6 +883,18 @@ def admin_clear_products_cache():
         # Возвращаемся на предыдущую страницу или на страницу продуктов
         return redirect(request.referrer or url_for('admin_products'))
 
+@app.route('/admin/stats/rebuild', methods=['POST'])
+@login_required
+def admin_rebuild_stats():
+    """Пересчитать счетчики панели управления из исходных таблиц"""
+    try:
+        with db.engine.begin() as conn:
+            rows = stats_rollup.rebuild(conn)
+        flash(f'Статистика пересчитана ({rows} счетчиков)', 'success')
+    except Exception as e:
+        flash(f'Ошибка при пересчете статистики: {str(e)}', 'danger')
+    return redirect(url_for('admin_dashboard'))
+
 
 @app.route('/admin/check_xui_connection', methods=['POST'])
 @login_required
@@ -45,6 +45,19 @@ with app.app_context():
     # Create database tables if they don't exist
     db.create_all()
     
+    # Apply schema changes to existing databases
+    from migrations import run_migrations
+    run_migrations()
+    
+    # Request timings, pool events and the /metrics route
+    import metrics
+    metrics.init_app(app, db.engine)
+    
+    # Query counts per request and the slow query log
+    import query_stats
+    query_stats.instrument_engine(db.engine)
+    query_stats.init_app(app)
+    
     # Ensure default admin exists
     from models import Admin
     from werkzeug.security import generate_password_hash
@@ -0,0 +1,561 @@
+"""
+Asynchronous client for the 3x-ui panel API
+
+Async-вариант XUIClient для использования из event loop бота: пул
+соединений фиксированного размера, таймауты на каждый вызов, повторы с
+джиттером и circuit breaker, который сразу отказывает, пока панель недоступна.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+import httpx
+
+from metrics import observe_xui, xui_operation
+from x_ui_client import (
+    BatchResult, InboundCatalog, XUIClientError, build_client, client_key, expiry_timestamp, group_by_inbound
+)
+
+logger = logging.getLogger(__name__)
+
+XUI_POOL_SIZE = int(os.environ.get('XUI_POOL_SIZE', '10'))
+XUI_TIMEOUT = float(os.environ.get('XUI_TIMEOUT', '10'))
+XUI_MAX_RETRIES = int(os.environ.get('XUI_MAX_RETRIES', '3'))
+XUI_BREAKER_THRESHOLD = int(os.environ.get('XUI_BREAKER_THRESHOLD', '5'))
+XUI_BREAKER_RESET_TIMEOUT = float(os.environ.get('XUI_BREAKER_RESET_TIMEOUT', '30'))
+
+# Ответы, после которых имеет смысл повторить запрос
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+
+
+class XUICircuitOpenError(XUIClientError):
+    """Raised without contacting the panel while the circuit breaker is open"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker
+
+    closed    - calls pass through; failures are counted
+    open      - calls fail immediately until reset_timeout has passed
+    half_open - one trial call is let through; success closes the circuit,
+                failure opens it again
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=XUI_BREAKER_THRESHOLD, reset_timeout=XUI_BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_progress = False
+
+    def before_call(self):
+        """
+        Check whether a call may proceed
+
+        Raises:
+            XUICircuitOpenError: If the circuit is open
+        """
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise XUICircuitOpenError("3x-ui panel is unavailable (circuit open)")
+            self.state = self.HALF_OPEN
+            self._trial_in_progress = False
+
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_progress:
+                raise XUICircuitOpenError("3x-ui panel is unavailable (trial call in progress)")
+            self._trial_in_progress = True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_in_progress = False
+
+    def release_trial(self):
+        """Отпустить пробный вызов, прерванный без результата (например, отменой)"""
+        self._trial_in_progress = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_progress = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit breaker 3x-ui открыт после {self.failures} ошибок подряд")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class _RetryableError(Exception):
+    """Временная ошибка, после которой запрос можно повторить"""
+    pass
+
+
+class AsyncXUIClient:
+    """Async client for interacting with 3x-ui panel"""
+
+    def __init__(self, base_url, username, password, pool_size=XUI_POOL_SIZE,
+                 timeout=XUI_TIMEOUT, max_retries=XUI_MAX_RETRIES, breaker=None):
+        """
+        Initialize the async 3x-ui client
+
+        Args:
+            base_url (str): Base URL of the 3x-ui panel
+            username (str): Admin username
+            password (str): Admin password
+            pool_size (int): Maximum number of open connections to the panel
+            timeout (float): Default timeout for a single request in seconds
+            max_retries (int): Retries after the first attempt for transient errors
+            breaker (CircuitBreaker, optional): Circuit breaker to use
+        """
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker()
+        self.logger = logging.getLogger(__name__)
+
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+        self._logged_in = False
+        self._login_lock = asyncio.Lock()
+        self.inbound_catalog = InboundCatalog()
+
+    async def aclose(self):
+        """Закрыть пул соединений"""
+        await self._client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    # -- транспорт ----------------------------------------------------------
+
+    @staticmethod
+    def _backoff(attempt, base=0.2, cap=5.0):
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+    async def _login(self, timeout=None):
+        """
+        Log in to the 3x-ui panel; the session cookie is kept by the HTTP client
+
+        Raises:
+            XUIClientError: If the credentials are rejected
+        """
+        response = await self._client.post(
+            '/login',
+            data={'username': self.username, 'password': self.password},
+            timeout=timeout or self.timeout
+        )
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            raise _RetryableError(f"login returned {response.status_code}")
+        try:
+            data = response.json() if response.content else {}
+        except ValueError:
+            # Панель или прокси перед ней вернули не JSON
+            raise XUIClientError(f"Login to 3x-ui failed: invalid response ({response.status_code})")
+        if response.status_code != 200 or not data.get('success'):
+            raise XUIClientError(f"Login to 3x-ui failed: {data.get('msg') or response.status_code}")
+        self._logged_in = True
+        self.logger.info("Successfully logged in to 3x-ui panel")
+
+    async def _ensure_login(self, timeout=None):
+        """Войти в панель, если сессии еще нет"""
+        if self._logged_in:
+            return
+        async with self._login_lock:
+            if not self._logged_in:
+                await self._login(timeout)
+
+    async def _attempt(self, method, path, timeout, **kwargs):
+        await self._ensure_login(timeout)
+        response = await self._client.request(method, path, timeout=timeout, **kwargs)
+
+        # Истекшая сессия: 3x-ui отвечает 401/404 или перенаправляет на страницу входа
+        if response.status_code in (401, 404) or response.is_redirect:
+            self._logged_in = False
+            await self._ensure_login(timeout)
+            response = await self._client.request(method, path, timeout=timeout, **kwargs)
+
+        if response.status_code in RETRYABLE_STATUS_CODES or response.status_code >= 500:
+            raise _RetryableError(f"{method} {path} returned {response.status_code}")
+        if response.status_code != 200:
+            raise XUIClientError(f"{method} {path} returned {response.status_code}")
+
+        try:
+            data = response.json()
+        except ValueError:
+            raise XUIClientError(f"{method} {path} returned invalid JSON")
+
+        if not data.get('success'):
+            raise XUIClientError(data.get('msg') or f"{method} {path} failed")
+        return data.get('obj')
+
+    async def _request(self, method, path, timeout=None, idempotent=True, **kwargs):
+        """
+        Perform an API request with retries and the circuit breaker
+
+        Args:
+            method (str): HTTP method
+            path (str): API path relative to base_url
+            timeout (float, optional): Timeout override for this call
+            idempotent (bool): Whether timeouts and 5xx responses may be retried.
+                Connection errors are always retried since nothing was sent.
+
+        Returns:
+            The 'obj' field of the panel response
+
+        Raises:
+            XUICircuitOpenError: If the panel is considered down
+            XUIClientError: On API errors or when retries are exhausted
+        """
+        with observe_xui('async', xui_operation(method, path)):
+            self.breaker.before_call()
+            timeout = timeout or self.timeout
+            last_error = None
+
+            try:
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        result = await self._attempt(method, path, timeout, **kwargs)
+                        self.breaker.record_success()
+                        return result
+                    except XUIClientError:
+                        # Ответ панели получен - это не сбой доступности
+                        self.breaker.record_success()
+                        raise
+                    except httpx.ConnectError as e:
+                        last_error = e
+                    except (httpx.TransportError, _RetryableError) as e:
+                        last_error = e
+                        if not idempotent:
+                            break
+
+                    if attempt < self.max_retries:
+                        delay = self._backoff(attempt)
+                        self.logger.warning(f"3x-ui {method} {path} failed ({last_error}), retry in {delay:.2f}s")
+                        await asyncio.sleep(delay)
+
+                self.breaker.record_failure()
+                raise XUIClientError(f"3x-ui {method} {path} failed: {last_error}")
+            except XUIClientError:
+                # Исход уже учтен в breaker
+                raise
+            except asyncio.CancelledError:
+                # Отмена ничего не говорит о панели, но пробный вызов надо отпустить
+                self.breaker.release_trial()
+                raise
+            except BaseException:
+                # Любая другая ошибка тоже завершает вызов для breaker, иначе
+                # пробный вызов в half_open остается занятым навсегда
+                self.breaker.record_failure()
+                raise
+
+    # -- API ----------------------------------------------------------------
+
+    async def get_inbounds(self, timeout=None):
+        """
+        Get all inbound configurations
+
+        Returns:
+            list: List of inbound configurations
+        """
+        return await self._request('GET', '/panel/api/inbounds/list', timeout=timeout) or []
+
+    async def get_inbound(self, inbound_id, timeout=None):
+        """
+        Get a specific inbound configuration
+
+        Returns:
+            dict: Inbound configuration
+        """
+        return await self._request('GET', f'/panel/api/inbounds/get/{inbound_id}', timeout=timeout)
+
+    async def _fresh_catalog(self, timeout=None):
+        """Вернуть каталог инбаундов, загрузив его заново, если он устарел"""
+        if not self.inbound_catalog.is_fresh():
+            self.inbound_catalog.load(await self.get_inbounds(timeout=timeout))
+        return self.inbound_catalog
+
+    async def _fresh_inbound(self, inbound_id, timeout=None):
+        """Вернуть каталог с актуальными settings инбаунда, запросив только его"""
+        catalog = await self._fresh_catalog(timeout)
+        generation = catalog.stale_generation(inbound_id)
+        if generation is not None:
+            catalog.refresh_inbound(await self.get_inbound(inbound_id, timeout=timeout), generation)
+        return catalog
+
+    async def find_inbound(self, protocol, timeout=None):
+        """
+        Find the inbound to provision clients of a protocol on
+
+        Returns:
+            dict: First inbound with that protocol, or None
+        """
+        matching = (await self._fresh_catalog(timeout)).for_protocol(protocol)
+        return matching[0] if matching else None
+
+    async def get_cached_inbound(self, inbound_id, timeout=None):
+        """
+        Get an inbound from the catalog without a panel request when fresh
+
+        Returns:
+            dict: Inbound configuration, or None if unknown
+        """
+        return (await self._fresh_inbound(inbound_id, timeout)).get(inbound_id)
+
+    def invalidate_inbounds(self):
+        """Сбросить каталог инбаундов (после создания, изменения или удаления инбаунда)"""
+        self.inbound_catalog.invalidate()
+
+    async def _find_client(self, inbound_id, email, timeout=None):
+        # Клиенты разбираются из settings один раз на версию инбаунда в каталоге
+        catalog = await self._fresh_inbound(inbound_id, timeout)
+        for client in catalog.clients(inbound_id):
+            if client.get('email') == email:
+                return dict(client)
+        raise XUIClientError(f"Client {email} not found in inbound {inbound_id}")
+
+    async def add_client(self, inbound_id, email, config_type, uuid=None, expiry_days=30, timeout=None):
+        """
+        Add a client to an inbound
+
+        Args:
+            inbound_id (int): ID of the inbound
+            email (str): Email/identifier for the client
+            config_type (str): Type of VPN config (vless, vmess, etc.)
+            uuid (str, optional): UUID for the client. If None, one will be generated.
+            expiry_days (int): Number of days until the client expires
+            timeout (float, optional): Timeout override for this call
+
+        Returns:
+            dict: Client configuration data
+        """
+        new_client = build_client(config_type, email, uuid=uuid, expiry_days=expiry_days)
+        await self._request(
+            'POST', '/panel/api/inbounds/addClient',
+            timeout=timeout,
+            idempotent=False,
+            json={'id': inbound_id, 'settings': json.dumps({'clients': [new_client]})}
+        )
+        self.inbound_catalog.invalidate_clients(inbound_id)
+        return new_client
+
+    async def update_client(self, inbound_id, email, new_expiry_days=None, enable=None, timeout=None):
+        """
+        Update a client's properties
+
+        Args:
+            inbound_id (int): ID of the inbound
+            email (str): Email/identifier of the client
+            new_expiry_days (int, optional): New expiry time in days from now
+            enable (bool, optional): Whether to enable or disable the client
+            timeout (float, optional): Timeout override for this call
+
+        Returns:
+            dict: Updated client data
+        """
+        client = await self._find_client(inbound_id, email, timeout=timeout)
+
+        if new_expiry_days is not None:
+            client['expiryTime'] = expiry_timestamp(new_expiry_days)
+        if enable is not None:
+            client['enable'] = enable
+
+        await self._request(
+            'POST', f'/panel/api/inbounds/updateClient/{client_key(client)}',
+            timeout=timeout,
+            json={'id': inbound_id, 'settings': json.dumps({'clients': [client]})}
+        )
+        self.inbound_catalog.invalidate_clients(inbound_id)
+        return client
+
+    async def remove_client(self, inbound_id, email, timeout=None):
+        """
+        Remove a client from an inbound
+
+        Returns:
+            bool: True if client was removed, False if it did not exist
+        """
+        try:
+            client = await self._find_client(inbound_id, email, timeout=timeout)
+        except XUIClientError:
+            return False
+
+        await self._request(
+            'POST', f'/panel/api/inbounds/{inbound_id}/delClient/{client_key(client)}',
+            timeout=timeout
+        )
+        self.inbound_catalog.invalidate_clients(inbound_id)
+        return True
+
+    # -- пакетные операции -------------------------------------------------
+
+    async def _write_clients(self, inbound_id, group, write, result, timeout=None):
+        """
+        Change existing clients of one inbound with one request per client
+
+        The inbound is fetched once to find the clients; each change then goes
+        to the per-client endpoint, so clients added by other writers in the
+        meantime are left untouched.
+
+        Args:
+            inbound_id (int): ID of the inbound
+            group (list): [(index, item), ...] for this inbound
+            write (callable): async write(client, item) -> client dict or None;
+                sends the change for one client, raises XUIClientError
+            result (BatchResult): Result to record outcomes in
+        """
+        try:
+            inbound = await self.get_inbound(inbound_id, timeout=timeout)
+            settings = json.loads(inbound.get('settings') or '{}')
+        except XUIClientError as e:
+            for index, item in group:
+                result.fail(index, item, e)
+            return
+        clients = {client.get('email'): client for client in settings.get('clients', [])}
+
+        async def write_one(index, item):
+            client = clients.get(item['email'])
+            if client is None:
+                result.fail(index, item, XUIClientError(
+                    f"Client {item['email']} not found in inbound {inbound_id}"
+                ))
+                return
+            try:
+                written = await write(dict(client), item)
+            except XUIClientError as e:
+                result.fail(index, item, e)
+            else:
+                result.succeed(index, item, written)
+
+        try:
+            await asyncio.gather(*(write_one(index, item) for index, item in group))
+        finally:
+            self.inbound_catalog.invalidate_clients(inbound_id)
+
+    async def add_clients(self, items, timeout=None):
+        """
+        Add many clients, one addClient request per inbound
+
+        Args:
+            items (list): Dicts with inbound_id, email, config_type and
+                optionally uuid and expiry_days
+            timeout (float, optional): Timeout override for each request
+
+        Returns:
+            BatchResult: Per-client results; clients of a failed group all fail
+        """
+        result = BatchResult(len(items))
+
+        async def add_group(inbound_id, group):
+            built = []
+            for index, item in group:
+                try:
+                    client = build_client(item['config_type'], item['email'],
+                                          uuid=item.get('uuid'), expiry_days=item.get('expiry_days', 30))
+                    built.append((index, item, client))
+                except XUIClientError as e:
+                    result.fail(index, item, e)
+            if not built:
+                return
+
+            try:
+                await self._request(
+                    'POST', '/panel/api/inbounds/addClient',
+                    timeout=timeout,
+                    idempotent=False,
+                    json={'id': inbound_id, 'settings': json.dumps({'clients': [c for _, _, c in built]})}
+                )
+            except XUIClientError as e:
+                for index, item, _ in built:
+                    result.fail(index, item, e)
+            else:
+                for index, item, client in built:
+                    result.succeed(index, item, client)
+            finally:
+                self.inbound_catalog.invalidate_clients(inbound_id)
+
+        await asyncio.gather(*(add_group(i, g) for i, g in group_by_inbound(items).items()))
+        return result
+
+    async def update_clients(self, items, timeout=None):
+        """
+        Update many clients, fetching each inbound once
+
+        Args:
+            items (list): Dicts with inbound_id, email and optionally
+                new_expiry_days and enable
+            timeout (float, optional): Timeout override for each request
+
+        Returns:
+            BatchResult: Per-client results; missing clients are reported as failures
+        """
+        result = BatchResult(len(items))
+
+        async def write(client, item):
+            if item.get('new_expiry_days') is not None:
+                client['expiryTime'] = expiry_timestamp(item['new_expiry_days'])
+            if item.get('enable') is not None:
+                client['enable'] = item['enable']
+            await self._request(
+                'POST', f'/panel/api/inbounds/updateClient/{client_key(client)}',
+                timeout=timeout,
+                json={'id': item['inbound_id'], 'settings': json.dumps({'clients': [client]})}
+            )
+            return client
+
+        await asyncio.gather(*(
+            self._write_clients(i, g, write, result, timeout) for i, g in group_by_inbound(items).items()
+        ))
+        return result
+
+    async def remove_clients(self, items, timeout=None):
+        """
+        Remove many clients, fetching each inbound once
+
+        Args:
+            items (list): Dicts with inbound_id and email
+            timeout (float, optional): Timeout override for each request
+
+        Returns:
+            BatchResult: Per-client results; missing clients are reported as failures
+        """
+        result = BatchResult(len(items))
+
+        async def write(client, item):
+            await self._request(
+                'POST', f'/panel/api/inbounds/{item["inbound_id"]}/delClient/{client_key(client)}',
+                timeout=timeout
+            )
+            return None
+
+        await asyncio.gather(*(
+            self._write_clients(i, g, write, result, timeout) for i, g in group_by_inbound(items).items()
+        ))
+        return result
+
+    async def get_stats(self, timeout=None):
+        """
+        Get system stats
+
+        Returns:
+            dict: System statistics
+        """
+        return await self._request('POST', '/server/status', timeout=timeout)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Utility script to fill VPNConfig.share_uri for existing configurations
+
+Обрабатывает конфигурации без share_uri пачками по возрастанию ID. Данные,
+сохраненные ботом в виде repr словаря, заодно переписываются в JSON.
+
+Example:
+    python backfill_share_uris.py --batch-size 500
+"""
+import argparse
+import json
+import logging
+import sys
+
+from app import app, db
+from models import VPNConfig
+from vpn_utils import load_config_data
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+def backfill(batch_size=500, recompute=False):
+    """
+    Fill share_uri for configurations that lack it
+
+    Args:
+        batch_size (int): Rows loaded and committed per batch
+        recompute (bool): Recompute share_uri for all rows, not only empty ones
+
+    Returns:
+        tuple: (updated, failed)
+    """
+    updated = failed = 0
+    last_id = 0
+
+    while True:
+        query = VPNConfig.query.filter(VPNConfig.id > last_id)
+        if not recompute:
+            query = query.filter(VPNConfig.share_uri.is_(None))
+        configs = query.order_by(VPNConfig.id).limit(batch_size).all()
+        if not configs:
+            break
+
+        for config in configs:
+            try:
+                data = load_config_data(config.config_data)
+                normalized = json.dumps(data)
+                if config.config_data != normalized:
+                    config.config_data = normalized
+                config.refresh_share_uri()
+                updated += 1
+            except (ValueError, SyntaxError, KeyError) as e:
+                failed += 1
+                logger.error(f"Не удалось обработать конфигурацию {config.id}: {e}")
+
+        last_id = configs[-1].id
+        db.session.commit()
+        # Освобождаем объекты обработанной пачки
+        db.session.expunge_all()
+        logger.info(f"Обработано до ID {last_id}: обновлено {updated}, ошибок {failed}")
+
+    return updated, failed
+
+def main():
+    """
+    Main entry point
+    """
+    parser = argparse.ArgumentParser(description="Fill VPNConfig.share_uri for existing configurations")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--recompute', action='store_true', help="Recompute URIs for all configurations")
+    args = parser.parse_args()
+
+    with app.app_context():
+        updated, failed = backfill(args.batch_size, args.recompute)
+
+    logger.info(f"Готово: обновлено {updated}, ошибок {failed}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,10 +3,10 @@ Telegram bot implementation for VPN configuration management
 """
 import logging
 import asyncio
+import itertools
 import os
 import sys
-import time
-from datetime import datetime, timedelta
+from datetime import datetime
 
 # Настройка логгера
 logger = logging.getLogger(__name__)
@@ -34,10 +34,19 @@ except ImportError as e:
     logger.error("Убедитесь, что установлена библиотека python-telegram-bot")
     raise
 
-from app import db, app
-from models import TelegramUser, Product, Order, VPNConfig, PaymentMethod, Settings
-from vpn_utils import generate_config, format_config_for_user
-from x_ui_client import XUIClient
+import bot_db
+from bot_db import run_db
+from cache import TTLCache
+import cache_bus
+import metrics
+from settings_snapshot import get_settings
+from update_processor import ChatOrderedUpdateProcessor, MAX_CONCURRENT_UPDATES
+from async_x_ui_client import AsyncXUIClient
+from expiry_sweeper import sweeper as expiry_sweeper
+from qr_service import qr_service
+from broadcast import broadcast_engine
+from notification_outbox import outbox_sender
+from flood_control import FloodControl
 
 # Set up logging
 logging.basicConfig(
@@ -46,11 +55,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+# Полный публичный URL webhook. Если не задан, setWebhook не вызывается
+# (например, при локальной проверке с записанными обновлениями)
+TELEGRAM_WEBHOOK_URL = os.environ.get('TELEGRAM_WEBHOOK_URL')
+# Альтернативный адрес Bot API, например локальная заглушка для тестов
+TELEGRAM_API_BASE_URL = os.environ.get('TELEGRAM_API_BASE_URL')
+
 # Define conversation states
 SELECTING_PRODUCT, CONFIRMING_PURCHASE, PAYMENT_METHOD, AWAITING_PAYMENT = range(4)
 
-# Initialize XUI client
-xui_client = XUIClient(
+# Initialize XUI client (async, чтобы вызовы панели не блокировали event loop)
+xui_client = AsyncXUIClient(
     base_url=os.environ.get('XUI_PANEL_URL', 'http://localhost:54321'),
     username=os.environ.get('XUI_USERNAME', 'admin'),
     password=os.environ.get('XUI_PASSWORD', 'admin')
@@ -58,60 +75,67 @@ xui_client = XUIClient(
 
 # Кэширование для улучшения производительности
 # Храним результаты запросов на 5 минут, чтобы уменьшить число обращений к базе данных
-USER_BLOCK_CACHE = {}  # {telegram_id: (is_blocked, timestamp)}
-PRODUCTS_CACHE = {}  # {cache_key: (products_list, timestamp)}
-USER_CONFIGS_CACHE = {}  # {user_id: (configs_list, timestamp)}
-CACHE_TTL = 300  # 5 минут (300 секунд)
+CACHE_TTL = int(os.environ.get('BOT_CACHE_TTL', '300'))  # 5 минут (300 секунд)
+CACHE_MAX_SIZE = int(os.environ.get('BOT_CACHE_MAX_SIZE', '50000'))
+
+# Пространства имен кэша
+USER_BLOCK_NS = 'user_block'  # {telegram_id: is_blocked}
+PRODUCTS_NS = 'products'  # {'active_products': products_list}
+USER_CONFIGS_NS = 'user_configs'  # {telegram_id: configs_list}
+USER_PROFILE_NS = 'user_profile'  # {telegram_id: profile_stats}
+
+bot_cache = TTLCache(
+    max_size=CACHE_MAX_SIZE,
+    default_ttl=CACHE_TTL,
+    ttls={
+        USER_BLOCK_NS: int(os.environ.get('BOT_CACHE_USER_BLOCK_TTL', CACHE_TTL)),
+        PRODUCTS_NS: int(os.environ.get('BOT_CACHE_PRODUCTS_TTL', CACHE_TTL)),
+        USER_CONFIGS_NS: int(os.environ.get('BOT_CACHE_USER_CONFIGS_TTL', CACHE_TTL)),
+        USER_PROFILE_NS: int(os.environ.get('BOT_CACHE_USER_PROFILE_TTL', CACHE_TTL)),
+    }
+)
+metrics.register_cache('bot', bot_cache)
+
+# Версия каталога растет при каждом сбросе PRODUCTS_NS: список продуктов,
+# прочитанный из базы до сброса, не должен попасть в кэш после него
+_catalog_versions = itertools.count(1)
+catalog_version = 0
 
 async def check_user_blocked(update: Update) -> bool:
     """Проверка, заблокирован ли пользователь с кэшированием результатов"""
     user = update.effective_user
     if not user:
         return False
-        
-    current_time = time.time()
+    
     user_id = user.id
     
-    # Проверяем кэш сначала
-    if user_id in USER_BLOCK_CACHE:
-        is_blocked, timestamp = USER_BLOCK_CACHE[user_id]
-        # Если кэш свежий (не старше CACHE_TTL секунд)
-        if current_time - timestamp < CACHE_TTL:
-            if is_blocked:
-                # Если пользователь заблокирован, отправляем сообщение
-                if update.callback_query:
-                    await update.callback_query.answer("Вы заблокированы в системе. Свяжитесь с администратором для разблокировки.")
-                    await update.callback_query.message.reply_text(
-                        "⛔ Ваш аккаунт заблокирован. Свяжитесь с администратором для разблокировки."
-                    )
-                else:
-                    await update.message.reply_text(
-                        "⛔ Ваш аккаунт заблокирован. Свяжитесь с администратором для разблокировки."
-                    )
-                return True
-            return False
-    
-    # Если кэша нет или он устарел, проверяем в базе данных
-    with app.app_context():
-        telegram_user = TelegramUser.query.filter_by(telegram_id=user_id).first()
-        is_blocked = False
-        
-        if telegram_user and telegram_user.is_blocked:
-            is_blocked = True
-            # Если пользователь заблокирован, отправляем сообщение
-            if update.callback_query:
-                await update.callback_query.answer("Вы заблокированы в системе. Свяжитесь с администратором для разблокировки.")
-                await update.callback_query.message.reply_text(
-                    "⛔ Ваш аккаунт заблокирован. Свяжитесь с администратором для разблокировки."
-                )
-            else:
-                await update.message.reply_text(
-                    "⛔ Ваш аккаунт заблокирован. Свяжитесь с администратором для разблокировки."
-                )
-        
-        # Обновляем кэш
-        USER_BLOCK_CACHE[user_id] = (is_blocked, current_time)
-        return is_blocked
+    # Проверяем кэш сначала, при промахе - базу данных
+    is_blocked = bot_cache.get(USER_BLOCK_NS, user_id)
+    if is_blocked is None:
+        is_blocked = await run_db(bot_db.is_user_blocked, user_id)
+        bot_cache.set(USER_BLOCK_NS, user_id, is_blocked)
+    
+    if is_blocked:
+        # Если пользователь заблокирован, отправляем сообщение
+        if update.callback_query:
+            await update.callback_query.answer("Вы заблокированы в системе. Свяжитесь с администратором для разблокировки.")
+            await update.callback_query.message.reply_text(
+                "⛔ Ваш аккаунт заблокирован. Свяжитесь с администратором для разблокировки."
+            )
+        else:
+            await update.message.reply_text(
+                "⛔ Ваш аккаунт заблокирован. Свяжитесь с администратором для разблокировки."
+            )
+    
+    return is_blocked
+
+def is_admin_user(telegram_id) -> bool:
+    """Проверить, является ли пользователь администратором бота"""
+    admin_id = get_settings().admin_telegram_id
+    return admin_id is not None and telegram_id == admin_id
+
+# Ограничение частоты обновлений от одного пользователя; администратор не ограничен
+flood_control = FloodControl(exempt=is_admin_user)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handler for /start command"""
@@ -122,32 +146,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     
     # Register or get the user
-    with app.app_context():
-        telegram_user = TelegramUser.query.filter_by(telegram_id=user.id).first()
-        if not telegram_user:
-            telegram_user = TelegramUser(
-                telegram_id=user.id,
-                username=user.username,
-                first_name=user.first_name,
-                last_name=user.last_name
-            )
-            db.session.add(telegram_user)
-            db.session.commit()
-            
-            # Логируем нового пользователя
-            logger.info(f"Зарегистрирован новый пользователь: {user.first_name} (ID: {user.id})")
-        
-        # Получаем приветственное сообщение из настроек
-        welcome_setting = Settings.query.filter_by(key='welcome_message').first()
-        if welcome_setting and welcome_setting.value:
-            welcome_message = welcome_setting.value.replace('{name}', user.first_name)
-        else:
-            welcome_message = (
-                f"👋 Добро пожаловать в VPN Shop Bot, {user.first_name}!\n\n"
-                "Здесь вы можете приобрести безопасные и быстрые VPN-конфигурации "
-                "для обхода блокировок и защиты вашей приватности.\n\n"
-                "Используйте меню для навигации:"
-            )
+    _, created = await run_db(
+        bot_db.get_or_create_user,
+        user.id, user.username, user.first_name, user.last_name
+    )
+    if created:
+        # Логируем нового пользователя
+        logger.info(f"Зарегистрирован новый пользователь: {user.first_name} (ID: {user.id})")
+    
+    # Получаем приветственное сообщение и ID администратора из снимка настроек
+    settings = get_settings()
+    if settings.welcome_message:
+        welcome_message = settings.welcome_message.replace('{name}', user.first_name)
+    else:
+        welcome_message = (
+            f"👋 Добро пожаловать в VPN Shop Bot, {user.first_name}!\n\n"
+            "Здесь вы можете приобрести безопасные и быстрые VPN-конфигурации "
+            "для обхода блокировок и защиты вашей приватности.\n\n"
+            "Используйте меню для навигации:"
+        )
+    is_admin = is_admin_user(user.id)
     
     # Создаем кнопки-вкладки
     buttons = [
@@ -170,16 +188,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     ]
     
     # Если пользователь является администратором, добавляем ему специальную кнопку
-    with app.app_context():
-        admin_id_setting = Settings.query.filter_by(key='admin_telegram_id').first()
-        if admin_id_setting and admin_id_setting.value:
-            try:
-                admin_id = int(admin_id_setting.value)
-                if user.id == admin_id:
-                    buttons.append([InlineKeyboardButton("⚙️ Панель администратора", callback_data="admin_panel")])
-                    logger.info(f"Администратор {user.first_name} (ID: {user.id}) подключился к боту")
-            except ValueError:
-                logger.warning(f"Неверный формат ID администратора в настройках: {admin_id_setting.value}")
+    if is_admin:
+        buttons.append([InlineKeyboardButton("⚙️ Панель администратора", callback_data="admin_panel")])
+        logger.info(f"Администратор {user.first_name} (ID: {user.id}) подключился к боту")
     
     # Создаем обычные кнопки для клавиатуры
     keyboard = [
@@ -189,15 +200,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     ]
     
     # Добавляем админскую кнопку на клавиатуру если нужно
-    with app.app_context():
-        admin_id_setting = Settings.query.filter_by(key='admin_telegram_id').first()
-        if admin_id_setting and admin_id_setting.value:
-            try:
-                admin_id = int(admin_id_setting.value)
-                if user.id == admin_id:
-                    keyboard.append(["⚙️ Панель администратора"])
-            except ValueError:
-                pass
+    if is_admin:
+        keyboard.append(["⚙️ Панель администратора"])
     
     # Отправляем сообщение с вкладками и кнопками
     await update.message.reply_text(
@@ -211,69 +215,62 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     )
 
+def invalidate_catalog(key=None):
+    """Сбросить кэш продуктов и перейти к новой версии каталога"""
+    global catalog_version
+    # Сначала версия, затем очистка: запись, проверившая старую версию, будет удалена очисткой
+    catalog_version = next(_catalog_versions)
+    return bot_cache.clear(PRODUCTS_NS)
+
+def cache_catalog_entry(key, value, version):
+    """
+    Cache a products namespace entry loaded at the given catalog version
+
+    Returns:
+        bool: False if the catalog was invalidated since, and nothing is cached
+    """
+    if version != catalog_version:
+        return False
+    bot_cache.set(PRODUCTS_NS, key, value)
+    if version != catalog_version:
+        # Сброс из потока шины пришел во время записи
+        bot_cache.delete(PRODUCTS_NS, key)
+        return False
+    return True
+
 async def clear_products_cache():
-    """Очистить кэш активных продуктов"""
-    global PRODUCTS_CACHE
-    
-    cache_key = 'active_products'
-    if cache_key in PRODUCTS_CACHE:
-        del PRODUCTS_CACHE[cache_key]
-        return True
-    return False
+    """Очистить кэш активных продуктов вместе с готовым сообщением каталога"""
+    return invalidate_catalog() > 0
+
+def subscribe_cache_invalidation(bus):
+    """Подписать кэш бота на сообщения инвалидации из админ-панели"""
+    bus.subscribe(cache_bus.PRODUCTS_CHANNEL, invalidate_catalog)
+    bus.subscribe(cache_bus.USER_CONFIGS_CHANNEL, drop_user_cache)
+    bus.subscribe(cache_bus.USER_BLOCK_CHANNEL, lambda key: bot_cache.delete(USER_BLOCK_NS, key))
 
 async def get_active_products():
     """Получить список активных продуктов с кэшированием для улучшения производительности"""
-    global PRODUCTS_CACHE
-    
-    cache_key = 'active_products'
-    current_time = time.time()
-    
     # Проверяем кэш сначала
-    if cache_key in PRODUCTS_CACHE:
-        products_list, timestamp = PRODUCTS_CACHE[cache_key]
-        # Если кэш свежий (не старше CACHE_TTL секунд)
-        if current_time - timestamp < CACHE_TTL:
-            return products_list
-    
-    # Если кэша нет или он устарел, загружаем из базы данных
-    with app.app_context():
-        products = Product.query.filter_by(is_active=True).all()
-        
-        # Кэшируем результат
-        PRODUCTS_CACHE[cache_key] = (products, current_time)
-        
+    products = bot_cache.get(PRODUCTS_NS, 'active_products')
+    if products is not None:
         return products
-
-async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Display available VPN products/packages"""
-    # Проверяем, не заблокирован ли пользователь
-    if await check_user_blocked(update):
-        return ConversationHandler.END
-        
-    query = update.callback_query
-    if query:
-        await query.answer()
-        message = query.message
-    else:
-        message = update.message
     
-    # Используем кэшированный список продуктов
-    products = await get_active_products()
+    # Если кэша нет или он устарел, загружаем из базы данных
+    version = catalog_version
+    products = await run_db(bot_db.get_active_products)
     
-    if not products:
-        if query:
-            await message.edit_text(
-                "В данный момент нет доступных VPN-пакетов. Пожалуйста, попробуйте позже.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Вернуться в меню", callback_data="tab_main")
-                ]])
-            )
-        else:
-            await message.reply_text(
-                "В данный момент нет доступных VPN-пакетов. Пожалуйста, попробуйте позже."
-            )
-        return ConversationHandler.END
+    # Кэшируем результат, если каталог не сбросили во время загрузки
+    cache_catalog_entry('active_products', products, version)
     
+    return products
+
+def render_catalog(products):
+    """
+    Render the catalog message and keyboard for a product list
+
+    Returns:
+        tuple: (text, InlineKeyboardMarkup)
+    """
     # Шапка с вкладками
     tabs = [
         InlineKeyboardButton("🏠 Главная", callback_data="tab_main"),
@@ -308,16 +305,73 @@ async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     # Добавляем вкладки в начало списка кнопок
     buttons.insert(0, tabs)
     
+    return text, InlineKeyboardMarkup(buttons)
+
+async def get_catalog_view():
+    """
+    Get the rendered catalog, building it once per catalog version
+
+    The view is cached in the products namespace, so it is dropped together
+    with the product list when the catalog changes. A view built from a
+    product list read before an invalidation is returned but not cached.
+
+    Returns:
+        tuple: (text, InlineKeyboardMarkup), or None if there are no products
+    """
+    version = catalog_version
+    view = bot_cache.get(PRODUCTS_NS, 'catalog_view')
+    if view is not None:
+        return view
+    
+    products = await get_active_products()
+    if not products:
+        return None
+    
+    view = render_catalog(products)
+    cache_catalog_entry('catalog_view', view, version)
+    return view
+
+async def show_products(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Display available VPN products/packages"""
+    # Проверяем, не заблокирован ли пользователь
+    if await check_user_blocked(update):
+        return ConversationHandler.END
+        
+    query = update.callback_query
+    if query:
+        await query.answer()
+        message = query.message
+    else:
+        message = update.message
+    
+    # Используем готовое сообщение каталога
+    view = await get_catalog_view()
+    
+    if view is None:
+        if query:
+            await message.edit_text(
+                "В данный момент нет доступных VPN-пакетов. Пожалуйста, попробуйте позже.",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("🏠 Вернуться в меню", callback_data="tab_main")
+                ]])
+            )
+        else:
+            await message.reply_text(
+                "В данный момент нет доступных VPN-пакетов. Пожалуйста, попробуйте позже."
+            )
+        return ConversationHandler.END
+    
+    text, reply_markup = view
     if query:
         await message.edit_text(
             text,
-            reply_markup=InlineKeyboardMarkup(buttons),
+            reply_markup=reply_markup,
             parse_mode="Markdown"
         )
     else:
         await message.reply_text(
             text,
-            reply_markup=InlineKeyboardMarkup(buttons),
+            reply_markup=reply_markup,
             parse_mode="Markdown"
         )
     
@@ -332,88 +386,86 @@ async def product_selected(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     product_id = int(query.data.split('_')[1])
     context.user_data['selected_product_id'] = product_id
     
-    with app.app_context():
-        product = Product.query.get(product_id)
-        
-        if not product:
-            await query.message.edit_text(
-                "Продукт не найден. Пожалуйста, выберите другой продукт.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("⬅️ Назад к списку", callback_data="back_to_products")
-                ]])
-            )
-            return SELECTING_PRODUCT
-        
-        # Store product info in context
-        context.user_data['product_info'] = {
-            'id': product.id,
-            'name': product.name,
-            'price': product.price,
-            'duration_days': product.duration_days,
-            'config_type': product.config_type
-        }
-        
-        confirmation_text = (
-            f"🔍 *Детали выбранного пакета:*\n\n"
-            f"*{product.name}*\n"
-            f"Описание: {product.description}\n"
-            f"Тип: {product.config_type.upper()}\n"
-            f"Срок действия: {product.duration_days} дней\n"
-            f"Цена: {product.price} руб.\n\n"
-            f"Подтверждаете покупку?"
-        )
-        
+    product = await run_db(bot_db.get_product, product_id)
+    
+    if not product:
         await query.message.edit_text(
-            confirmation_text,
-            reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("✅ Подтвердить", callback_data="confirm_purchase"),
-                    InlineKeyboardButton("❌ Отмена", callback_data="cancel")
-                ],
-                [InlineKeyboardButton("⬅️ Назад к списку", callback_data="back_to_products")]
-            ]),
-            parse_mode="Markdown"
+            "Продукт не найден. Пожалуйста, выберите другой продукт.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("⬅️ Назад к списку", callback_data="back_to_products")
+            ]])
         )
-        
-        return CONFIRMING_PURCHASE
+        return SELECTING_PRODUCT
+    
+    # Store product info in context
+    context.user_data['product_info'] = {
+        'id': product.id,
+        'name': product.name,
+        'price': product.price,
+        'duration_days': product.duration_days,
+        'config_type': product.config_type
+    }
+    
+    confirmation_text = (
+        f"🔍 *Детали выбранного пакета:*\n\n"
+        f"*{product.name}*\n"
+        f"Описание: {product.description}\n"
+        f"Тип: {product.config_type.upper()}\n"
+        f"Срок действия: {product.duration_days} дней\n"
+        f"Цена: {product.price} руб.\n\n"
+        f"Подтверждаете покупку?"
+    )
+    
+    await query.message.edit_text(
+        confirmation_text,
+        reply_markup=InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("✅ Подтвердить", callback_data="confirm_purchase"),
+                InlineKeyboardButton("❌ Отмена", callback_data="cancel")
+            ],
+            [InlineKeyboardButton("⬅️ Назад к списку", callback_data="back_to_products")]
+        ]),
+        parse_mode="Markdown"
+    )
+    
+    return CONFIRMING_PURCHASE
 
 async def confirm_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle purchase confirmation"""
     query = update.callback_query
     await query.answer()
     
-    with app.app_context():
-        payment_methods = PaymentMethod.query.filter_by(is_active=True).all()
-        
-        if not payment_methods:
-            await query.message.edit_text(
-                "К сожалению, сейчас нет доступных способов оплаты. "
-                "Пожалуйста, попробуйте позже или обратитесь в поддержку.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("⬅️ Назад", callback_data="back_to_products")
-                ]])
-            )
-            return SELECTING_PRODUCT
-        
-        payment_text = "💳 Выберите способ оплаты:\n\n"
-        buttons = []
-        
-        for method in payment_methods:
-            payment_text += f"• *{method.name}*: {method.description}\n"
-            buttons.append([InlineKeyboardButton(
-                method.name, 
-                callback_data=f"payment_{method.id}"
-            )])
-        
-        buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_product")])
-        
+    payment_methods = await run_db(bot_db.get_active_payment_methods)
+    
+    if not payment_methods:
         await query.message.edit_text(
-            payment_text,
-            reply_markup=InlineKeyboardMarkup(buttons),
-            parse_mode="Markdown"
+            "К сожалению, сейчас нет доступных способов оплаты. "
+            "Пожалуйста, попробуйте позже или обратитесь в поддержку.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("⬅️ Назад", callback_data="back_to_products")
+            ]])
         )
-        
-        return PAYMENT_METHOD
+        return SELECTING_PRODUCT
+    
+    payment_text = "💳 Выберите способ оплаты:\n\n"
+    buttons = []
+    
+    for method in payment_methods:
+        payment_text += f"• *{method.name}*: {method.description}\n"
+        buttons.append([InlineKeyboardButton(
+            method.name, 
+            callback_data=f"payment_{method.id}"
+        )])
+    
+    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_product")])
+    
+    await query.message.edit_text(
+        payment_text,
+        reply_markup=InlineKeyboardMarkup(buttons),
+        parse_mode="Markdown"
+    )
+    
+    return PAYMENT_METHOD
 
 async def process_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle payment method selection and order creation"""
@@ -426,55 +478,38 @@ async def process_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user = update.effective_user
     product_info = context.user_data.get('product_info')
     
-    with app.app_context():
-        # Get payment method
-        payment_method = PaymentMethod.query.get(payment_method_id)
-        
-        # Get or create telegram user
-        telegram_user = TelegramUser.query.filter_by(telegram_id=user.id).first()
-        if not telegram_user:
-            telegram_user = TelegramUser(
-                telegram_id=user.id,
-                username=user.username,
-                first_name=user.first_name,
-                last_name=user.last_name
-            )
-            db.session.add(telegram_user)
-            db.session.commit()
-        
-        # Create order
-        order = Order(
-            user_id=telegram_user.id,
-            product_id=product_info['id'],
-            amount=product_info['price'],
-            status='pending'
-        )
-        db.session.add(order)
-        db.session.commit()
-        
-        # Store order ID in context
-        context.user_data['order_id'] = order.id
-        
-        # Prepare payment instructions
-        payment_text = (
-            f"💰 *Оплата заказа #{order.id}*\n\n"
-            f"Сумма к оплате: *{order.amount} руб.*\n"
-            f"Способ оплаты: *{payment_method.name}*\n\n"
-            f"Инструкции по оплате:\n{payment_method.instructions}\n\n"
-            f"После оплаты нажмите кнопку «Я оплатил» ниже. "
-            f"Администратор проверит оплату и активирует ваш VPN."
-        )
-        
-        await query.message.edit_text(
-            payment_text,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Я оплатил", callback_data=f"paid_{order.id}")],
-                [InlineKeyboardButton("❌ Отмена", callback_data="cancel_payment")]
-            ]),
-            parse_mode="Markdown"
-        )
-        
-        return AWAITING_PAYMENT
+    # Get or create telegram user and create order
+    order = await run_db(
+        bot_db.create_order,
+        user.id, user.username, user.first_name, user.last_name,
+        product_info['id'], product_info['price'], payment_method_id
+    )
+    
+    # Store order ID in context
+    context.user_data['order_id'] = order['order_id']
+    # Число заказов в профиле изменилось
+    bot_cache.delete(USER_PROFILE_NS, user.id)
+    
+    # Prepare payment instructions
+    payment_text = (
+        f"💰 *Оплата заказа #{order['order_id']}*\n\n"
+        f"Сумма к оплате: *{order['amount']} руб.*\n"
+        f"Способ оплаты: *{order['payment_method_name']}*\n\n"
+        f"Инструкции по оплате:\n{order['payment_instructions']}\n\n"
+        f"После оплаты нажмите кнопку «Я оплатил» ниже. "
+        f"Администратор проверит оплату и активирует ваш VPN."
+    )
+    
+    await query.message.edit_text(
+        payment_text,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Я оплатил", callback_data=f"paid_{order['order_id']}")],
+            [InlineKeyboardButton("❌ Отмена", callback_data="cancel_payment")]
+        ]),
+        parse_mode="Markdown"
+    )
+    
+    return AWAITING_PAYMENT
 
 async def payment_confirmed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle user confirming payment"""
@@ -483,41 +518,38 @@ async def payment_confirmed(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     order_id = int(query.data.split('_')[1])
     
-    with app.app_context():
-        order = Order.query.get(order_id)
-        
-        if not order:
-            await query.message.edit_text(
-                "Заказ не найден. Пожалуйста, начните процесс заново.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔄 Начать заново", callback_data="start")
-                ]])
-            )
-            return ConversationHandler.END
-        
-        # Mark order as awaiting confirmation
-        order.status = 'awaiting_confirmation'
-        db.session.commit()
-        
-        # Notify admin about payment (implement this elsewhere)
-        
+    # Mark order as awaiting confirmation
+    found = await run_db(bot_db.mark_order_awaiting_confirmation, order_id)
+    
+    if not found:
         await query.message.edit_text(
-            "✅ Спасибо за информацию об оплате!\n\n"
-            "Ваш платеж находится на проверке у администратора. "
-            "Как только платеж будет подтвержден, вы получите доступ к VPN.\n\n"
-            "Это обычно происходит в течение 30 минут до нескольких часов "
-            "(в зависимости от времени суток).",
+            "Заказ не найден. Пожалуйста, начните процесс заново.",
             reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🏠 Главное меню", callback_data="start")
+                InlineKeyboardButton("🔄 Начать заново", callback_data="start")
             ]])
         )
-        
-        user = update.effective_user
-        # Очистим кэш конфигураций пользователя
-        await clear_user_configs_cache(user.id)
-        
-        # End the conversation
         return ConversationHandler.END
+    
+    # Администратор получит заказ в сводке из outbox
+    outbox_sender.wake()
+    
+    await query.message.edit_text(
+        "✅ Спасибо за информацию об оплате!\n\n"
+        "Ваш платеж находится на проверке у администратора. "
+        "Как только платеж будет подтвержден, вы получите доступ к VPN.\n\n"
+        "Это обычно происходит в течение 30 минут до нескольких часов "
+        "(в зависимости от времени суток).",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("🏠 Главное меню", callback_data="start")
+        ]])
+    )
+    
+    user = update.effective_user
+    # Очистим кэш конфигураций пользователя
+    await clear_user_configs_cache(user.id)
+    
+    # End the conversation
+    return ConversationHandler.END
 
 async def cancel_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancel the purchase process"""
@@ -537,59 +569,48 @@ async def cancel_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # Clean up any order data if needed
     if context.user_data.get('order_id'):
-        with app.app_context():
-            order = Order.query.get(context.user_data['order_id'])
-            if order and order.status == 'pending':
-                order.status = 'cancelled'
-                db.session.commit()
+        await run_db(bot_db.cancel_pending_order, context.user_data['order_id'])
     
     # Clear user data
     context.user_data.clear()
     
     return ConversationHandler.END
 
+def drop_user_cache(telegram_id):
+    """Удалить конфигурации и статистику профиля пользователя из кэша"""
+    bot_cache.delete(USER_PROFILE_NS, telegram_id)
+    return bot_cache.delete(USER_CONFIGS_NS, telegram_id)
+
 async def clear_user_configs_cache(telegram_id):
-    """Очистить кэш конфигураций пользователя"""
-    global USER_CONFIGS_CACHE
-    
-    cache_key = f"user_configs_{telegram_id}"
-    if cache_key in USER_CONFIGS_CACHE:
-        del USER_CONFIGS_CACHE[cache_key]
-        return True
-    return False
+    """Очистить кэш конфигураций пользователя вместе со статистикой профиля"""
+    return drop_user_cache(telegram_id)
+
+async def get_profile_stats(telegram_id):
+    """Получить статистику профиля с кэшированием"""
+    stats = bot_cache.get(USER_PROFILE_NS, telegram_id)
+    if stats is not None:
+        return stats
+    
+    stats = await run_db(bot_db.get_profile_stats, telegram_id)
+    if stats is not None:
+        bot_cache.set(USER_PROFILE_NS, telegram_id, stats)
+    return stats
 
 async def get_user_active_configs(telegram_id):
     """Получить список активных VPN-конфигураций пользователя с кэшированием"""
-    global USER_CONFIGS_CACHE
-    
-    cache_key = f"user_configs_{telegram_id}"
-    current_time = time.time()
-    
     # Проверяем кэш сначала
-    if cache_key in USER_CONFIGS_CACHE:
-        configs_list, timestamp = USER_CONFIGS_CACHE[cache_key]
-        # Если кэш свежий (не старше CACHE_TTL секунд)
-        if current_time - timestamp < CACHE_TTL:
-            return configs_list
+    configs = bot_cache.get(USER_CONFIGS_NS, telegram_id)
+    if configs is not None:
+        return configs
     
     # Если кэша нет или он устарел, загружаем из базы данных
-    with app.app_context():
-        # Сначала получаем объект пользователя по telegram_id
-        telegram_user = TelegramUser.query.filter_by(telegram_id=telegram_id).first()
-        
-        if telegram_user:
-            # Получаем все активные конфигурации пользователя
-            configs = VPNConfig.query.filter_by(
-                user_id=telegram_user.id,
-                is_active=True
-            ).all()
-            
-            # Кэшируем результат
-            USER_CONFIGS_CACHE[cache_key] = (configs, current_time)
-            
-            return configs
-        else:
-            return None
+    configs = await run_db(bot_db.get_user_active_configs, telegram_id)
+    
+    if configs is not None:
+        # Кэшируем результат
+        bot_cache.set(USER_CONFIGS_NS, telegram_id, configs)
+    
+    return configs
 
 async def refresh_user_configs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обновляет и показывает актуальный список конфигураций пользователя"""
@@ -622,26 +643,23 @@ async def my_configs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     else:
         message = update.message
     
-    # Получаем пользователя из базы, чтобы убедиться, что он существует
-    with app.app_context():
-        telegram_user = TelegramUser.query.filter_by(telegram_id=user.id).first()
-        
-        if not telegram_user:
-            if query:
-                await message.edit_text(
-                    "Вы еще не зарегистрированы в нашей системе. "
-                    "Пожалуйста, начните с команды /start."
-                )
-            else:
-                await message.reply_text(
-                    "Вы еще не зарегистрированы в нашей системе. "
-                    "Пожалуйста, начните с команды /start."
-                )
-            return
-    
-    # Используем кэшированный список конфигураций
+    # Используем кэшированный список конфигураций.
+    # None означает, что пользователь еще не зарегистрирован
     configs = await get_user_active_configs(user.id)
     
+    if configs is None:
+        if query:
+            await message.edit_text(
+                "Вы еще не зарегистрированы в нашей системе. "
+                "Пожалуйста, начните с команды /start."
+            )
+        else:
+            await message.reply_text(
+                "Вы еще не зарегистрированы в нашей системе. "
+                "Пожалуйста, начните с команды /start."
+            )
+        return
+    
     # Шапка с вкладками
     tabs = [
         InlineKeyboardButton("🏠 Главная", callback_data="tab_main"),
@@ -736,38 +754,31 @@ async def get_config(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     
     config_id = int(query.data.split('_')[2])
     
-    with app.app_context():
-        config = VPNConfig.query.get(config_id)
-        
-        if not config or not config.is_active:
-            await query.message.reply_text(
-                "❌ Конфигурация не найдена или неактивна."
-            )
-            return
-        
-        # Get user data
-        user_id = update.effective_user.id
-        telegram_user = TelegramUser.query.filter_by(telegram_id=user_id).first()
-        
-        if not telegram_user or config.user_id != telegram_user.id:
-            await query.message.reply_text(
-                "❌ У вас нет доступа к этой конфигурации."
-            )
-            return
-        
-        # Format and send the configuration
-        formatted_config = format_config_for_user(config)
-        
+    # Проверяем доступ и форматируем конфигурацию вне event loop
+    error, config, formatted_config = await run_db(
+        bot_db.get_user_config, update.effective_user.id, config_id, formatted=True
+    )
+    
+    if error == 'not_found':
         await query.message.reply_text(
-            f"📱 *Ваша VPN-конфигурация: {config.name}*\n\n"
-            f"Тип: {config.config_type.upper()}\n"
-            f"Действительна до: {config.valid_until.strftime('%d.%m.%Y')}\n\n"
-            f"```\n{formatted_config}\n```\n\n"
-            f"Для подключения просто скопируйте эту конфигурацию или используйте QR-код.",
-            parse_mode="Markdown"
+            "❌ Конфигурация не найдена или неактивна."
         )
-        
-        # Generate and send QR code as image (implement this elsewhere)
+        return
+    
+    if error == 'forbidden':
+        await query.message.reply_text(
+            "❌ У вас нет доступа к этой конфигурации."
+        )
+        return
+    
+    await query.message.reply_text(
+        f"📱 *Ваша VPN-конфигурация: {config.name}*\n\n"
+        f"Тип: {config.config_type.upper()}\n"
+        f"Действительна до: {config.valid_until.strftime('%d.%m.%Y')}\n\n"
+        f"```\n{formatted_config}\n```\n\n"
+        f"Для подключения просто скопируйте эту конфигурацию или используйте QR-код.",
+        parse_mode="Markdown"
+    )
 
 async def get_qr_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send QR code for VPN configuration"""
@@ -780,29 +791,32 @@ async def get_qr_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     
     config_id = int(query.data.split('_')[2])
     
-    with app.app_context():
-        config = VPNConfig.query.get(config_id)
-        
-        if not config or not config.is_active:
-            await query.message.reply_text(
-                "❌ Конфигурация не найдена или неактивна."
-            )
-            return
-        
-        # Get user data
-        user_id = update.effective_user.id
-        telegram_user = TelegramUser.query.filter_by(telegram_id=user_id).first()
-        
-        if not telegram_user or config.user_id != telegram_user.id:
-            await query.message.reply_text(
-                "❌ У вас нет доступа к этой конфигурации."
-            )
-            return
-        
-        # Временное сообщение для QR-кода
+    error, config, share_uri = await run_db(
+        bot_db.get_user_config, update.effective_user.id, config_id, formatted=True
+    )
+    
+    if error == 'not_found':
         await query.message.reply_text(
-            f"🔄 Функция QR-кода для конфигурации '{config.name}' в разработке.\n\n"
-            f"Пожалуйста, используйте текстовую конфигурацию."
+            "❌ Конфигурация не найдена или неактивна."
+        )
+        return
+    
+    if error == 'forbidden':
+        await query.message.reply_text(
+            "❌ У вас нет доступа к этой конфигурации."
+        )
+        return
+    
+    try:
+        await qr_service.reply_qr(
+            query.message,
+            share_uri,
+            caption=f"📱 QR-код конфигурации «{config.name}». Отсканируйте его в VPN-клиенте."
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при отправке QR-кода для конфигурации {config_id}: {e}")
+        await query.message.reply_text(
+            "❌ Не удалось создать QR-код. Пожалуйста, используйте текстовую конфигурацию."
         )
 
 async def handle_tab_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -848,18 +862,17 @@ async def show_main_tab(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         InlineKeyboardButton("🔑 Мои VPN", callback_data="tab_configs")
     ]
     
-    # Получаем приветственное сообщение из настроек
-    with app.app_context():
-        welcome_setting = Settings.query.filter_by(key='welcome_message').first()
-        if welcome_setting and welcome_setting.value:
-            welcome_message = welcome_setting.value.replace('{name}', user.first_name)
-        else:
-            welcome_message = (
-                f"👋 Добро пожаловать в VPN Shop Bot, {user.first_name}!\n\n"
-                "Здесь вы можете приобрести безопасные и быстрые VPN-конфигурации "
-                "для обхода блокировок и защиты вашей приватности.\n\n"
-                "Используйте меню для навигации."
-            )
+    # Получаем приветственное сообщение и ID администратора из снимка настроек
+    settings = get_settings()
+    if settings.welcome_message:
+        welcome_message = settings.welcome_message.replace('{name}', user.first_name)
+    else:
+        welcome_message = (
+            f"👋 Добро пожаловать в VPN Shop Bot, {user.first_name}!\n\n"
+            "Здесь вы можете приобрести безопасные и быстрые VPN-конфигурации "
+            "для обхода блокировок и защиты вашей приватности.\n\n"
+            "Используйте меню для навигации."
+        )
     
     # Создаем кнопки меню
     buttons = [
@@ -872,15 +885,8 @@ async def show_main_tab(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     ]
     
     # Если пользователь является администратором, добавляем ему специальную кнопку
-    with app.app_context():
-        admin_id_setting = Settings.query.filter_by(key='admin_telegram_id').first()
-        if admin_id_setting and admin_id_setting.value:
-            try:
-                admin_id = int(admin_id_setting.value)
-                if user.id == admin_id:
-                    buttons.append([InlineKeyboardButton("⚙️ Панель администратора", callback_data="admin_panel")])
-            except ValueError:
-                pass
+    if is_admin_user(user.id):
+        buttons.append([InlineKeyboardButton("⚙️ Панель администратора", callback_data="admin_panel")])
     
     await query.message.edit_text(
         welcome_message,
@@ -899,62 +905,48 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     user = update.effective_user
     
     # Получаем данные о пользователе
-    with app.app_context():
-        telegram_user = TelegramUser.query.filter_by(telegram_id=user.id).first()
-        
-        if not telegram_user:
-            await query.message.edit_text(
-                "Информация о вашем профиле не найдена. Пожалуйста, перезапустите бота командой /start",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🏠 Главная", callback_data="tab_main")
-                ]])
-            )
-            return
-        
-        # Шапка с вкладками
-        tabs = [
-            InlineKeyboardButton("🏠 Главная", callback_data="tab_main"),
-            InlineKeyboardButton("🛒 Продукты", callback_data="tab_products"),
-            InlineKeyboardButton("🔑 Мои VPN", callback_data="tab_configs")
-        ]
-        
-        # Считаем активные и неактивные конфигурации
-        active_configs = VPNConfig.query.filter_by(
-            user_id=telegram_user.id,
-            is_active=True
-        ).count()
-        
-        # Получаем историю заказов
-        orders = Order.query.filter_by(user_id=telegram_user.id).count()
-        completed_orders = Order.query.filter_by(
-            user_id=telegram_user.id,
-            status='completed'
-        ).count()
-        
-        # Готовим сообщение с профилем
-        profile_text = (
-            f"👤 *Профиль пользователя*\n\n"
-            f"Имя: {user.first_name}" + (f" {user.last_name}" if user.last_name else "") + "\n"
-            f"ID: `{user.id}`\n"
-            f"Дата регистрации: {telegram_user.registration_date.strftime('%d.%m.%Y')}\n\n"
-            f"📊 *Статистика:*\n"
-            f"Активные VPN: {active_configs}\n"
-            f"Всего заказов: {orders}\n"
-            f"Завершённых заказов: {completed_orders}\n"
-        )
-        
-        buttons = [
-            tabs,
-            [InlineKeyboardButton("🛒 Купить VPN", callback_data="show_products")],
-            [InlineKeyboardButton("📱 Мои конфигурации", callback_data="show_configs")],
-            [InlineKeyboardButton("🏠 Главная", callback_data="tab_main")]
-        ]
-        
+    stats = await get_profile_stats(user.id)
+    
+    if not stats:
         await query.message.edit_text(
-            profile_text,
-            reply_markup=InlineKeyboardMarkup(buttons),
-            parse_mode="Markdown"
+            "Информация о вашем профиле не найдена. Пожалуйста, перезапустите бота командой /start",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🏠 Главная", callback_data="tab_main")
+            ]])
         )
+        return
+    
+    # Шапка с вкладками
+    tabs = [
+        InlineKeyboardButton("🏠 Главная", callback_data="tab_main"),
+        InlineKeyboardButton("🛒 Продукты", callback_data="tab_products"),
+        InlineKeyboardButton("🔑 Мои VPN", callback_data="tab_configs")
+    ]
+    
+    # Готовим сообщение с профилем
+    profile_text = (
+        f"👤 *Профиль пользователя*\n\n"
+        f"Имя: {user.first_name}" + (f" {user.last_name}" if user.last_name else "") + "\n"
+        f"ID: `{user.id}`\n"
+        f"Дата регистрации: {stats['registration_date'].strftime('%d.%m.%Y')}\n\n"
+        f"📊 *Статистика:*\n"
+        f"Активные VPN: {stats['active_configs']}\n"
+        f"Всего заказов: {stats['orders']}\n"
+        f"Завершённых заказов: {stats['completed_orders']}\n"
+    )
+    
+    buttons = [
+        tabs,
+        [InlineKeyboardButton("🛒 Купить VPN", callback_data="show_products")],
+        [InlineKeyboardButton("📱 Мои конфигурации", callback_data="show_configs")],
+        [InlineKeyboardButton("🏠 Главная", callback_data="tab_main")]
+    ]
+    
+    await query.message.edit_text(
+        profile_text,
+        reply_markup=InlineKeyboardMarkup(buttons),
+        parse_mode="Markdown"
+    )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send help message"""
@@ -971,21 +963,18 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         message = update.message
     
     # Получаем справочный текст из настроек
-    with app.app_context():
-        help_setting = Settings.query.filter_by(key='help_message').first()
-        if help_setting and help_setting.value:
-            help_text = help_setting.value
-        else:
-            help_text = (
-                "🔍 *Справка по использованию бота*\n\n"
-                "Этот бот поможет вам приобрести и управлять VPN-конфигурациями. Используйте интерактивные кнопки в меню бота для выполнения всех операций.\n\n"
-                "📌 *Основные функции:*\n\n"
-                "• *Купить VPN* - просмотр доступных тарифов и покупка доступа\n"
-                "• *Мои конфигурации* - управление вашими VPN-подключениями\n"
-                "• *Профиль* - информация о вашем аккаунте\n"
-                "• *Поддержка* - связь с администратором\n\n"
-                "По всем вопросам обращайтесь в поддержку через соответствующий раздел меню."
-            )
+    help_text = get_settings().get('help_message')
+    if not help_text:
+        help_text = (
+            "🔍 *Справка по использованию бота*\n\n"
+            "Этот бот поможет вам приобрести и управлять VPN-конфигурациями. Используйте интерактивные кнопки в меню бота для выполнения всех операций.\n\n"
+            "📌 *Основные функции:*\n\n"
+            "• *Купить VPN* - просмотр доступных тарифов и покупка доступа\n"
+            "• *Мои конфигурации* - управление вашими VPN-подключениями\n"
+            "• *Профиль* - информация о вашем аккаунте\n"
+            "• *Поддержка* - связь с администратором\n\n"
+            "По всем вопросам обращайтесь в поддержку через соответствующий раздел меню."
+        )
     
     # Шапка с вкладками
     tabs = [
@@ -1030,24 +1019,19 @@ async def support(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         message = update.message
     
     # Получаем контактные данные для поддержки из настроек
-    with app.app_context():
-        support_setting = Settings.query.filter_by(key='support_message').first()
-        admin_contact = Settings.query.filter_by(key='admin_contact').first()
+    settings = get_settings()
+    admin_username = settings.get('admin_contact', "@admin")
         
-        admin_username = "@admin"
-        if admin_contact and admin_contact.value:
-            admin_username = admin_contact.value
-            
-        if support_setting and support_setting.value:
-            support_text = support_setting.value.replace('{admin}', admin_username)
-        else:
-            support_text = (
-                "📞 *Поддержка*\n\n"
-                f"Если у вас возникли вопросы или проблемы с использованием VPN, "
-                f"пожалуйста, напишите администратору: {admin_username}\n\n"
-                f"Пожалуйста, опишите вашу проблему как можно более подробно, "
-                f"включая информацию о вашей подписке и устройстве."
-            )
+    if settings.get('support_message'):
+        support_text = settings.get('support_message').replace('{admin}', admin_username)
+    else:
+        support_text = (
+            "📞 *Поддержка*\n\n"
+            f"Если у вас возникли вопросы или проблемы с использованием VPN, "
+            f"пожалуйста, напишите администратору: {admin_username}\n\n"
+            f"Пожалуйста, опишите вашу проблему как можно более подробно, "
+            f"включая информацию о вашей подписке и устройстве."
+        )
     
     # Шапка с вкладками
     tabs = [
@@ -1087,55 +1071,82 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         message = update.message
     
     # Проверяем, является ли пользователь администратором
-    with app.app_context():
-        admin_id_setting = Settings.query.filter_by(key='admin_telegram_id').first()
-        is_admin = False
-        
-        if admin_id_setting and admin_id_setting.value:
-            try:
-                admin_id = int(admin_id_setting.value)
-                is_admin = (user.id == admin_id)
-            except ValueError:
-                logger.warning(f"Неверный формат ID администратора в настройках: {admin_id_setting.value}")
-        
-        if not is_admin:
-            if query:
-                await message.edit_text("⛔ У вас нет доступа к административной панели.")
-            else:
-                await message.reply_text("⛔ У вас нет доступа к административной панели.")
-            return
-        
-        # Показываем панель администратора
-        admin_text = (
-            "⚙️ *Панель администратора*\n\n"
-            "Здесь вы можете выполнять административные функции:\n\n"
-            "• Просмотр заказов\n"
-            "• Управление продуктами\n"
-            "• Управление пользователями\n"
-            "• Статистика\n\n"
-            "Выберите нужную функцию:"
-        )
-        
-        buttons = [
-            [InlineKeyboardButton("📋 Новые заказы", callback_data="admin_orders_new")],
-            [InlineKeyboardButton("👥 Пользователи", callback_data="admin_users")],
-            [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
-            [InlineKeyboardButton("🔄 Обновить конфиги", callback_data="admin_refresh_configs")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="tab_main")]
-        ]
-        
+    if not is_admin_user(user.id):
         if query:
-            await message.edit_text(
-                admin_text,
-                reply_markup=InlineKeyboardMarkup(buttons),
-                parse_mode="Markdown"
-            )
+            await message.edit_text("⛔ У вас нет доступа к административной панели.")
         else:
-            await message.reply_text(
-                admin_text,
-                reply_markup=InlineKeyboardMarkup(buttons),
-                parse_mode="Markdown"
-            )
+            await message.reply_text("⛔ У вас нет доступа к административной панели.")
+        return
+    
+    # Показываем панель администратора
+    admin_text = (
+        "⚙️ *Панель администратора*\n\n"
+        "Здесь вы можете выполнять административные функции:\n\n"
+        "• Просмотр заказов\n"
+        "• Управление продуктами\n"
+        "• Управление пользователями\n"
+        "• Статистика\n\n"
+        "Выберите нужную функцию:"
+    )
+    
+    buttons = [
+        [InlineKeyboardButton("📋 Новые заказы", callback_data="admin_orders_new")],
+        [InlineKeyboardButton("👥 Пользователи", callback_data="admin_users")],
+        [InlineKeyboardButton("📊 Статистика", callback_data="admin_stats")],
+        [InlineKeyboardButton("🔄 Обновить конфиги", callback_data="admin_refresh_configs")],
+        [InlineKeyboardButton("🏠 Главное меню", callback_data="tab_main")]
+    ]
+    
+    if query:
+        await message.edit_text(
+            admin_text,
+            reply_markup=InlineKeyboardMarkup(buttons),
+            parse_mode="Markdown"
+        )
+    else:
+        await message.reply_text(
+            admin_text,
+            reply_markup=InlineKeyboardMarkup(buttons),
+            parse_mode="Markdown"
+        )
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показать администратору счетчики ограничения частоты и фоновых задач"""
+    query = update.callback_query
+    await query.answer()
+    
+    if not is_admin_user(update.effective_user.id):
+        await query.message.edit_text("⛔ У вас нет доступа к административной панели.")
+        return
+    
+    flood = flood_control.snapshot()
+    text = "📊 *Статистика бота*\n\n🚦 *Ограничение частоты*\n"
+    for group, (rate, burst) in flood['limits'].items():
+        counts = flood['totals'][group]
+        text += f"  {group}: {rate:g}/с, до {burst:g} подряд — пропущено {counts['allowed']}, отброшено {counts['throttled']}\n"
+    
+    if flood['top_users']:
+        text += "\n*Чаще всего ограничены:*\n"
+        for user_id, count, last_at in flood['top_users']:
+            text += f"  `{user_id}` — {count} (последний раз {datetime.fromtimestamp(last_at).strftime('%d.%m %H:%M:%S')})\n"
+    else:
+        text += "\nОграниченных пользователей нет.\n"
+    
+    outbox = outbox_sender.stats
+    text += (
+        f"\n📨 *Уведомления:* отправлено {outbox['sent']}, повторов {outbox['retried']}, ошибок {outbox['failed']}\n"
+        f"🔳 *QR-коды:* нарисовано {qr_service.stats['rendered']}, "
+        f"по file\\_id {qr_service.stats['sent_by_file_id']}\n"
+    )
+    
+    await query.message.edit_text(
+        text,
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_stats")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data="admin_panel")]
+        ]),
+        parse_mode="Markdown"
+    )
 
 async def admin_confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Подтверждение заказа администратором и создание VPN-конфигурации"""
@@ -1145,26 +1156,18 @@ async def admin_confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE
     user = update.effective_user
     
     # Проверяем, является ли пользователь администратором
-    with app.app_context():
-        admin_id_setting = Settings.query.filter_by(key='admin_telegram_id').first()
-        is_admin = False
-        
-        if admin_id_setting and admin_id_setting.value:
-            try:
-                admin_id = int(admin_id_setting.value)
-                is_admin = (user.id == admin_id)
-            except ValueError:
-                pass
-        
-        if not is_admin:
-            await query.message.edit_text("⛔ У вас нет доступа к административной панели.")
-            return
-        
-        # Извлекаем ID заказа из callback_data
-        order_id = int(query.data.split('_')[3])
-        order = Order.query.get(order_id)
+    if not is_admin_user(user.id):
+        await query.message.edit_text("⛔ У вас нет доступа к административной панели.")
+        return
+    
+    # Извлекаем ID заказа из callback_data
+    order_id = int(query.data.split('_')[3])
+    
+    # Создаем конфигурацию (в реальном проекте здесь был бы вызов к XUI API)
+    try:
+        result = await run_db(bot_db.confirm_order, order_id)
         
-        if not order:
+        if result['status'] == 'not_found':
             await query.message.edit_text(
                 "❌ Заказ не найден. Возможно, он был удален.",
                 reply_markup=InlineKeyboardMarkup([[
@@ -1173,20 +1176,16 @@ async def admin_confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return
         
-        if order.status != 'awaiting_confirmation':
+        if result['status'] == 'wrong_status':
             await query.message.edit_text(
-                f"❌ Заказ #{order_id} уже имеет статус {order.status}.",
+                f"❌ Заказ #{order_id} уже имеет статус {result['order_status']}.",
                 reply_markup=InlineKeyboardMarkup([[
                     InlineKeyboardButton("⬅️ Назад", callback_data="admin_orders_new")
                 ]])
             )
             return
         
-        # Получаем информацию о пользователе и продукте
-        telegram_user = TelegramUser.query.get(order.user_id)
-        product = Product.query.get(order.product_id)
-        
-        if not telegram_user or not product:
+        if result['status'] == 'missing_data':
             await query.message.edit_text(
                 "❌ Не удалось найти информацию о пользователе или продукте.",
                 reply_markup=InlineKeyboardMarkup([[
@@ -1195,93 +1194,34 @@ async def admin_confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return
         
-        # Создаем срок действия VPN-конфигурации
-        valid_until = datetime.utcnow() + timedelta(days=product.duration_days)
+        # Очищаем кэш конфигураций пользователя для обновления данных
+        await clear_user_configs_cache(result['telegram_id'])
         
-        # Создаем конфигурацию (в реальном проекте здесь был бы вызов к XUI API)
-        try:
-            # Пытаемся получить IP-адрес и порт сервера из настроек
-            server_address = Settings.query.filter_by(key='vpn_server_address').first()
-            server_address = server_address.value if server_address else "127.0.0.1"
-            
-            server_port = Settings.query.filter_by(key='vpn_server_port').first()
-            server_port = int(server_port.value) if server_port else 443
-            
-            # Формируем имя конфигурации
-            config_name = f"{product.name} - {telegram_user.first_name}"
-            user_email = f"{telegram_user.telegram_id}@vpntgbot.com"
-            
-            # Генерируем конфигурацию с помощью встроенной утилиты
-            config_data = generate_config(
-                config_type=product.config_type,
-                user_email=user_email,
-                server_address=server_address,
-                server_port=server_port
-            )
-            
-            # Сохраняем сгенерированный config_data как строку
-            config_data_str = str(config_data)
-            
-            # Сохраняем конфигурацию в базе данных
-            vpn_config = VPNConfig(
-                user_id=telegram_user.id,
-                config_type=product.config_type,
-                name=config_name,
-                config_data=config_data_str,
-                valid_until=valid_until,
-                is_active=True
-            )
-            db.session.add(vpn_config)
-            
-            # Обновляем заказ
-            order.status = 'completed'
-            order.paid_at = datetime.utcnow()
-            order.config_id = vpn_config.id
-            
-            db.session.commit()
-            
-            # Очищаем кэш конфигураций пользователя для обновления данных
-            # Создаем задачу, чтобы не блокировать основной поток
-            loop = asyncio.get_event_loop()
-            loop.create_task(clear_user_configs_cache(telegram_user.telegram_id))
-            
-            # Отправляем уведомление пользователю о подтверждении заказа
-            confirmation_message = Settings.query.filter_by(key='payment_confirmation_message').first()
-            if confirmation_message and confirmation_message.value:
-                notification_text = confirmation_message.value
-            else:
-                notification_text = (
-                    "✅ *Ваш заказ подтвержден!*\n\n"
-                    f"Заказ #{order.id} был успешно подтвержден администратором. "
-                    f"Ваша VPN-конфигурация готова к использованию и будет действительна до {valid_until.strftime('%d.%m.%Y')}.\n\n"
-                    f"Вы можете найти вашу конфигурацию в разделе «Мои конфигурации»."
-                )
-            
-            # Здесь нужно отправить уведомление пользователю через бота
-            # В реальном проекте это делается через контекст и application
-            # На данном этапе просто сохраняем для будущих улучшений
-            
-            # Сообщаем администратору об успешном выполнении
-            await query.message.edit_text(
-                f"✅ Заказ #{order.id} успешно подтвержден!\n\n"
-                f"Создана VPN-конфигурация для пользователя {telegram_user.first_name}.\n"
-                f"Срок действия: до {valid_until.strftime('%d.%m.%Y')}",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📋 К списку заказов", callback_data="admin_orders_new")],
-                    [InlineKeyboardButton("⚙️ Панель администратора", callback_data="admin_panel")]
-                ])
-            )
-            
-        except Exception as e:
-            logger.error(f"Ошибка при создании VPN-конфигурации: {str(e)}")
-            await query.message.edit_text(
-                f"❌ Произошла ошибка при создании VPN-конфигурации: {str(e)}",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("⬅️ Назад", callback_data="admin_orders_new")
-                ]])
-            )
-            import traceback
-            logger.error(traceback.format_exc())
+        # Уведомление пользователю уже записано в outbox вместе с заказом
+        outbox_sender.wake()
+        
+        # Сообщаем администратору об успешном выполнении
+        valid_until = result['valid_until']
+        await query.message.edit_text(
+            f"✅ Заказ #{result['order_id']} успешно подтвержден!\n\n"
+            f"Создана VPN-конфигурация для пользователя {result['first_name']}.\n"
+            f"Срок действия: до {valid_until.strftime('%d.%m.%Y')}",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("📋 К списку заказов", callback_data="admin_orders_new")],
+                [InlineKeyboardButton("⚙️ Панель администратора", callback_data="admin_panel")]
+            ])
+        )
+        
+    except Exception as e:
+        logger.error(f"Ошибка при создании VPN-конфигурации: {str(e)}")
+        await query.message.edit_text(
+            f"❌ Произошла ошибка при создании VPN-конфигурации: {str(e)}",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("⬅️ Назад", callback_data="admin_orders_new")
+            ]])
+        )
+        import traceback
+        logger.error(traceback.format_exc())
 
 async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показать список заказов для администратора"""
@@ -1292,65 +1232,19 @@ async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     user = update.effective_user
     
     # Проверяем, является ли пользователь администратором
-    with app.app_context():
-        admin_id_setting = Settings.query.filter_by(key='admin_telegram_id').first()
-        is_admin = False
-        
-        if admin_id_setting and admin_id_setting.value:
-            try:
-                admin_id = int(admin_id_setting.value)
-                is_admin = (user.id == admin_id)
-            except ValueError:
-                pass
-        
-        if not is_admin:
-            if query:
-                await query.message.edit_text("⛔ У вас нет доступа к административной панели.")
-            else:
-                await update.message.reply_text("⛔ У вас нет доступа к административной панели.")
-            return
-        
-        # Получаем новые заказы
-        new_orders = Order.query.filter_by(status='awaiting_confirmation').all()
-        
-        if not new_orders:
-            text = "📋 *Новые заказы*\n\nНет новых заказов, ожидающих подтверждения."
-            buttons = [[InlineKeyboardButton("⬅️ Назад", callback_data="admin_panel")]]
-            
-            if query:
-                await query.message.edit_text(
-                    text,
-                    reply_markup=InlineKeyboardMarkup(buttons),
-                    parse_mode="Markdown"
-                )
-            else:
-                await update.message.reply_text(
-                    text,
-                    reply_markup=InlineKeyboardMarkup(buttons),
-                    parse_mode="Markdown"
-                )
-            return
-        
-        text = "📋 *Новые заказы, ожидающие подтверждения*\n\n"
-        buttons = []
-        
-        for order in new_orders:
-            user = TelegramUser.query.get(order.user_id)
-            product = Product.query.get(order.product_id)
-            
-            if user and product:
-                text += f"🔹 *Заказ #{order.id}*\n"
-                text += f"  ├ Пользователь: {user.first_name} (@{user.username})\n"
-                text += f"  ├ Продукт: {product.name}\n"
-                text += f"  ├ Сумма: {order.amount} руб.\n"
-                text += f"  └ Дата: {order.created_at.strftime('%d.%m.%Y %H:%M')}\n\n"
-                
-                buttons.append([InlineKeyboardButton(
-                    f"Подтвердить заказ #{order.id}",
-                    callback_data=f"admin_confirm_order_{order.id}"
-                )])
-        
-        buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_panel")])
+    if not is_admin_user(user.id):
+        if query:
+            await query.message.edit_text("⛔ У вас нет доступа к административной панели.")
+        else:
+            await update.message.reply_text("⛔ У вас нет доступа к административной панели.")
+        return
+    
+    # Получаем новые заказы
+    new_orders = await run_db(bot_db.get_orders_awaiting_confirmation)
+    
+    if not new_orders:
+        text = "📋 *Новые заказы*\n\nНет новых заказов, ожидающих подтверждения."
+        buttons = [[InlineKeyboardButton("⬅️ Назад", callback_data="admin_panel")]]
         
         if query:
             await query.message.edit_text(
@@ -1364,6 +1258,37 @@ async def admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                 reply_markup=InlineKeyboardMarkup(buttons),
                 parse_mode="Markdown"
             )
+        return
+    
+    text = "📋 *Новые заказы, ожидающие подтверждения*\n\n"
+    buttons = []
+    
+    for order, user, product in new_orders:
+        text += f"🔹 *Заказ #{order.id}*\n"
+        text += f"  ├ Пользователь: {user.first_name} (@{user.username})\n"
+        text += f"  ├ Продукт: {product.name}\n"
+        text += f"  ├ Сумма: {order.amount} руб.\n"
+        text += f"  └ Дата: {order.created_at.strftime('%d.%m.%Y %H:%M')}\n\n"
+        
+        buttons.append([InlineKeyboardButton(
+            f"Подтвердить заказ #{order.id}",
+            callback_data=f"admin_confirm_order_{order.id}"
+        )])
+    
+    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="admin_panel")])
+    
+    if query:
+        await query.message.edit_text(
+            text,
+            reply_markup=InlineKeyboardMarkup(buttons),
+            parse_mode="Markdown"
+        )
+    else:
+        await update.message.reply_text(
+            text,
+            reply_markup=InlineKeyboardMarkup(buttons),
+            parse_mode="Markdown"
+        )
 
 async def handle_text_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle text button presses from the main menu"""
@@ -1413,9 +1338,23 @@ def setup_bot():
                 logger.info("Initializing Telegram application...")
                 # Build the application
                 logger.info("Создание объекта Application...")
-                application = Application.builder().token(token).build()
+                # Обновления разных чатов обрабатываются параллельно, одного чата - по порядку
+                builder = Application.builder().token(token).concurrent_updates(
+                    ChatOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES)
+                )
+                if TELEGRAM_API_BASE_URL:
+                    builder = builder.base_url(TELEGRAM_API_BASE_URL)
+                if BOT_MODE == 'webhook':
+                    # Обновления приходят через Flask, поэтому Updater не нужен,
+                    # а очередь обновлений ограничена по размеру
+                    from bot_webhook import WEBHOOK_QUEUE_SIZE
+                    builder = builder.updater(None).update_queue(asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE))
+                application = builder.build()
                 logger.info("Application создан успешно")
                 
+                # Проверка частоты запросов раньше всех обработчиков (группа -1)
+                flood_control.register(application)
+                
                 logger.info("Регистрация основных обработчиков команд...")
                 # Add handlers
                 application.add_handler(CommandHandler("start", start))
@@ -1483,26 +1422,51 @@ def setup_bot():
                 # Admin handlers
                 application.add_handler(CallbackQueryHandler(admin_panel, pattern="^admin_panel$"))
                 application.add_handler(CallbackQueryHandler(admin_orders, pattern="^admin_orders_new$"))
+                application.add_handler(CallbackQueryHandler(admin_stats, pattern="^admin_stats$"))
                 application.add_handler(CallbackQueryHandler(admin_confirm_order, pattern="^admin_confirm_order_"))
                 
                 # Handle text buttons
                 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_buttons))
                 
-                logger.info("Starting Telegram bot polling...")
+                # Время выполнения каждого обработчика для /metrics
+                metrics.instrument_application(application)
+                
+                logger.info(f"Starting Telegram bot in {BOT_MODE} mode...")
                 # Start the bot asynchronously with retry logic
                 try:
                     logger.info("Initializing bot application...")
                     await application.initialize()
+                    bot_cache.start_purger()
+                    # Загружаем снимок настроек заранее, вне event loop
+                    await run_db(get_settings)
+                    subscribe_cache_invalidation(cache_bus.get_bus())
                     logger.info("Starting bot application...")
                     await application.start()
-                    logger.info("Starting updater polling...")
-                    await application.updater.start_polling(
-                        allowed_updates=Update.ALL_TYPES,
-                        read_timeout=30,
-                        connect_timeout=30,
-                        pool_timeout=30
-                    )
-                    logger.info("Telegram bot polling started successfully")
+                    expiry_sweeper.start(xui_client)
+                    broadcast_engine.start(application.bot)
+                    outbox_sender.start(application.bot)
+                    if BOT_MODE == 'webhook':
+                        from bot_webhook import ingress, WEBHOOK_SECRET
+                        if not WEBHOOK_SECRET:
+                            logger.warning("TELEGRAM_WEBHOOK_SECRET не задан, webhook принимает запросы без проверки")
+                        if TELEGRAM_WEBHOOK_URL:
+                            logger.info(f"Регистрация webhook: {TELEGRAM_WEBHOOK_URL}")
+                            await application.bot.set_webhook(
+                                url=TELEGRAM_WEBHOOK_URL,
+                                secret_token=WEBHOOK_SECRET,
+                                allowed_updates=Update.ALL_TYPES
+                            )
+                        ingress.attach(application, asyncio.get_running_loop())
+                        logger.info("Telegram bot webhook ingestion started successfully")
+                    else:
+                        logger.info("Starting updater polling...")
+                        await application.updater.start_polling(
+                            allowed_updates=Update.ALL_TYPES,
+                            read_timeout=30,
+                            connect_timeout=30,
+                            pool_timeout=30
+                        )
+                        logger.info("Telegram bot polling started successfully")
                 except telegram.error.TimedOut:
                     logger.error("Timed out connecting to Telegram API. Possible network issues or invalid token.")
                     # Return gracefully to allow for restart
@@ -1530,11 +1494,25 @@ def setup_bot():
                 logger.info("Shutting down bot...")
                 try:
                     if 'application' in locals():
-                        await application.updater.stop()
+                        if application.updater and application.updater.running:
+                            await application.updater.stop()
+                        if BOT_MODE == 'webhook':
+                            from bot_webhook import ingress
+                            ingress.detach()
                         await application.stop()
                         await application.shutdown()
                 except Exception as e:
                     logger.error(f"Error during bot shutdown: {e}")
+                bot_cache.stop_purger()
+                await expiry_sweeper.stop()
+                await broadcast_engine.stop()
+                await outbox_sender.stop()
+                qr_service.shutdown()
+                try:
+                    await xui_client.aclose()
+                except Exception as e:
+                    logger.error(f"Error closing XUI client: {e}")
+                bot_db.shutdown()
         
         # Запускаем бота в отдельном потоке с новым event loop
         def run_bot_thread():
@@ -1560,7 +1538,6 @@ def setup_bot():
                 logger.error(f"Bot thread error details:\n{traceback.format_exc()}")
         
         import threading
-        import asyncio
         logger.info("Creating bot thread...")
         bot_thread = threading.Thread(target=run_bot_thread, name="TelegramBotThread")
         bot_thread.daemon = True  # Завершить поток, когда завершится основной процесс
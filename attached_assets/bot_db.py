@@ -0,0 +1,366 @@
+"""
+Data-access layer for the Telegram bot
+
+Все обращения бота к базе данных выполняются в отдельном пуле потоков,
+чтобы медленный запрос одного пользователя не блокировал event loop бота
+и обработку обновлений остальных пользователей.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+from app import app, db
+from models import TelegramUser, Product, Order, VPNConfig, PaymentMethod
+from settings_snapshot import get_settings
+from vpn_utils import generate_config, format_config_for_user
+import stats_rollup
+import notification_outbox
+
+logger = logging.getLogger(__name__)
+
+# Размер пула не должен превышать pool_size + max_overflow движка SQLAlchemy
+DB_POOL_SIZE = int(os.environ.get('BOT_DB_POOL_SIZE', '5'))
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='bot-db')
+
+
+def _call_in_app_context(func, args, kwargs):
+    """Выполнить функцию в собственном контексте приложения и сессии"""
+    with app.app_context():
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Run a synchronous database function in the bot DB thread pool
+
+    Every call gets its own application context and scoped session, which is
+    removed when the call finishes. Returned ORM objects are detached, so
+    functions must load every attribute the caller needs before returning.
+    The caller's contextvars are copied into the worker thread, so queries
+    are accounted to the handler that issued them.
+
+    Args:
+        func (callable): Function performing the database work
+        *args: Positional arguments for func
+        **kwargs: Keyword arguments for func
+
+    Returns:
+        Whatever func returns
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _executor,
+        functools.partial(context.run, _call_in_app_context, func, args, kwargs)
+    )
+
+
+def shutdown():
+    """Остановить пул потоков базы данных"""
+    _executor.shutdown(wait=False)
+
+
+# ---------------------------------------------------------------------------
+# Пользователи
+# ---------------------------------------------------------------------------
+
+def is_user_blocked(telegram_id):
+    """Проверить, заблокирован ли пользователь"""
+    telegram_user = TelegramUser.query.filter_by(telegram_id=telegram_id).first()
+    return bool(telegram_user and telegram_user.is_blocked)
+
+
+def get_user(telegram_id):
+    """Получить пользователя по telegram_id"""
+    return TelegramUser.query.filter_by(telegram_id=telegram_id).first()
+
+
+def get_or_create_user(telegram_id, username=None, first_name=None, last_name=None):
+    """
+    Get a Telegram user, registering them on first contact
+
+    Returns:
+        tuple: (TelegramUser, created)
+    """
+    telegram_user = TelegramUser.query.filter_by(telegram_id=telegram_id).first()
+    if telegram_user:
+        return telegram_user, False
+
+    telegram_user = TelegramUser(
+        telegram_id=telegram_id,
+        username=username,
+        first_name=first_name,
+        last_name=last_name
+    )
+    db.session.add(telegram_user)
+    stats_rollup.bump(stats_rollup.USERS)
+    db.session.commit()
+    db.session.refresh(telegram_user)
+    return telegram_user, True
+
+
+# ---------------------------------------------------------------------------
+# Продукты и способы оплаты
+# ---------------------------------------------------------------------------
+
+def get_active_products():
+    """Получить список активных продуктов"""
+    return Product.query.filter_by(is_active=True).all()
+
+
+def get_product(product_id):
+    """Получить продукт по ID"""
+    return Product.query.get(product_id)
+
+
+def get_active_payment_methods():
+    """Получить список активных способов оплаты"""
+    return PaymentMethod.query.filter_by(is_active=True).all()
+
+
+# ---------------------------------------------------------------------------
+# Заказы
+# ---------------------------------------------------------------------------
+
+def create_order(telegram_id, username, first_name, last_name, product_id, amount, payment_method_id):
+    """
+    Create a pending order for a user
+
+    Returns:
+        dict: Order ID and amount plus payment method name and instructions
+    """
+    payment_method = PaymentMethod.query.get(payment_method_id)
+    telegram_user, _ = get_or_create_user(telegram_id, username, first_name, last_name)
+
+    order = Order(
+        user_id=telegram_user.id,
+        product_id=product_id,
+        amount=amount,
+        status='pending'
+    )
+    db.session.add(order)
+    db.session.commit()
+
+    # После commit атрибуты истекли - читаем их, пока сессия еще открыта
+    return {
+        'order_id': order.id,
+        'amount': order.amount,
+        'payment_method_name': payment_method.name if payment_method else None,
+        'payment_instructions': payment_method.instructions if payment_method else None,
+    }
+
+
+def mark_order_awaiting_confirmation(order_id):
+    """
+    Mark an order as paid by the user and awaiting admin confirmation
+
+    Returns:
+        bool: False if the order does not exist
+    """
+    order = Order.query.get(order_id)
+    if not order:
+        return False
+
+    if order.status != 'awaiting_confirmation':
+        order.status = 'awaiting_confirmation'
+        # Уведомление администратору коммитится вместе со статусом
+        notification_outbox.enqueue_admin_order(order)
+    db.session.commit()
+    return True
+
+
+def cancel_pending_order(order_id):
+    """Отменить заказ, если он еще не оплачен"""
+    order = Order.query.get(order_id)
+    if order and order.status == 'pending':
+        order.status = 'cancelled'
+        stats_rollup.bump(stats_rollup.ORDERS_CANCELLED, when=order.created_at)
+        db.session.commit()
+        return True
+    return False
+
+
+def get_orders_awaiting_confirmation():
+    """
+    Get orders awaiting admin confirmation with their users and products
+
+    Returns:
+        list: (Order, TelegramUser, Product) tuples
+    """
+    # Один запрос вместо двух дополнительных на каждый заказ
+    rows = db.session.query(Order, TelegramUser, Product).join(
+        TelegramUser, Order.user_id == TelegramUser.id
+    ).join(
+        Product, Order.product_id == Product.id
+    ).filter(
+        Order.status == 'awaiting_confirmation'
+    ).order_by(Order.created_at, Order.id).all()
+    return [tuple(row) for row in rows]
+
+
+def confirm_order(order_id):
+    """
+    Confirm an order and create its VPN configuration
+
+    Returns:
+        dict: Outcome with a 'status' key - 'not_found', 'wrong_status',
+            'missing_data' or 'completed' - and the data needed for the reply
+    """
+    order = Order.query.get(order_id)
+    if not order:
+        return {'status': 'not_found'}
+
+    if order.status != 'awaiting_confirmation':
+        return {'status': 'wrong_status', 'order_status': order.status}
+
+    telegram_user = TelegramUser.query.get(order.user_id)
+    product = Product.query.get(order.product_id)
+    if not telegram_user or not product:
+        return {'status': 'missing_data'}
+
+    # Создаем срок действия VPN-конфигурации
+    valid_until = datetime.utcnow() + timedelta(days=product.duration_days)
+
+    settings = get_settings()
+    server_address = settings.vpn_server_address
+    server_port = settings.vpn_server_port
+
+    # Формируем имя конфигурации
+    config_name = f"{product.name} - {telegram_user.first_name}"
+    user_email = f"{telegram_user.telegram_id}@vpntgbot.com"
+
+    # Генерируем конфигурацию с помощью встроенной утилиты
+    config_data = generate_config(
+        config_type=product.config_type,
+        user_email=user_email,
+        server_address=server_address,
+        server_port=server_port
+    )
+
+    vpn_config = VPNConfig(
+        user_id=telegram_user.id,
+        config_type=product.config_type,
+        name=config_name,
+        config_data=json.dumps(config_data),
+        valid_until=valid_until,
+        is_active=True
+    )
+    db.session.add(vpn_config)
+    db.session.flush()
+
+    order.status = 'completed'
+    order.paid_at = datetime.utcnow()
+    order.config_id = vpn_config.id
+
+    # Уведомление пользователю уходит из outbox после коммита
+    notification_outbox.enqueue_order_completed(order, telegram_user.telegram_id, vpn_config.id, valid_until)
+
+    stats_rollup.bump(stats_rollup.ORDERS_COMPLETED, amount=order.amount, when=order.paid_at)
+    stats_rollup.bump(stats_rollup.CONFIGS_CREATED, when=order.paid_at)
+    stats_rollup.bump(stats_rollup.CONFIGS_ACTIVE)
+    db.session.commit()
+
+    return {
+        'status': 'completed',
+        'order_id': order.id,
+        'telegram_id': telegram_user.telegram_id,
+        'first_name': telegram_user.first_name,
+        'valid_until': valid_until,
+    }
+
+
+# ---------------------------------------------------------------------------
+# VPN-конфигурации
+# ---------------------------------------------------------------------------
+
+def get_user_active_configs(telegram_id):
+    """
+    Get a user's active VPN configurations
+
+    Returns:
+        list: VPNConfig objects, or None if the user is not registered
+    """
+    telegram_user = TelegramUser.query.filter_by(telegram_id=telegram_id).first()
+    if not telegram_user:
+        return None
+
+    return VPNConfig.query.filter_by(
+        user_id=telegram_user.id,
+        is_active=True
+    ).all()
+
+
+def get_user_config(telegram_id, config_id, formatted=False):
+    """
+    Get a configuration owned by the user
+
+    Args:
+        telegram_id (int): Telegram ID of the requesting user
+        config_id (int): ID of the configuration
+        formatted (bool): Also build the client import string
+
+    Returns:
+        tuple: (error, VPNConfig, formatted_config) where error is None,
+            'not_found' or 'forbidden'
+    """
+    config = VPNConfig.query.get(config_id)
+    if not config or not config.is_active:
+        return 'not_found', None, None
+
+    telegram_user = TelegramUser.query.filter_by(telegram_id=telegram_id).first()
+    if not telegram_user or config.user_id != telegram_user.id:
+        return 'forbidden', None, None
+
+    formatted_config = format_config_for_user(config) if formatted else None
+    return None, config, formatted_config
+
+
+def get_profile_stats(telegram_id):
+    """
+    Get profile data and statistics for a user
+
+    The user row and all counters are read in a single query.
+
+    Returns:
+        dict: Profile statistics, or None if the user is not registered
+    """
+    active_configs = select(func.count(VPNConfig.id)).where(
+        VPNConfig.user_id == TelegramUser.id,
+        VPNConfig.is_active == True
+    ).scalar_subquery()
+    orders = select(func.count(Order.id)).where(
+        Order.user_id == TelegramUser.id
+    ).scalar_subquery()
+    completed_orders = select(func.count(Order.id)).where(
+        Order.user_id == TelegramUser.id,
+        Order.status == 'completed'
+    ).scalar_subquery()
+
+    row = db.session.execute(
+        select(TelegramUser.registration_date, active_configs, orders, completed_orders)
+        .where(TelegramUser.telegram_id == telegram_id)
+    ).first()
+    if row is None:
+        return None
+
+    registration_date, active_configs, orders, completed_orders = row
+    return {
+        'registration_date': registration_date,
+        'active_configs': active_configs,
+        'orders': orders,
+        'completed_orders': completed_orders,
+    }
@@ -0,0 +1,193 @@
+"""
+Webhook ingestion for the Telegram bot
+
+В режиме BOT_MODE=webhook обновления приходят HTTP-запросами от Telegram
+на маршрут Flask и передаются в очередь обновлений Application бота.
+Для локальной проверки достаточно отправить POST с записанным JSON Update
+(см. replay_updates.py) - обращения к Telegram для этого не нужны.
+"""
+import asyncio
+import concurrent.futures
+import hmac
+import logging
+import os
+
+from flask import request, jsonify
+
+from app import app
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = os.environ.get('TELEGRAM_WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET')
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('TELEGRAM_WEBHOOK_QUEUE_SIZE', '1000'))
+# Обновлений, принятых и еще не обработанных до конца (в очереди и в обработке)
+WEBHOOK_MAX_IN_FLIGHT = int(os.environ.get('TELEGRAM_WEBHOOK_MAX_IN_FLIGHT', str(WEBHOOK_QUEUE_SIZE)))
+# Сколько ждать постановки в очередь в event loop бота, секунд
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.environ.get('TELEGRAM_WEBHOOK_ENQUEUE_TIMEOUT', '5'))
+
+
+class WebhookIngress:
+    """
+    Bridge between the Flask webhook route and the bot Application
+
+    submit() bounds the updates in flight - accepted but not yet fully
+    processed, whether still queued or already running - and rejects new
+    ones beyond the limit, so Telegram redelivers them later instead of the
+    process buffering without limit. The update is put into the queue on
+    the bot loop before the HTTP response is returned, so an accepted
+    update is never dropped afterwards.
+    """
+
+    def __init__(self, secret_token=None, max_in_flight=WEBHOOK_MAX_IN_FLIGHT,
+                 enqueue_timeout=WEBHOOK_ENQUEUE_TIMEOUT):
+        """
+        Initialize the ingress
+
+        Args:
+            secret_token (str, optional): Expected X-Telegram-Bot-Api-Secret-Token
+                value. If None, the header is not checked.
+            max_in_flight (int): Maximum number of accepted, unfinished updates
+            enqueue_timeout (float): Seconds to wait for the bot loop
+        """
+        self.secret_token = secret_token
+        self.max_in_flight = max_in_flight
+        self.enqueue_timeout = enqueue_timeout
+        self.application = None
+        self.loop = None
+        self._accepted_total = 0  # Изменяется только в event loop бота
+        self.stats = {
+            'accepted': 0,
+            'rejected_secret': 0,
+            'rejected_full': 0,
+            'rejected_invalid': 0,
+            'rejected_timeout': 0,
+        }
+
+    def attach(self, application, loop):
+        """Начать прием обновлений для Application, работающего в loop"""
+        self.application = application
+        self.loop = loop
+        # Счетчик обработанных обновлений у нового Application начинается с нуля
+        self._accepted_total = 0
+        logger.info(f"Webhook-прием обновлений подключен к {WEBHOOK_PATH}")
+
+    def detach(self):
+        """Прекратить прием обновлений"""
+        self.application = None
+        self.loop = None
+
+    @property
+    def is_ready(self):
+        return self.application is not None and self.loop is not None
+
+    @property
+    def in_flight(self):
+        """
+        Updates accepted and not yet fully processed
+
+        Uses the processed counter of ChatOrderedUpdateProcessor; without it
+        only queued updates are known.
+        """
+        return self._in_flight(self.application)
+
+    def _in_flight(self, application):
+        if application is None:
+            return 0
+        processed = getattr(application.update_processor, 'processed', None)
+        if processed is None:
+            return application.update_queue.qsize()
+        return self._accepted_total - processed
+
+    def check_secret(self, header_value):
+        """
+        Validate the secret token header
+
+        Returns:
+            bool: True if no secret is configured or the header matches
+        """
+        if not self.secret_token:
+            return True
+        if not header_value or not hmac.compare_digest(header_value, self.secret_token):
+            self.stats['rejected_secret'] += 1
+            return False
+        return True
+
+    def submit(self, data):
+        """
+        Queue an update received over HTTP
+
+        Args:
+            data (dict): Update JSON as sent by Telegram
+
+        Returns:
+            str: 'accepted', 'not_ready', 'queue_full', 'timeout' or 'invalid'
+        """
+        application, loop = self.application, self.loop
+        if application is None or loop is None:
+            return 'not_ready'
+
+        from telegram import Update
+        try:
+            update = Update.de_json(data, application.bot)
+        except Exception as e:
+            logger.warning(f"Не удалось разобрать обновление из webhook: {e}")
+            update = None
+        if update is None:
+            self.stats['rejected_invalid'] += 1
+            return 'invalid'
+
+        # Постановка в очередь завершается до ответа Telegram: если места нет,
+        # он получит 503 и доставит обновление повторно
+        future = asyncio.run_coroutine_threadsafe(self._enqueue(application, update), loop)
+        try:
+            accepted = future.result(self.enqueue_timeout)
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                self.stats['rejected_timeout'] += 1
+                return 'timeout'
+            # Успело выполниться одновременно с таймаутом
+            accepted = future.result()
+
+        if not accepted:
+            self.stats['rejected_full'] += 1
+            return 'queue_full'
+        self.stats['accepted'] += 1
+        return 'accepted'
+
+    async def _enqueue(self, application, update):
+        # Выполняется в event loop бота, поэтому проверка и постановка атомарны
+        if self._in_flight(application) >= self.max_in_flight:
+            return False
+        try:
+            application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        self._accepted_total += 1
+        return True
+
+
+ingress = WebhookIngress(secret_token=WEBHOOK_SECRET)
+
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    """Прием обновлений Telegram в режиме webhook"""
+    if not ingress.check_secret(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+        return jsonify({'ok': False, 'error': 'invalid secret token'}), 403
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'ok': False, 'error': 'invalid update'}), 400
+
+    status = ingress.submit(data)
+    if status == 'accepted':
+        return jsonify({'ok': True})
+    if status == 'invalid':
+        return jsonify({'ok': False, 'error': 'invalid update'}), 400
+
+    # Бот не запущен, занят или очередь заполнена - Telegram повторит доставку позже
+    response = jsonify({'ok': False, 'error': status})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
@@ -0,0 +1,244 @@
+"""
+Rate-limited broadcast engine
+
+Админ-панель создает запись Broadcast, а движок в event loop бота находит
+ее, перебирает получателей сегмента по возрастанию TelegramUser.id и
+отправляет сообщения с общим и по-чатовым лимитом. Курсор и счетчики
+сохраняются после каждой пачки, поэтому после перезапуска рассылка
+продолжается с места остановки (повторно может уйти не больше одной пачки).
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from app import db
+from models import Broadcast, TelegramUser, VPNConfig
+from bot_db import run_db
+from rate_limit import KeyedRateLimiter
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))
+BROADCAST_PER_CHAT_RATE = float(os.environ.get('BROADCAST_PER_CHAT_RATE', '1'))
+BROADCAST_BATCH_SIZE = int(os.environ.get('BROADCAST_BATCH_SIZE', '100'))
+BROADCAST_POLL_INTERVAL = float(os.environ.get('BROADCAST_POLL_INTERVAL', '5'))
+BROADCAST_MAX_ATTEMPTS = int(os.environ.get('BROADCAST_MAX_ATTEMPTS', '3'))
+
+SEGMENTS = {
+    'all': 'Все пользователи',
+    'active': 'С активной подпиской',
+    'expiring': 'Подписка скоро истекает',
+}
+
+
+def segment_query(segment, reference_time, expiring_days=None):
+    """
+    Build the recipient query for a segment
+
+    Blocked users are always excluded.
+
+    Args:
+        segment (str): 'all', 'active' or 'expiring'
+        reference_time (datetime): Time the segment is evaluated at; the
+            broadcast's creation time, so a resumed run sees the same segment
+        expiring_days (int, optional): Window for 'expiring'
+
+    Returns:
+        Query: Query of (TelegramUser.id, TelegramUser.telegram_id)
+    """
+    query = db.session.query(TelegramUser.id, TelegramUser.telegram_id).filter(
+        TelegramUser.is_blocked == False
+    )
+
+    if segment in ('active', 'expiring'):
+        conditions = [
+            VPNConfig.user_id == TelegramUser.id,
+            VPNConfig.is_active == True,
+            VPNConfig.valid_until > reference_time,
+        ]
+        if segment == 'expiring':
+            conditions.append(VPNConfig.valid_until <= reference_time + timedelta(days=expiring_days or 3))
+        query = query.filter(db.session.query(VPNConfig.id).filter(*conditions).exists())
+    elif segment != 'all':
+        raise ValueError(f"Unknown broadcast segment: {segment}")
+
+    return query
+
+
+def create_broadcast(text, segment, expiring_days=None, parse_mode=None):
+    """
+    Create a pending broadcast; the bot picks it up on its next poll
+
+    Returns:
+        Broadcast: The new broadcast with total recipients counted
+    """
+    broadcast = Broadcast(
+        text=text,
+        segment=segment,
+        expiring_days=expiring_days if segment == 'expiring' else None,
+        parse_mode=parse_mode,
+        status='pending',
+        created_at=datetime.utcnow()
+    )
+    broadcast.total = segment_query(segment, broadcast.created_at, expiring_days).count()
+    db.session.add(broadcast)
+    db.session.commit()
+    return broadcast
+
+
+# -- функции для run_db (выполняются в пуле потоков бота) ----------------------
+
+def _next_runnable():
+    broadcast = Broadcast.query.filter(
+        Broadcast.status.in_(['running', 'pending'])
+    ).order_by(Broadcast.id).first()
+    if broadcast is None:
+        return None
+    if broadcast.status == 'pending':
+        broadcast.status = 'running'
+        broadcast.started_at = datetime.utcnow()
+        db.session.commit()
+    return {
+        'id': broadcast.id,
+        'text': broadcast.text,
+        'parse_mode': broadcast.parse_mode,
+        'segment': broadcast.segment,
+        'expiring_days': broadcast.expiring_days,
+        'created_at': broadcast.created_at,
+        'cursor_user_id': broadcast.cursor_user_id,
+    }
+
+
+def _recipients_after(job, cursor_user_id, limit):
+    return [
+        (row.id, row.telegram_id)
+        for row in segment_query(job['segment'], job['created_at'], job['expiring_days'])
+        .filter(TelegramUser.id > cursor_user_id)
+        .order_by(TelegramUser.id)
+        .limit(limit)
+    ]
+
+
+def _save_progress(broadcast_id, cursor_user_id, sent, failed, blocked, last_error, finished):
+    """
+    Persist a processed batch
+
+    Returns:
+        str: Current status, so the engine notices pause/cancel from the panel
+    """
+    broadcast = Broadcast.query.get(broadcast_id)
+    if broadcast is None:
+        return 'cancelled'
+    broadcast.cursor_user_id = cursor_user_id
+    broadcast.sent += sent
+    broadcast.failed += failed
+    broadcast.blocked += blocked
+    if last_error:
+        broadcast.last_error = last_error
+    if finished and broadcast.status == 'running':
+        broadcast.status = 'completed'
+        broadcast.finished_at = datetime.utcnow()
+    db.session.commit()
+    return broadcast.status
+
+
+class BroadcastEngine:
+    """Sends pending broadcasts from the bot's event loop"""
+
+    def __init__(self, global_rate=BROADCAST_RATE, per_chat_rate=BROADCAST_PER_CHAT_RATE,
+                 batch_size=BROADCAST_BATCH_SIZE, poll_interval=BROADCAST_POLL_INTERVAL):
+        self.limiter = KeyedRateLimiter(global_rate, per_chat_rate)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.bot = None
+        self._task = None
+
+    async def _send(self, chat_id, job):
+        """
+        Send one message, waiting out flood limits
+
+        Returns:
+            tuple: (outcome, error) - outcome is 'sent', 'blocked' or 'failed'
+        """
+        from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+        attempts = 0
+        error = None
+        while attempts < BROADCAST_MAX_ATTEMPTS:
+            await self.limiter.acquire(chat_id)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=job['text'], parse_mode=job['parse_mode'])
+                return 'sent', None
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logger.warning(f"Telegram ограничил рассылку, пауза {retry_after} с")
+                # Ограничение глобальное - тормозим все отправки, попытка не засчитывается
+                self.limiter.global_bucket.pause(retry_after)
+            except Forbidden:
+                return 'blocked', None
+            except BadRequest as e:
+                return 'failed', str(e)
+            except (TimedOut, NetworkError) as e:
+                attempts += 1
+                error = str(e)
+                await asyncio.sleep(2 ** attempts)
+            except Exception as e:
+                return 'failed', str(e)
+
+        return 'failed', error
+
+    async def _run(self, job):
+        logger.info(f"Рассылка {job['id']} ({job['segment']}): продолжение после пользователя {job['cursor_user_id']}")
+        cursor = job['cursor_user_id']
+
+        while True:
+            recipients = await run_db(_recipients_after, job, cursor, self.batch_size)
+            counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+            last_error = None
+            for user_id, chat_id in recipients:
+                outcome, error = await self._send(chat_id, job)
+                counts[outcome] += 1
+                last_error = error or last_error
+                cursor = user_id
+
+            finished = len(recipients) < self.batch_size
+            status = await run_db(
+                _save_progress, job['id'], cursor,
+                counts['sent'], counts['failed'], counts['blocked'], last_error, finished
+            )
+            if finished or status != 'running':
+                logger.info(f"Рассылка {job['id']}: статус {status}")
+                return
+
+    async def _run_forever(self):
+        while True:
+            try:
+                job = await run_db(_next_runnable)
+                if job is not None:
+                    await self._run(job)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка движка рассылок: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self, bot):
+        """Начать обработку рассылок в текущем event loop"""
+        self.bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run_forever())
+
+    async def stop(self):
+        """Остановить обработку; незавершенная рассылка продолжится после запуска"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+broadcast_engine = BroadcastEngine()
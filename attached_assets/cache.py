@@ -0,0 +1,206 @@
+"""
+Bounded in-memory cache with per-namespace TTLs and LRU eviction
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe cache shared by several namespaces
+
+    Entries are keyed by (namespace, key). The total number of entries is
+    capped by max_size; when the cap is reached the least recently used entry
+    is evicted. Each namespace may have its own TTL, and expired entries are
+    removed lazily on access and periodically by a background purger thread.
+    """
+
+    def __init__(self, max_size=10000, default_ttl=300, ttls=None, purge_interval=60):
+        """
+        Initialize the cache
+
+        Args:
+            max_size (int): Maximum number of entries across all namespaces
+            default_ttl (float): TTL in seconds for namespaces without their own
+            ttls (dict, optional): Mapping of namespace to TTL in seconds
+            purge_interval (float): Seconds between background purges
+        """
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.ttls = dict(ttls or {})
+        self.purge_interval = purge_interval
+
+        self._data = OrderedDict()  # {(namespace, key): (value, expires_at)}
+        self._lock = threading.RLock()
+        self._stats = {}  # {namespace: {'hits': ..., 'misses': ..., ...}}
+
+        self._purger = None
+        self._stop_event = threading.Event()
+
+    def _ns_stats(self, namespace):
+        stats = self._stats.get(namespace)
+        if stats is None:
+            stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+            self._stats[namespace] = stats
+        return stats
+
+    def ttl_for(self, namespace):
+        """Вернуть TTL для пространства имен"""
+        return self.ttls.get(namespace, self.default_ttl)
+
+    def get(self, namespace, key, default=None):
+        """
+        Get a value from the cache
+
+        Args:
+            namespace (str): Cache namespace
+            key: Key inside the namespace
+            default: Value returned on a miss
+
+        Returns:
+            The cached value, or default if missing or expired
+        """
+        full_key = (namespace, key)
+        now = time.monotonic()
+
+        with self._lock:
+            stats = self._ns_stats(namespace)
+            entry = self._data.get(full_key, _MISSING)
+
+            if entry is _MISSING:
+                stats['misses'] += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at <= now:
+                del self._data[full_key]
+                stats['expirations'] += 1
+                stats['misses'] += 1
+                return default
+
+            self._data.move_to_end(full_key)
+            stats['hits'] += 1
+            return value
+
+    def set(self, namespace, key, value, ttl=None):
+        """
+        Store a value in the cache
+
+        Args:
+            namespace (str): Cache namespace
+            key: Key inside the namespace
+            value: Value to store
+            ttl (float, optional): TTL override in seconds
+        """
+        full_key = (namespace, key)
+        expires_at = time.monotonic() + (ttl if ttl is not None else self.ttl_for(namespace))
+
+        with self._lock:
+            self._data[full_key] = (value, expires_at)
+            self._data.move_to_end(full_key)
+
+            while len(self._data) > self.max_size:
+                (evicted_ns, _), _ = self._data.popitem(last=False)
+                self._ns_stats(evicted_ns)['evictions'] += 1
+
+    def delete(self, namespace, key):
+        """
+        Remove a single entry
+
+        Returns:
+            bool: True if the entry existed
+        """
+        with self._lock:
+            return self._data.pop((namespace, key), _MISSING) is not _MISSING
+
+    def clear(self, namespace=None):
+        """
+        Remove all entries of a namespace, or the whole cache
+
+        Returns:
+            int: Number of removed entries
+        """
+        with self._lock:
+            if namespace is None:
+                removed = len(self._data)
+                self._data.clear()
+                return removed
+
+            keys = [k for k in self._data if k[0] == namespace]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def purge_expired(self):
+        """
+        Remove all expired entries
+
+        Returns:
+            int: Number of removed entries
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [k for k, (_, expires_at) in self._data.items() if expires_at <= now]
+            for k in expired:
+                del self._data[k]
+                self._ns_stats(k[0])['expirations'] += 1
+        return len(expired)
+
+    def stats(self):
+        """
+        Get cache counters
+
+        Returns:
+            dict: Total size plus hits/misses/evictions/expirations and the
+                current size per namespace
+        """
+        with self._lock:
+            sizes = {}
+            for namespace, _ in self._data:
+                sizes[namespace] = sizes.get(namespace, 0) + 1
+
+            namespaces = {}
+            for namespace in set(self._stats) | set(sizes):
+                ns_stats = dict(self._ns_stats(namespace))
+                ns_stats['size'] = sizes.get(namespace, 0)
+                namespaces[namespace] = ns_stats
+
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'namespaces': namespaces,
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def _purge_loop(self):
+        while not self._stop_event.wait(self.purge_interval):
+            try:
+                removed = self.purge_expired()
+                if removed:
+                    logger.debug(f"Из кэша удалено {removed} устаревших записей")
+            except Exception as e:
+                logger.error(f"Ошибка при очистке кэша: {e}")
+
+    def start_purger(self):
+        """Запустить фоновый поток удаления устаревших записей"""
+        if self._purger and self._purger.is_alive():
+            return
+        self._stop_event.clear()
+        self._purger = threading.Thread(target=self._purge_loop, name="CachePurger", daemon=True)
+        self._purger.start()
+
+    def stop_purger(self):
+        """Остановить фоновый поток удаления устаревших записей"""
+        self._stop_event.set()
+        if self._purger:
+            self._purger.join(timeout=1)
+            self._purger = None
@@ -0,0 +1,324 @@
+"""
+Cross-process cache invalidation bus
+
+Админ-панель и бот могут работать в разных процессах (например, несколько
+воркеров gunicorn), поэтому сброс кэша передается сообщением через общий
+канал, а не вызовом функции в event loop бота.
+
+Backends:
+    postgres - LISTEN/NOTIFY on the application database
+    unix     - datagram unix sockets in a shared directory, one per listener
+    none     - invalidations are dropped
+
+The backend is chosen by CACHE_BUS_BACKEND ('auto' by default: postgres for
+PostgreSQL databases, unix sockets otherwise).
+"""
+import glob
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Каналы инвалидации
+PRODUCTS_CHANNEL = 'products'
+USER_CONFIGS_CHANNEL = 'user_configs'
+USER_BLOCK_CHANNEL = 'user_block'
+
+PG_CHANNEL = os.environ.get('CACHE_BUS_PG_CHANNEL', 'vpnbot_cache')
+SOCKET_DIR = os.environ.get(
+    'CACHE_BUS_SOCKET_DIR',
+    os.path.join(tempfile.gettempdir(), 'vpnbot-cache-bus')
+)
+PUBLISH_QUEUE_SIZE = int(os.environ.get('CACHE_BUS_QUEUE_SIZE', '1000'))
+RECONNECT_DELAY = 5
+
+
+class InvalidationBus:
+    """
+    Base class for invalidation buses
+
+    publish() only enqueues the message and returns immediately; a background
+    publisher thread delivers it. Subscribers are called from the listener
+    thread, so callbacks must be thread-safe and fast.
+    """
+
+    def __init__(self):
+        self._subscribers = {}  # {channel: [callback, ...]}
+        self._queue = queue.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+        self._publisher = None
+        self._listener = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    # -- публикация ---------------------------------------------------------
+
+    def publish(self, channel, key=None):
+        """
+        Publish an invalidation without waiting for delivery
+
+        Args:
+            channel (str): Invalidation channel (e.g. PRODUCTS_CHANNEL)
+            key: Optional key inside the channel (e.g. a Telegram ID)
+
+        Returns:
+            bool: True if the message was queued for delivery
+        """
+        self._ensure_publisher()
+        try:
+            self._queue.put_nowait(json.dumps({'channel': channel, 'key': key}))
+            return True
+        except queue.Full:
+            logger.warning(f"Очередь инвалидации переполнена, сообщение {channel}:{key} отброшено")
+            return False
+
+    def _ensure_publisher(self):
+        with self._lock:
+            if self._publisher and self._publisher.is_alive():
+                return
+            self._publisher = threading.Thread(
+                target=self._publish_loop, name="CacheBusPublisher", daemon=True
+            )
+            self._publisher.start()
+
+    def _publish_loop(self):
+        while True:
+            payload = self._queue.get()
+            try:
+                self._send(payload)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке инвалидации кэша: {e}")
+
+    def _send(self, payload):
+        raise NotImplementedError
+
+    # -- подписка -----------------------------------------------------------
+
+    def subscribe(self, channel, callback):
+        """
+        Register a callback for a channel
+
+        Args:
+            channel (str): Invalidation channel
+            callback (callable): Called with the message key
+        """
+        self._subscribers.setdefault(channel, []).append(callback)
+
+    def _dispatch(self, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            logger.warning(f"Некорректное сообщение инвалидации: {payload!r}")
+            return
+
+        for callback in self._subscribers.get(message.get('channel'), []):
+            try:
+                callback(message.get('key'))
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике инвалидации {message.get('channel')}: {e}")
+
+    def start(self):
+        """Запустить поток приема сообщений инвалидации"""
+        if self._listener and self._listener.is_alive():
+            return
+        self._stop_event.clear()
+        self._listener = threading.Thread(
+            target=self._listen_loop, name="CacheBusListener", daemon=True
+        )
+        self._listener.start()
+
+    def stop(self):
+        """Остановить поток приема сообщений инвалидации"""
+        self._stop_event.set()
+        if self._listener:
+            self._listener.join(timeout=2)
+            self._listener = None
+
+    def _listen_loop(self):
+        raise NotImplementedError
+
+
+class NullInvalidationBus(InvalidationBus):
+    """Шина, которая ничего не доставляет"""
+
+    def _send(self, payload):
+        pass
+
+    def _listen_loop(self):
+        self._stop_event.wait()
+
+
+class PostgresInvalidationBus(InvalidationBus):
+    """Invalidation bus based on PostgreSQL LISTEN/NOTIFY"""
+
+    def __init__(self, dsn, channel=PG_CHANNEL):
+        super().__init__()
+        self.dsn = dsn
+        self.channel = channel
+        self._publish_conn = None
+
+    def _connect(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        conn = psycopg2.connect(self.dsn)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def _send(self, payload):
+        for attempt in range(2):
+            try:
+                if self._publish_conn is None or self._publish_conn.closed:
+                    self._publish_conn = self._connect()
+                with self._publish_conn.cursor() as cur:
+                    cur.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+                return
+            except Exception:
+                # Соединение могло быть разорвано - переподключаемся один раз
+                self._publish_conn = None
+                if attempt:
+                    raise
+
+    def _listen_loop(self):
+        while not self._stop_event.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{self.channel}"')
+                logger.info(f"Подписка на канал инвалидации PostgreSQL {self.channel}")
+
+                while not self._stop_event.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._dispatch(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.error(f"Ошибка слушателя инвалидации PostgreSQL: {e}")
+                self._stop_event.wait(RECONNECT_DELAY)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+class UnixSocketInvalidationBus(InvalidationBus):
+    """
+    Invalidation bus based on unix datagram sockets
+
+    Every listening process binds its own socket in socket_dir; publishers send
+    each message to all sockets found there and remove sockets of dead
+    processes.
+    """
+
+    def __init__(self, socket_dir=SOCKET_DIR):
+        super().__init__()
+        self.socket_dir = socket_dir
+        self.socket_path = os.path.join(socket_dir, f"{os.getpid()}.sock")
+        self._send_sock = None
+
+    def _send(self, payload):
+        if self._send_sock is None:
+            self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._send_sock.setblocking(False)
+
+        data = payload.encode()
+        for path in glob.glob(os.path.join(self.socket_dir, '*.sock')):
+            try:
+                self._send_sock.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Процесс-слушатель завершился, удаляем его сокет
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except BlockingIOError:
+                logger.warning(f"Буфер сокета {path} переполнен, инвалидация пропущена")
+
+    def _listen_loop(self):
+        os.makedirs(self.socket_dir, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.socket_path)
+        sock.settimeout(1.0)
+        logger.info(f"Слушатель инвалидации кэша запущен на {self.socket_path}")
+
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                self._dispatch(data.decode())
+        finally:
+            sock.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def create_bus(backend=None, database_url=None):
+    """
+    Create an invalidation bus for the configured backend
+
+    Args:
+        backend (str, optional): 'auto', 'postgres', 'unix' or 'none'.
+            Defaults to CACHE_BUS_BACKEND.
+        database_url (str, optional): Database URL. Defaults to DATABASE_URL.
+
+    Returns:
+        InvalidationBus: Bus instance
+    """
+    backend = backend or os.environ.get('CACHE_BUS_BACKEND', 'auto')
+    database_url = database_url or os.environ.get('DATABASE_URL', 'sqlite:///vpn_bot.db')
+
+    if backend == 'auto':
+        backend = 'postgres' if database_url.startswith('postgres') else 'unix'
+
+    if backend == 'postgres':
+        from sqlalchemy.engine import make_url
+        url = make_url(database_url).set(drivername='postgresql')
+        return PostgresInvalidationBus(url.render_as_string(hide_password=False))
+    if backend == 'unix':
+        return UnixSocketInvalidationBus()
+    if backend == 'none':
+        return NullInvalidationBus()
+
+    raise ValueError(f"Unsupported cache bus backend: {backend}")
+
+
+def get_bus():
+    """Получить общую для процесса шину инвалидации"""
+    global _bus
+    with _bus_lock:
+        if _bus is None:
+            _bus = create_bus()
+            logger.info(f"Шина инвалидации кэша: {type(_bus).__name__}")
+        return _bus
+
+
+def invalidate_products():
+    """Сбросить кэш продуктов во всех процессах"""
+    return get_bus().publish(PRODUCTS_CHANNEL)
+
+
+def invalidate_user_configs(telegram_id):
+    """Сбросить кэш конфигураций пользователя во всех процессах"""
+    return get_bus().publish(USER_CONFIGS_CHANNEL, telegram_id)
+
+
+def invalidate_user_block(telegram_id):
+    """Сбросить кэш статуса блокировки пользователя во всех процессах"""
+    return get_bus().publish(USER_BLOCK_CHANNEL, telegram_id)
@@ -0,0 +1,299 @@
+"""
+Batched sweeper that deactivates expired VPN configurations
+
+Фоновая задача в event loop бота: пачками выбирает активные конфигурации с
+истекшим valid_until (по индексу), деактивирует каждую пачку одним UPDATE и
+отключает соответствующих клиентов в 3x-ui пакетным запросом.
+
+Тот же UPDATE ставит конфигурациям с клиентом в 3x-ui отметку
+xui_sync_pending. Отметка снимается только после того, как 3x-ui подтвердил
+отключение клиента, поэтому сбой панели или перезапуск процесса между
+коммитом и запросом к 3x-ui не оставляет включенных клиентов: каждый проход
+повторяет отключение для всех отмеченных конфигураций.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+from app import db
+from models import TelegramUser, VPNConfig
+from bot_db import run_db
+from cache_bus import invalidate_user_configs
+import stats_rollup
+from x_ui_client import XUIClientError
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = float(os.environ.get('EXPIRY_SWEEP_INTERVAL', '300'))
+SWEEP_BATCH_SIZE = int(os.environ.get('EXPIRY_SWEEP_BATCH_SIZE', '500'))
+SWEEP_MAX_BATCHES = int(os.environ.get('EXPIRY_SWEEP_MAX_BATCHES', '100'))
+
+
+def client_email(telegram_id, created_at):
+    """Email клиента в 3x-ui, под которым админ-панель создает конфигурации"""
+    return f"tguser_{telegram_id}_{created_at.strftime('%Y%m%d%H%M%S')}"
+
+
+def deactivate_expired_batch(now, batch_size):
+    """
+    Deactivate one batch of expired configurations
+
+    Must be called inside an app context (run_db provides one).
+
+    Args:
+        now (datetime): Expiry cutoff
+        batch_size (int): Maximum number of configurations to process
+
+    Configurations with a 3x-ui client are marked xui_sync_pending in the
+    same transaction; the sweeper clears the mark once 3x-ui confirms.
+
+    Returns:
+        tuple: (scanned, updated, rows) - rows are dicts with id, config_type,
+            telegram_id, x_ui_client_id and created_at of the deactivated configs
+    """
+    rows = db.session.query(
+        VPNConfig.id,
+        VPNConfig.config_type,
+        VPNConfig.x_ui_client_id,
+        VPNConfig.created_at,
+        TelegramUser.telegram_id
+    ).join(TelegramUser, VPNConfig.user_id == TelegramUser.id).filter(
+        VPNConfig.is_active == True,
+        VPNConfig.valid_until < now
+    ).order_by(VPNConfig.valid_until, VPNConfig.id).limit(batch_size).all()
+
+    if not rows:
+        return 0, 0, []
+    scanned = len(rows)
+
+    # Повторная проверка условия в UPDATE защищает от продления, сделанного
+    # между выборкой и обновлением
+    updated = VPNConfig.query.filter(
+        VPNConfig.id.in_([row.id for row in rows]),
+        VPNConfig.is_active == True,
+        VPNConfig.valid_until < now
+    ).update({
+        VPNConfig.is_active: False,
+        VPNConfig.xui_sync_pending: VPNConfig.x_ui_client_id.isnot(None)
+    }, synchronize_session=False)
+    if updated:
+        stats_rollup.bump(stats_rollup.CONFIGS_ACTIVE, -updated)
+    db.session.commit()
+
+    if updated < len(rows):
+        # Часть конфигураций продлили - их клиентов в 3x-ui не трогаем
+        inactive = {config_id for (config_id,) in db.session.query(VPNConfig.id).filter(
+            VPNConfig.id.in_([row.id for row in rows]),
+            VPNConfig.is_active == False
+        )}
+        rows = [row for row in rows if row.id in inactive]
+
+    return scanned, updated, [row._asdict() for row in rows]
+
+
+def pending_xui_batch(after_id, batch_size):
+    """
+    Get deactivated configurations whose 3x-ui client is not disabled yet
+
+    Args:
+        after_id (int): Return only configurations with a greater ID
+        batch_size (int): Maximum number of configurations
+
+    Returns:
+        list: Dicts with id, config_type, telegram_id, x_ui_client_id and
+            created_at, ordered by id
+    """
+    rows = db.session.query(
+        VPNConfig.id,
+        VPNConfig.config_type,
+        VPNConfig.x_ui_client_id,
+        VPNConfig.created_at,
+        TelegramUser.telegram_id
+    ).join(TelegramUser, VPNConfig.user_id == TelegramUser.id).filter(
+        VPNConfig.xui_sync_pending == True,
+        VPNConfig.is_active == False,
+        VPNConfig.id > after_id
+    ).order_by(VPNConfig.id).limit(batch_size).all()
+    return [row._asdict() for row in rows]
+
+
+def clear_xui_sync_pending(config_ids):
+    """Снять отметку xui_sync_pending с конфигураций, отключенных в 3x-ui"""
+    if not config_ids:
+        return 0
+    cleared = VPNConfig.query.filter(
+        VPNConfig.id.in_(config_ids)
+    ).update({VPNConfig.xui_sync_pending: False}, synchronize_session=False)
+    db.session.commit()
+    return cleared
+
+
+class ExpirySweeper:
+    """
+    Periodic expiry sweep running as an asyncio task
+
+    Each run processes batches until no expired active configurations are
+    left or max_batches is reached, then disables the 3x-ui clients of all
+    configurations still marked xui_sync_pending. Run statistics are kept
+    in last_run and accumulated in totals.
+    """
+
+    def __init__(self, xui_client=None, interval=SWEEP_INTERVAL, batch_size=SWEEP_BATCH_SIZE,
+                 max_batches=SWEEP_MAX_BATCHES):
+        """
+        Initialize the sweeper
+
+        Args:
+            xui_client (AsyncXUIClient, optional): Client used to disable
+                3x-ui clients; if None, only the database is updated
+            interval (float): Seconds between runs
+            batch_size (int): Configurations per batch
+            max_batches (int): Upper bound of batches per run
+        """
+        self.xui_client = xui_client
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.last_run = None
+        self.totals = {'runs': 0, 'scanned': 0, 'updated': 0, 'xui_disabled': 0, 'xui_failed': 0}
+        self._task = None
+
+    async def _disable_xui_clients(self, rows):
+        """
+        Disable the 3x-ui clients of deactivated configurations
+
+        Returns:
+            tuple: (done_ids, failed) - IDs of configurations whose client is
+                disabled or has no inbound to disable it in, and the number
+                of failures left for the next run
+        """
+        done_ids = []
+        items = []
+        item_ids = []
+        for row in rows:
+            try:
+                inbound = await self.xui_client.find_inbound(row['config_type'])
+            except XUIClientError as e:
+                logger.warning(f"Не удалось получить инбаунды 3x-ui: {e}")
+                return [], len(rows)
+            if inbound is None:
+                # Инбаунда этого типа больше нет - отключать нечего
+                done_ids.append(row['id'])
+                continue
+            items.append({
+                'inbound_id': inbound.get('id'),
+                'email': client_email(row['telegram_id'], row['created_at']),
+                'enable': False
+            })
+            item_ids.append(row['id'])
+
+        failed = 0
+        if items:
+            result = await self.xui_client.update_clients(items)
+            # results идут в порядке items
+            for config_id, item in zip(item_ids, result.results):
+                if item is not None and item['ok']:
+                    done_ids.append(config_id)
+                else:
+                    failed += 1
+                    if item is not None:
+                        logger.warning(f"Не удалось отключить клиента {item['email']} в 3x-ui: {item['error']}")
+        return done_ids, failed
+
+    async def _sync_pending(self, stats):
+        """Отключить в 3x-ui клиентов всех конфигураций с отметкой xui_sync_pending"""
+        if self.xui_client is None:
+            return
+
+        after_id = 0
+        for _ in range(self.max_batches):
+            rows = await run_db(pending_xui_batch, after_id, self.batch_size)
+            if not rows:
+                break
+            after_id = rows[-1]['id']
+
+            done_ids, failed = await self._disable_xui_clients(rows)
+            if done_ids:
+                await run_db(clear_xui_sync_pending, done_ids)
+            stats['xui_disabled'] += len(done_ids)
+            stats['xui_failed'] += failed
+
+            if len(rows) < self.batch_size:
+                break
+
+    async def run_once(self):
+        """
+        Run one sweep
+
+        Returns:
+            dict: Run statistics - scanned, updated, xui_disabled, xui_failed,
+                batches, duration and started_at
+        """
+        started = time.monotonic()
+        now = datetime.utcnow()
+        stats = {'scanned': 0, 'updated': 0, 'xui_disabled': 0, 'xui_failed': 0,
+                 'batches': 0, 'duration': 0.0, 'started_at': now}
+
+        for _ in range(self.max_batches):
+            scanned, updated, rows = await run_db(deactivate_expired_batch, now, self.batch_size)
+            if not scanned:
+                break
+
+            stats['batches'] += 1
+            stats['scanned'] += scanned
+            stats['updated'] += updated
+
+            for telegram_id in {row['telegram_id'] for row in rows}:
+                invalidate_user_configs(telegram_id)
+
+            if scanned < self.batch_size:
+                break
+
+        # Включая конфигурации, которые не удалось отключить в прошлых проходах
+        await self._sync_pending(stats)
+
+        stats['duration'] = round(time.monotonic() - started, 3)
+        self.last_run = stats
+        self.totals['runs'] += 1
+        for key in ('scanned', 'updated', 'xui_disabled', 'xui_failed'):
+            self.totals[key] += stats[key]
+
+        if stats['scanned'] or stats['xui_disabled'] or stats['xui_failed']:
+            logger.info(
+                f"Проверка сроков: деактивировано {stats['updated']} из {stats['scanned']} конфигураций "
+                f"за {stats['duration']} с, отключено в 3x-ui: {stats['xui_disabled']}, ошибок: {stats['xui_failed']}"
+            )
+        return stats
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при проверке сроков конфигураций: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self, xui_client=None):
+        """Запустить периодическую проверку в текущем event loop"""
+        if xui_client is not None:
+            self.xui_client = xui_client
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run_forever())
+
+    async def stop(self):
+        """Остановить периодическую проверку"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Экземпляр процесса: запускается ботом, статистику показывает админ-панель
+sweeper = ExpirySweeper()
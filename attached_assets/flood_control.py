@@ -0,0 +1,174 @@
+"""
+Per-user flood control for the Telegram bot
+
+Обработчик регистрируется в группе -1, то есть раньше всех остальных, и
+проверяет ведро токенов пользователя для группы обновления (нажатия кнопок,
+команды, прочие сообщения). Лишние обновления отбрасываются через
+ApplicationHandlerStop без обращения к базе данных - дальше них не доходит
+даже check_user_blocked. Счетчики отброшенных обновлений доступны
+администратору в боте.
+
+Лимиты задаются переменными окружения BOT_FLOOD_<ГРУППА>_RATE (токенов в
+секунду, 0 - без ограничения) и BOT_FLOOD_<ГРУППА>_BURST.
+"""
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from rate_limit import KeyedRateLimiter
+
+logger = logging.getLogger(__name__)
+
+FLOOD_GROUP = -1
+FLOOD_MAX_TRACKED_USERS = int(os.environ.get('BOT_FLOOD_MAX_TRACKED_USERS', '1000'))
+# Не чаще одного ответа "слишком часто" пользователю за это время, секунд
+FLOOD_NOTICE_INTERVAL = float(os.environ.get('BOT_FLOOD_NOTICE_INTERVAL', '5'))
+
+CALLBACK = 'callback'
+COMMAND = 'command'
+MESSAGE = 'message'
+
+DEFAULT_LIMITS = {
+    CALLBACK: (2.0, 5),
+    COMMAND: (1.0, 3),
+    MESSAGE: (1.0, 3),
+}
+
+
+def limits_from_env(defaults=DEFAULT_LIMITS):
+    """
+    Read per-group limits from the environment
+
+    Returns:
+        dict: {group: (rate, burst)}; groups with rate 0 are left out
+    """
+    limits = {}
+    for group, (rate, burst) in defaults.items():
+        prefix = f'BOT_FLOOD_{group.upper()}'
+        rate = float(os.environ.get(f'{prefix}_RATE', rate))
+        burst = float(os.environ.get(f'{prefix}_BURST', burst))
+        if rate > 0:
+            limits[group] = (rate, burst)
+    return limits
+
+
+def update_group(update):
+    """
+    Classify an update for flood control
+
+    Returns:
+        str: CALLBACK, COMMAND or MESSAGE
+    """
+    if update.callback_query is not None:
+        return CALLBACK
+    message = update.effective_message
+    if message is not None and message.text and message.text.startswith('/'):
+        return COMMAND
+    return MESSAGE
+
+
+class FloodControl:
+    """Token bucket per user and update group, checked before all handlers"""
+
+    def __init__(self, limits=None, exempt=None):
+        """
+        Initialize flood control
+
+        Args:
+            limits (dict, optional): {group: (rate, burst)}; read from the
+                environment by default
+            exempt (callable, optional): Returns True for user IDs that are
+                never limited, e.g. the admin
+        """
+        if limits is None:
+            limits = limits_from_env()
+        self.limiters = {
+            group: KeyedRateLimiter(None, rate, burst)
+            for group, (rate, burst) in limits.items()
+        }
+        self.exempt = exempt
+        self.totals = {group: {'allowed': 0, 'throttled': 0} for group in self.limiters}
+        self.throttled_users = OrderedDict()  # {user_id: {'count', 'last_at', 'notified_at'}}
+
+    def _record_throttled(self, user_id, group):
+        self.totals[group]['throttled'] += 1
+        entry = self.throttled_users.pop(user_id, None)
+        if entry is None:
+            entry = {'count': 0, 'last_at': 0.0, 'notified_at': 0.0}
+        entry['count'] += 1
+        entry['last_at'] = time.time()
+        self.throttled_users[user_id] = entry
+        while len(self.throttled_users) > FLOOD_MAX_TRACKED_USERS:
+            self.throttled_users.popitem(last=False)
+        return entry
+
+    def check(self, user_id, group):
+        """
+        Take a token for the user in the group
+
+        Returns:
+            bool: True if the update may be processed
+        """
+        limiter = self.limiters.get(group)
+        if limiter is None or (self.exempt is not None and self.exempt(user_id)):
+            return True
+        if limiter.try_acquire(user_id) == 0:
+            self.totals[group]['allowed'] += 1
+            return True
+        return False
+
+    async def handle(self, update, context):
+        """Обработчик группы -1: отбросить обновление, если лимит превышен"""
+        from telegram.ext import ApplicationHandlerStop
+
+        user = update.effective_user
+        if user is None:
+            return
+
+        group = update_group(update)
+        if self.check(user.id, group):
+            return
+
+        entry = self._record_throttled(user.id, group)
+        if entry['count'] == 1 or entry['count'] % 100 == 0:
+            logger.warning(f"Пользователь {user.id} превысил лимит ({group}), отброшено {entry['count']}")
+
+        # Ответ без обращения к базе и не чаще раза в FLOOD_NOTICE_INTERVAL
+        if update.callback_query is not None and entry['last_at'] - entry['notified_at'] >= FLOOD_NOTICE_INTERVAL:
+            entry['notified_at'] = entry['last_at']
+            try:
+                await update.callback_query.answer("Слишком много запросов, подождите немного.")
+            except Exception as e:
+                logger.debug(f"Не удалось ответить на callback при ограничении: {e}")
+
+        raise ApplicationHandlerStop
+
+    def register(self, application, group=FLOOD_GROUP):
+        """Зарегистрировать проверку раньше всех обработчиков приложения"""
+        from telegram import Update
+        from telegram.ext import TypeHandler
+
+        application.add_handler(TypeHandler(Update, self.handle), group=group)
+
+    def snapshot(self, top=10):
+        """
+        Counters for the admin
+
+        Returns:
+            dict: 'limits', 'totals' and 'top_users' - the most throttled users
+                as (user_id, count, last_at) tuples
+        """
+        top_users = sorted(
+            ((user_id, entry['count'], entry['last_at']) for user_id, entry in self.throttled_users.items()),
+            key=lambda item: item[1],
+            reverse=True
+        )[:top]
+        return {
+            'limits': {
+                group: (limiter.per_key_rate, limiter.per_key_capacity)
+                for group, limiter in self.limiters.items()
+            },
+            'totals': {group: dict(counts) for group, counts in self.totals.items()},
+            'top_users': top_users,
+        }
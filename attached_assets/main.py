@@ -5,7 +5,6 @@ import logging
 import os
 import threading
 import sys
-import asyncio
 
 # Configure logging
 logging.basicConfig(
@@ -50,6 +49,16 @@ from flask import jsonify
 
 # Import for admin panel cache clearing
 import admin_panel_cache
+# Маршрут для приема обновлений Telegram в режиме webhook
+import bot_webhook
+import cache_bus
+import settings_snapshot
+
+# Слушаем сообщения инвалидации в каждом процессе (в том числе воркерах gunicorn),
+# чтобы снимок настроек обновлялся после сохранения в любом из них
+invalidation_bus = cache_bus.get_bus()
+settings_snapshot.subscribe(invalidation_bus)
+invalidation_bus.start()
 
 # Глобальная переменная для хранения event loop для запуска асинхронных функций
 # Определение атрибута bot_event_loop в модуле main
@@ -61,81 +70,28 @@ sys.modules['main'] = sys.modules[__name__]
 def clear_products_cache():
     """
     Очистить кэш продуктов в боте
-    Эта функция используется в админ-панели для сброса кэша после изменения продуктов
+    Эта функция используется в админ-панели для сброса кэша после изменения продуктов.
+    Сообщение отправляется через шину инвалидации и доходит до бота в любом процессе,
+    вызов не ждет его обработки.
     """
-    global bot_event_loop
-    
-    if bot_event_loop is None:
-        logger.warning("Event loop не инициализирован, невозможно очистить кэш продуктов")
-        return False
-    
-    try:
-        # Импортируем здесь, чтобы избежать циклических импортов
-        from bot import clear_products_cache as async_clear_products_cache
-        
-        # Создаем future для выполнения асинхронной функции
-        future = asyncio.run_coroutine_threadsafe(async_clear_products_cache(), bot_event_loop)
-        
-        # Ждем результата с таймаутом в 2 секунды
-        result = future.result(timeout=2)
-        logger.info(f"Кэш продуктов очищен: {result}")
-        return result
-    except Exception as e:
-        logger.error(f"Ошибка при очистке кэша продуктов: {str(e)}")
-        return False
+    result = cache_bus.invalidate_products()
+    logger.info(f"Инвалидация кэша продуктов отправлена: {result}")
+    return result
 
 def clear_user_configs_cache(telegram_id):
     """
     Очистить кэш конфигураций пользователя в боте
     Эта функция используется для сброса кэша конфигураций конкретного пользователя
     """
-    global bot_event_loop
-    
-    if bot_event_loop is None:
-        logger.warning("Event loop не инициализирован, невозможно очистить кэш конфигураций пользователя")
-        return False
-    
-    try:
-        # Импортируем здесь, чтобы избежать циклических импортов
-        from bot import clear_user_configs_cache as async_clear_user_configs_cache
-        
-        # Создаем future для выполнения асинхронной функции
-        future = asyncio.run_coroutine_threadsafe(async_clear_user_configs_cache(telegram_id), bot_event_loop)
-        
-        # Ждем результата с таймаутом в 2 секунды
-        result = future.result(timeout=2)
-        logger.info(f"Кэш конфигураций пользователя {telegram_id} очищен: {result}")
-        return result
-    except Exception as e:
-        logger.error(f"Ошибка при очистке кэша конфигураций пользователя {telegram_id}: {str(e)}")
-        return False
+    result = cache_bus.invalidate_user_configs(telegram_id)
+    logger.info(f"Инвалидация кэша конфигураций пользователя {telegram_id} отправлена: {result}")
+    return result
 
 @app.route('/test/clear_products_cache')
 def test_clear_products_cache():
     """
     Тестовый публичный маршрут для очистки кэша продуктов
     """
-    global bot_event_loop
-    
-    # Проверка, инициализирован ли event loop
-    max_wait = 10  # максимальное время ожидания в секундах
-    wait_interval = 0.5  # интервал проверки в секундах
-    
-    waited = 0
-    while bot_event_loop is None and waited < max_wait:
-        import time
-        time.sleep(wait_interval)
-        waited += wait_interval
-        logger.info(f"Ожидание инициализации bot_event_loop: {waited} сек...")
-    
-    if bot_event_loop is None:
-        logger.error(f"bot_event_loop не инициализирован после {max_wait} секунд ожидания")
-        return jsonify({
-            'success': False,
-            'message': f'Ошибка: bot_event_loop не инициализирован после {max_wait} секунд ожидания'
-        }), 500
-    
-    # Очистка кэша продуктов
     result = clear_products_cache()
     return jsonify({
         'success': result,
@@ -147,27 +103,6 @@ def test_clear_user_configs_cache(telegram_id):
     """
     Тестовый публичный маршрут для очистки кэша конфигураций пользователя
     """
-    global bot_event_loop
-    
-    # Проверка, инициализирован ли event loop
-    max_wait = 10  # максимальное время ожидания в секундах
-    wait_interval = 0.5  # интервал проверки в секундах
-    
-    waited = 0
-    while bot_event_loop is None and waited < max_wait:
-        import time
-        time.sleep(wait_interval)
-        waited += wait_interval
-        logger.info(f"Ожидание инициализации bot_event_loop: {waited} сек...")
-    
-    if bot_event_loop is None:
-        logger.error(f"bot_event_loop не инициализирован после {max_wait} секунд ожидания")
-        return jsonify({
-            'success': False,
-            'message': f'Ошибка: bot_event_loop не инициализирован после {max_wait} секунд ожидания'
-        }), 500
-    
-    # Очистка кэша конфигураций пользователя
     result = clear_user_configs_cache(telegram_id)
     return jsonify({
         'success': result,
@@ -0,0 +1,442 @@
+"""
+In-process metrics in the Prometheus text exposition format
+
+Бот работает в том же процессе, что и Flask, поэтому один реестр покрывает
+и обработчики бота, и маршруты админ-панели. Маршрут /metrics отдает все
+метрики в текстовом формате Prometheus. Доступ есть у вошедшего
+администратора и, если задан METRICS_TOKEN, у запросов с этим токеном в
+заголовке Authorization: Bearer или в параметре token; остальным маршрут
+отвечает 404, в том числе когда токен не задан.
+
+Реестр намеренно простой и без внешних зависимостей: счетчики, гистограммы
+и коллекторы, которые читают готовую статистику (кэши, пул соединений) в
+момент запроса.
+"""
+import functools
+import hmac
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base class for labelled metrics"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Get current samples
+
+        Returns:
+            list: (suffix, labels, value) tuples where labels is a list of
+                (name, value) pairs
+        """
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing value"""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [('', list(zip(self.labelnames, key)), value) for key, value in items]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Измерить время выполнения блока в секундах"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+
+        samples = []
+        for key, (counts, total, count) in items:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', labels + [('le', _format_value(float(bound)))], cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+class Registry:
+    """Collection of metrics and collectors rendered together"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector):
+        """
+        Register a callable producing metrics at scrape time
+
+        The callable returns an iterable of (name, type, documentation,
+        samples) where samples are (labels dict, value) pairs.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """
+        Render all metrics
+
+        Returns:
+            str: Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for suffix, labels, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+
+        for collector in collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                # Сбой одного коллектора не должен ломать остальные метрики
+                logger.error(f"Ошибка сбора метрик: {e}")
+                continue
+            for name, metric_type, documentation, samples in families:
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+BOT_HANDLER_SECONDS = REGISTRY.histogram(
+    'bot_handler_duration_seconds', 'Telegram bot handler callback duration', ['handler']
+)
+BOT_HANDLER_ERRORS = REGISTRY.counter(
+    'bot_handler_errors_total', 'Telegram bot handler callbacks that raised', ['handler']
+)
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', 'Flask request duration by endpoint', ['endpoint', 'method', 'status']
+)
+XUI_REQUEST_SECONDS = REGISTRY.histogram(
+    'xui_request_duration_seconds', '3x-ui panel call duration', ['client', 'operation']
+)
+XUI_REQUEST_ERRORS = REGISTRY.counter(
+    'xui_request_errors_total', '3x-ui panel calls that failed', ['client', 'operation']
+)
+DB_POOL_EVENTS = REGISTRY.counter(
+    'db_pool_events_total', 'SQLAlchemy connection pool events', ['event']
+)
+DB_POOL_HOLD_SECONDS = REGISTRY.histogram(
+    'db_pool_checkout_duration_seconds', 'Time a pooled connection stays checked out'
+)
+
+_ID_SEGMENT = re.compile(r'/\d+(?=/|$)')
+
+
+def xui_operation(method, path):
+    """Метка операции 3x-ui без ID в пути, чтобы не плодить ряды"""
+    return f"{method} {_ID_SEGMENT.sub('/:id', path)}"
+
+
+@contextmanager
+def observe_xui(client, operation):
+    """Измерить вызов панели 3x-ui и посчитать ошибки"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        XUI_REQUEST_ERRORS.inc(client=client, operation=operation)
+        raise
+    finally:
+        XUI_REQUEST_SECONDS.observe(time.perf_counter() - started, client=client, operation=operation)
+
+
+def timed_xui(func):
+    """Декоратор метода синхронного XUIClient"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with observe_xui('sync', func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+# -- кэши ---------------------------------------------------------------------
+
+def register_cache(name, cache, registry=REGISTRY):
+    """
+    Expose a TTLCache's counters
+
+    Args:
+        name (str): Cache label, e.g. 'bot' or 'qr'
+        cache (TTLCache): Cache to read stats() from at scrape time
+    """
+    def collect():
+        stats = cache.stats()
+        samples = {'hits': [], 'misses': [], 'evictions': [], 'expirations': [], 'size': []}
+        for namespace, ns_stats in stats['namespaces'].items():
+            labels = {'cache': name, 'namespace': namespace}
+            for field, values in samples.items():
+                values.append((labels, ns_stats[field]))
+        return [
+            ('cache_hits_total', 'counter', 'Cache hits', samples['hits']),
+            ('cache_misses_total', 'counter', 'Cache misses, including expired entries', samples['misses']),
+            ('cache_evictions_total', 'counter', 'Entries evicted by the size limit', samples['evictions']),
+            ('cache_expirations_total', 'counter', 'Entries dropped after their TTL', samples['expirations']),
+            ('cache_entries', 'gauge', 'Entries currently cached', samples['size']),
+        ]
+
+    registry.register_collector(collect)
+
+
+# -- пул соединений ------------------------------------------------------------
+
+def instrument_engine(engine, registry=REGISTRY):
+    """Считать события пула соединений SQLAlchemy и время удержания соединений"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        DB_POOL_EVENTS.inc(event='connect')
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_POOL_EVENTS.inc(event='checkout')
+        connection_record.info['metrics_checkout_at'] = time.perf_counter()
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        DB_POOL_EVENTS.inc(event='checkin')
+        started = connection_record.info.pop('metrics_checkout_at', None)
+        if started is not None:
+            DB_POOL_HOLD_SECONDS.observe(time.perf_counter() - started)
+
+    @event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        DB_POOL_EVENTS.inc(event='invalidate')
+
+    def collect():
+        pool = engine.pool
+        families = []
+        # Не у всех реализаций пула есть эти счетчики (например, у SQLite)
+        for name, attr, documentation in (
+            ('db_pool_size', 'size', 'Configured pool size'),
+            ('db_pool_checked_out', 'checkedout', 'Connections currently checked out'),
+            ('db_pool_overflow', 'overflow', 'Connections above the pool size'),
+            ('db_pool_checked_in', 'checkedin', 'Idle connections in the pool'),
+        ):
+            method = getattr(pool, attr, None)
+            if callable(method):
+                families.append((name, 'gauge', documentation, [({}, method())]))
+        return families
+
+    registry.register_collector(collect)
+
+
+# -- обработчики бота ----------------------------------------------------------
+
+def _wrap_callback(callback):
+    from telegram.ext import ApplicationHandlerStop
+    import query_stats
+
+    name = getattr(callback, '__qualname__', None) or repr(callback)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            # Запросы к БД считаются в области этого обработчика
+            with query_stats.scope('handler', name):
+                return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            BOT_HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            BOT_HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+    wrapper.metrics_wrapped = True
+    return wrapper
+
+
+def _handler_tree(handler):
+    from telegram.ext import ConversationHandler
+
+    if isinstance(handler, ConversationHandler):
+        for child in handler.entry_points:
+            yield from _handler_tree(child)
+        for children in handler.states.values():
+            for child in children:
+                yield from _handler_tree(child)
+        for child in handler.fallbacks:
+            yield from _handler_tree(child)
+    else:
+        yield handler
+
+
+def instrument_application(application):
+    """
+    Time every handler callback registered in the application
+
+    Each call also opens a query_stats scope, so its SQL statements are
+    counted and slow ones are logged with the handler name.
+
+    Call after all handlers are added; handlers inside ConversationHandler
+    are included. Calling twice does not wrap callbacks twice.
+    """
+    wrapped = 0
+    for handlers in application.handlers.values():
+        for top in handlers:
+            for handler in _handler_tree(top):
+                callback = getattr(handler, 'callback', None)
+                if callback is not None and not getattr(callback, 'metrics_wrapped', False):
+                    handler.callback = _wrap_callback(callback)
+                    wrapped += 1
+    logger.info(f"Метрики подключены к {wrapped} обработчикам бота")
+    return wrapped
+
+
+# -- Flask ----------------------------------------------------------------------
+
+def init_app(app, engine=None):
+    """
+    Time Flask requests and add the /metrics route
+
+    Args:
+        app (Flask): Application to instrument
+        engine (Engine, optional): SQLAlchemy engine whose pool to observe
+    """
+    from flask import Response, abort, g, request
+    from flask_login import current_user
+
+    if engine is not None:
+        instrument_engine(engine)
+
+    @app.before_request
+    def _metrics_start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _metrics_observe(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                endpoint=request.endpoint or 'unmatched',
+                method=request.method,
+                status=response.status_code
+            )
+        return response
+
+    def _authorized():
+        if current_user.is_authenticated:
+            return True
+        # Без настроенного токена доступ только у администратора
+        if not METRICS_TOKEN:
+            return False
+        header = request.headers.get('Authorization', '')
+        token = header[7:] if header.startswith('Bearer ') else request.args.get('token', '')
+        return hmac.compare_digest(token.encode(), METRICS_TOKEN.encode())
+
+    @app.route('/metrics')
+    def metrics():
+        """Метрики в текстовом формате Prometheus"""
+        if not _authorized():
+            abort(404)
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,134 @@
+"""
+Versioned schema migrations
+
+db.create_all() создает только отсутствующие таблицы, поэтому изменения
+схемы существующих баз (индексы и т.п.) применяются здесь. Каждая миграция
+выполняется один раз; примененные версии хранятся в таблице schema_version.
+Работает с SQLite и PostgreSQL.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from app import db
+
+logger = logging.getLogger(__name__)
+
+# Произвольный ключ advisory-блокировки, чтобы миграции не шли параллельно
+# из нескольких процессов на PostgreSQL
+_PG_LOCK_KEY = 720514
+
+
+def _create_indexes(conn, *names):
+    """Создать индексы, объявленные в моделях, если их еще нет"""
+    indexes = {
+        index.name: index
+        for table in db.metadata.sorted_tables
+        for index in table.indexes
+    }
+    for name in names:
+        indexes[name].create(bind=conn, checkfirst=True)
+
+
+def _hot_path_indexes(conn):
+    # Индекс на valid_until поглощается составным (is_active, valid_until)
+    conn.execute(text("DROP INDEX IF EXISTS ix_vpn_config_valid_until"))
+    _create_indexes(
+        conn,
+        'ix_telegram_user_registration_date',
+        'ix_vpn_config_user_id_is_active',
+        'ix_vpn_config_is_active_valid_until',
+        'ix_vpn_config_created_at',
+        'ix_product_is_active',
+        'ix_order_status_created_at',
+        'ix_order_status_paid_at',
+        'ix_order_user_id_created_at',
+        'ix_order_created_at',
+    )
+
+
+def _order_amount_index(conn):
+    # Для постраничного вывода заказов с сортировкой по сумме
+    _create_indexes(conn, 'ix_order_amount')
+
+
+def _initial_stats_rollup(conn):
+    # Таблицу создал create_all, заполняем счетчики по существующим данным
+    from stats_rollup import rebuild
+    rebuild(conn)
+
+
+def _vpn_config_share_uri(conn):
+    # Новые базы получают колонку из create_all; значения заполняет backfill_share_uris.py
+    columns = {column['name'] for column in inspect(conn).get_columns('vpn_config')}
+    if 'share_uri' not in columns:
+        conn.execute(text("ALTER TABLE vpn_config ADD COLUMN share_uri TEXT"))
+
+
+def _vpn_config_xui_sync_pending(conn):
+    # Отметка о неотключенном в 3x-ui клиенте ставится в одной транзакции с деактивацией
+    columns = {column['name'] for column in inspect(conn).get_columns('vpn_config')}
+    if 'xui_sync_pending' not in columns:
+        conn.execute(text("ALTER TABLE vpn_config ADD COLUMN xui_sync_pending BOOLEAN NOT NULL DEFAULT FALSE"))
+    _create_indexes(conn, 'ix_vpn_config_xui_sync_pending')
+
+
+# (версия, описание, функция(conn)) - только добавлять в конец, не изменять
+MIGRATIONS = [
+    (1, 'Indexes for hot query columns', _hot_path_indexes),
+    (2, 'Order amount index for keyset pagination', _order_amount_index),
+    (3, 'Initial dashboard stats rollup', _initial_stats_rollup),
+    (4, 'VPNConfig.share_uri column', _vpn_config_share_uri),
+    (5, 'VPNConfig.xui_sync_pending column', _vpn_config_xui_sync_pending),
+]
+
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INTEGER PRIMARY KEY, "
+        "description VARCHAR(200) NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL)"
+    ))
+
+
+def applied_versions(conn):
+    """Получить множество примененных версий"""
+    _ensure_version_table(conn)
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+
+def run_migrations(engine=None):
+    """
+    Apply all pending migrations
+
+    Each migration runs in its own transaction together with its
+    schema_version row, so a failed migration is retried on next start.
+
+    Args:
+        engine (Engine, optional): Engine to migrate. Defaults to db.engine,
+            which requires an app context.
+
+    Returns:
+        list: Versions applied by this call
+    """
+    engine = engine or db.engine
+    applied = []
+
+    for version, description, migrate in MIGRATIONS:
+        with engine.begin() as conn:
+            if engine.dialect.name == 'postgresql':
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': _PG_LOCK_KEY})
+            if version in applied_versions(conn):
+                continue
+
+            logger.info(f"Применение миграции {version}: {description}")
+            migrate(conn)
+            conn.execute(
+                text("INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :t)"),
+                {'v': version, 'd': description, 't': datetime.utcnow()}
+            )
+            applied.append(version)
+
+    return applied
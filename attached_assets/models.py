@@ -4,6 +4,8 @@ Database models for the VPN Telegram Bot application
 from datetime import datetime
 from app import db
 from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from vpn_utils import build_share_uri, load_config_data
 
 class Admin(UserMixin, db.Model):
     """Admin user model for web panel access"""
@@ -24,6 +26,10 @@ class TelegramUser(db.Model):
     registration_date = db.Column(db.DateTime, default=datetime.utcnow)
     is_blocked = db.Column(db.Boolean, default=False)
     
+    __table_args__ = (
+        db.Index('ix_telegram_user_registration_date', 'registration_date', 'id'),
+    )
+    
     # Relationships
     vpn_configs = db.relationship('VPNConfig', backref='owner', lazy=True)
     orders = db.relationship('Order', backref='user', lazy=True)
@@ -39,9 +45,19 @@ class VPNConfig(db.Model):
     x_ui_client_id = db.Column(db.Integer)  # Client ID in 3x-ui panel
     name = db.Column(db.String(100), nullable=False)
     config_data = db.Column(db.Text, nullable=False)  # Full configuration data
+    share_uri = db.Column(db.Text)  # Ready-to-import URI, derived from config_data
     valid_until = db.Column(db.DateTime, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Деактивирована в базе, но клиент в 3x-ui еще не отключен
+    xui_sync_pending = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    
+    __table_args__ = (
+        db.Index('ix_vpn_config_user_id_is_active', 'user_id', 'is_active'),
+        db.Index('ix_vpn_config_is_active_valid_until', 'is_active', 'valid_until'),
+        db.Index('ix_vpn_config_created_at', 'created_at', 'id'),
+        db.Index('ix_vpn_config_xui_sync_pending', 'xui_sync_pending', 'id'),
+    )
     
     def __repr__(self):
         return f'<VPNConfig {self.id} ({self.config_type})>'
@@ -49,6 +65,23 @@ class VPNConfig(db.Model):
     @property
     def is_expired(self):
         return datetime.utcnow() > self.valid_until
+    
+    def refresh_share_uri(self):
+        """Пересчитать share_uri из config_data"""
+        self.share_uri = build_share_uri(self.config_type, load_config_data(self.config_data), self.name)
+
+@event.listens_for(VPNConfig, 'before_insert')
+def _vpn_config_before_insert(mapper, connection, target):
+    target.refresh_share_uri()
+
+@event.listens_for(VPNConfig, 'before_update')
+def _vpn_config_before_update(mapper, connection, target):
+    # URI зависит только от данных, типа и имени конфигурации
+    state = inspect(target)
+    if target.share_uri is None or any(
+        state.attrs[name].history.has_changes() for name in ('config_data', 'config_type', 'name')
+    ):
+        target.refresh_share_uri()
 
 class Product(db.Model):
     """VPN subscription product options"""
@@ -60,6 +93,10 @@ class Product(db.Model):
     config_type = db.Column(db.String(20), nullable=False)  # VPN protocol type
     is_active = db.Column(db.Boolean, default=True)
     
+    __table_args__ = (
+        db.Index('ix_product_is_active', 'is_active'),
+    )
+    
     # Relationships
     orders = db.relationship('Order', backref='product', lazy=True)
     
@@ -77,6 +114,14 @@ class Order(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     paid_at = db.Column(db.DateTime)
     
+    __table_args__ = (
+        db.Index('ix_order_status_created_at', 'status', 'created_at'),
+        db.Index('ix_order_status_paid_at', 'status', 'paid_at'),
+        db.Index('ix_order_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_order_created_at', 'created_at', 'id'),
+        db.Index('ix_order_amount', 'amount', 'id'),
+    )
+    
     # Reference to created VPN config
     vpn_config = db.relationship('VPNConfig', backref='order', lazy=True, foreign_keys=[config_id])
     
@@ -102,3 +147,77 @@ class Settings(db.Model):
     
     def __repr__(self):
         return f'<Settings {self.key}>'
+
+class StatsCounter(db.Model):
+    """Precomputed dashboard counter for a metric and period"""
+    id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(50), nullable=False)
+    period = db.Column(db.String(10), nullable=False)  # 'total', 'YYYY-MM' or 'YYYY-MM-DD'
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+    amount = db.Column(db.Float, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.UniqueConstraint('metric', 'period', name='uq_stats_counter_metric_period'),
+    )
+    
+    def __repr__(self):
+        return f'<StatsCounter {self.metric} {self.period}: {self.count}>'
+
+class Broadcast(db.Model):
+    """Mass message to a user segment, sent by the bot in the background"""
+    id = db.Column(db.Integer, primary_key=True)
+    text = db.Column(db.Text, nullable=False)
+    parse_mode = db.Column(db.String(20))  # None or 'Markdown'
+    segment = db.Column(db.String(20), nullable=False, default='all')  # all, active, expiring
+    expiring_days = db.Column(db.Integer)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, paused, completed, cancelled
+    cursor_user_id = db.Column(db.Integer, nullable=False, default=0)  # Last processed TelegramUser.id
+    total = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    blocked = db.Column(db.Integer, nullable=False, default=0)  # Users who blocked the bot
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_broadcast_status', 'status'),
+    )
+    
+    @property
+    def processed(self):
+        return self.sent + self.failed + self.blocked
+    
+    @property
+    def progress(self):
+        """Доля обработанных получателей, 0..100"""
+        if not self.total:
+            return 100 if self.status == 'completed' else 0
+        return min(100, round(self.processed * 100 / self.total))
+    
+    def __repr__(self):
+        return f'<Broadcast {self.id} ({self.status})>'
+
+class Notification(db.Model):
+    """Outbox message written with the order change and sent by the bot"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)  # order_completed, order_cancelled, admin_order
+    chat_id = db.Column(db.BigInteger)  # None for admin notices - resolved when sent
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
+    config_id = db.Column(db.Integer, db.ForeignKey('vpn_config.id'))
+    text = db.Column(db.Text)
+    parse_mode = db.Column(db.String(20))
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_notification_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<Notification {self.id} {self.kind} ({self.status})>'
@@ -0,0 +1,362 @@
+"""
+Transactional outbox for order notifications
+
+Изменение статуса заказа и уведомление о нем записываются в одной
+транзакции: enqueue() только добавляет строку Notification в сессию, а
+коммитит ее вызывающий код вместе с заказом. Отправитель в event loop бота
+забирает созревшие строки пачками, отправляет их с повторными попытками и
+экспоненциальной задержкой, поэтому обработчики не ждут Telegram, а
+уведомление не теряется при сбое между коммитом и отправкой.
+
+Уведомления администратору о заказах, ожидающих подтверждения, не
+отправляются по одному: они копятся OUTBOX_DIGEST_DELAY секунд и уходят
+одной сводкой.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from app import db
+from models import Notification, Order, Product, TelegramUser
+import bot_db
+from rate_limit import KeyedRateLimiter
+from settings_snapshot import get_settings
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', '2'))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_RETRY_BASE = float(os.environ.get('OUTBOX_RETRY_BASE', '5'))
+OUTBOX_DIGEST_DELAY = int(os.environ.get('OUTBOX_DIGEST_DELAY', '60'))
+OUTBOX_RATE = float(os.environ.get('OUTBOX_RATE', '20'))
+
+ORDER_COMPLETED = 'order_completed'
+ORDER_CANCELLED = 'order_cancelled'
+ADMIN_ORDER = 'admin_order'
+
+
+def order_completed_text(order_id, valid_until):
+    """Текст уведомления пользователя о подтвержденном заказе"""
+    custom = get_settings().get('payment_confirmation_message')
+    if custom:
+        return custom
+    return (
+        "✅ *Ваш заказ подтвержден!*\n\n"
+        f"Заказ #{order_id} был успешно подтвержден администратором. "
+        f"Ваша VPN-конфигурация готова к использованию и будет действительна до {valid_until.strftime('%d.%m.%Y')}.\n\n"
+        f"Вы можете найти вашу конфигурацию в разделе «Мои конфигурации»."
+    )
+
+
+def enqueue(kind, chat_id=None, text=None, parse_mode=None, order_id=None, config_id=None, delay=0):
+    """
+    Add a notification to the current session without committing
+
+    The caller commits it together with the change it describes.
+
+    Args:
+        kind (str): ORDER_COMPLETED, ORDER_CANCELLED or ADMIN_ORDER
+        chat_id (int, optional): Recipient; None for admin notices
+        text (str, optional): Message text; admin notices are rendered when sent
+        parse_mode (str, optional): Telegram parse mode
+        order_id (int, optional): Related order
+        config_id (int, optional): Configuration to offer in the message
+        delay (int): Seconds before the notification becomes due
+
+    Returns:
+        Notification: The pending row
+    """
+    notification = Notification(
+        kind=kind,
+        chat_id=chat_id,
+        text=text,
+        parse_mode=parse_mode,
+        order_id=order_id,
+        config_id=config_id,
+        status='pending',
+        attempts=0,
+        next_attempt_at=datetime.utcnow() + timedelta(seconds=delay)
+    )
+    db.session.add(notification)
+    return notification
+
+
+def enqueue_order_completed(order, telegram_id, config_id, valid_until):
+    """Поставить в очередь уведомление пользователя о выданной конфигурации"""
+    return enqueue(
+        ORDER_COMPLETED,
+        chat_id=telegram_id,
+        text=order_completed_text(order.id, valid_until),
+        parse_mode='Markdown',
+        order_id=order.id,
+        config_id=config_id
+    )
+
+
+def enqueue_order_cancelled(order, telegram_id):
+    """Поставить в очередь уведомление пользователя об отмене заказа"""
+    return enqueue(
+        ORDER_CANCELLED,
+        chat_id=telegram_id,
+        text=f"❌ Заказ #{order.id} отменен администратором.\n\n"
+             "Если вы уже оплатили заказ, обратитесь в поддержку.",
+        order_id=order.id
+    )
+
+
+def enqueue_admin_order(order):
+    """Поставить заказ в следующую сводку для администратора"""
+    return enqueue(ADMIN_ORDER, order_id=order.id, delay=OUTBOX_DIGEST_DELAY)
+
+
+# -- функции для run_db (выполняются в пуле потоков бота) ----------------------
+
+def _due_batch(limit):
+    """
+    Load due notifications
+
+    Admin notices are taken all at once as soon as the oldest is due, so
+    orders that arrived during the digest delay go out in one message.
+
+    Returns:
+        tuple: (messages, digest) - messages is a list of dicts for direct
+            sends, digest is None or a dict with 'ids', 'chat_id' and 'orders'
+    """
+    now = datetime.utcnow()
+    rows = Notification.query.filter(
+        Notification.status == 'pending',
+        Notification.next_attempt_at <= now
+    ).order_by(Notification.next_attempt_at, Notification.id).limit(limit).all()
+
+    messages = [
+        {
+            'id': row.id,
+            'kind': row.kind,
+            'chat_id': row.chat_id,
+            'text': row.text,
+            'parse_mode': row.parse_mode,
+            'config_id': row.config_id,
+            'attempts': row.attempts,
+        }
+        for row in rows if row.kind != ADMIN_ORDER
+    ]
+
+    digest = None
+    if any(row.kind == ADMIN_ORDER for row in rows):
+        pending = Notification.query.filter(
+            Notification.status == 'pending',
+            Notification.kind == ADMIN_ORDER
+        ).all()
+        order_ids = {row.order_id for row in pending}
+        orders = db.session.query(Order, TelegramUser, Product).join(
+            TelegramUser, Order.user_id == TelegramUser.id
+        ).join(
+            Product, Order.product_id == Product.id
+        ).filter(
+            Order.id.in_(order_ids),
+            Order.status == 'awaiting_confirmation'
+        ).order_by(Order.id).all()
+        digest = {
+            'ids': [row.id for row in pending],
+            'chat_id': get_settings().admin_telegram_id,
+            'attempts': max(row.attempts for row in pending),
+            'orders': [
+                {
+                    'id': order.id,
+                    'user': f"@{user.username}" if user.username else (user.first_name or str(user.telegram_id)),
+                    'product': product.name,
+                    'amount': order.amount,
+                }
+                for order, user, product in orders
+            ],
+        }
+
+    return messages, digest
+
+
+def _record(ids, outcome, error=None, attempts=0, retry_in=None):
+    """
+    Store the outcome of a send
+
+    Args:
+        ids (list): Notification IDs sent together
+        outcome (str): 'sent', 'failed' or 'retry'
+        error (str, optional): Error to keep for the admin panel
+        attempts (int): Attempts made so far, including this one
+        retry_in (float, optional): Delay before the next attempt for 'retry'
+    """
+    now = datetime.utcnow()
+    values = {'attempts': attempts, 'last_error': error}
+    if outcome == 'sent':
+        values.update(status='sent', sent_at=now)
+    elif outcome == 'retry' and attempts < OUTBOX_MAX_ATTEMPTS:
+        values['next_attempt_at'] = now + timedelta(seconds=retry_in)
+    else:
+        values['status'] = 'failed'
+
+    Notification.query.filter(
+        Notification.id.in_(ids),
+        Notification.status == 'pending'
+    ).update(values, synchronize_session=False)
+    db.session.commit()
+
+
+def render_digest(orders):
+    """Текст сводки заказов, ожидающих подтверждения"""
+    lines = [f"🔔 *Новые заказы ожидают подтверждения: {len(orders)}*\n"]
+    for order in orders:
+        lines.append(f"#{order['id']} — {order['user']} — {order['product']} — {order['amount']} ₽")
+    return "\n".join(lines)
+
+
+class OutboxSender:
+    """Drains the notification outbox from the bot's event loop"""
+
+    def __init__(self, poll_interval=OUTBOX_POLL_INTERVAL, batch_size=OUTBOX_BATCH_SIZE):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.limiter = KeyedRateLimiter(OUTBOX_RATE, 1)
+        self.bot = None
+        self.stats = {'sent': 0, 'failed': 0, 'retried': 0}
+        self._task = None
+        self._wakeup = None
+
+    def wake(self):
+        """Проверить очередь сейчас, не дожидаясь следующего опроса"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _markup(self, message):
+        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+        if message['kind'] == ADMIN_ORDER:
+            return InlineKeyboardMarkup([[
+                InlineKeyboardButton("📋 Открыть заказы", callback_data="admin_orders_new")
+            ]])
+        if message['config_id']:
+            return InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔑 Получить конфигурацию", callback_data=f"get_config_{message['config_id']}")
+            ]])
+        return None
+
+    async def _send(self, message):
+        """
+        Send one message
+
+        Returns:
+            tuple: (outcome, error, retry_in) - outcome is 'sent', 'failed',
+                'retry' or 'throttled' (flood limit, not counted as an attempt)
+        """
+        from telegram.error import BadRequest, Forbidden, RetryAfter
+
+        await self.limiter.acquire(message['chat_id'])
+        try:
+            try:
+                await self.bot.send_message(
+                    chat_id=message['chat_id'],
+                    text=message['text'],
+                    parse_mode=message['parse_mode'],
+                    reply_markup=self._markup(message)
+                )
+            except BadRequest as e:
+                if not message['parse_mode'] or "parse entities" not in str(e):
+                    raise
+                # Текст из настроек может содержать некорректную разметку
+                await self.bot.send_message(
+                    chat_id=message['chat_id'],
+                    text=message['text'],
+                    reply_markup=self._markup(message)
+                )
+            return 'sent', None, None
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            self.limiter.global_bucket.pause(retry_after)
+            return 'throttled', str(e), retry_after
+        except (Forbidden, BadRequest) as e:
+            return 'failed', str(e), None
+        except Exception as e:
+            return 'retry', str(e), OUTBOX_RETRY_BASE * 2 ** message['attempts']
+
+    async def _deliver(self, ids, message):
+        outcome, error, retry_in = await self._send(message)
+        if outcome == 'throttled':
+            outcome, attempts = 'retry', message['attempts']
+        else:
+            attempts = message['attempts'] + 1
+            if outcome == 'retry' and attempts >= OUTBOX_MAX_ATTEMPTS:
+                outcome = 'failed'
+        self.stats['retried' if outcome == 'retry' else outcome] += len(ids)
+        if outcome != 'sent':
+            logger.warning(f"Уведомление {ids} ({message['kind']}): {outcome}, {error}")
+        await bot_db.run_db(_record, ids, outcome, error, attempts, retry_in)
+
+    async def drain(self):
+        """
+        Send everything that is due
+
+        Returns:
+            int: Number of notifications processed
+        """
+        processed = 0
+        while True:
+            messages, digest = await bot_db.run_db(_due_batch, self.batch_size)
+            if digest is not None:
+                if not digest['orders']:
+                    # Все заказы уже обработаны - сообщать не о чем
+                    await bot_db.run_db(_record, digest['ids'], 'sent', attempts=digest['attempts'])
+                elif not digest['chat_id']:
+                    await bot_db.run_db(_record, digest['ids'], 'failed', "admin_telegram_id не задан", digest['attempts'])
+                else:
+                    await self._deliver(digest['ids'], {
+                        'kind': ADMIN_ORDER,
+                        'chat_id': digest['chat_id'],
+                        'text': render_digest(digest['orders']),
+                        'parse_mode': 'Markdown',
+                        'config_id': None,
+                        'attempts': digest['attempts'],
+                    })
+                processed += len(digest['ids'])
+
+            for message in messages:
+                await self._deliver([message['id']], message)
+            processed += len(messages)
+
+            if len(messages) < self.batch_size:
+                return processed
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self.drain()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка отправки уведомлений: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self, bot):
+        """Начать отправку уведомлений в текущем event loop"""
+        self.bot = bot
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run_forever())
+
+    async def stop(self):
+        """Остановить отправку; неотправленные уведомления останутся в очереди"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self._wakeup = None
+
+
+outbox_sender = OutboxSender()
@@ -0,0 +1,127 @@
+"""
+Keyset (cursor) pagination for admin list pages
+
+Страница выбирается условием (sort_column, id) < (значение, id) по индексу,
+а не OFFSET, поэтому стоимость страницы не зависит от размера таблицы.
+Курсор - непрозрачная строка с ключом первой или последней строки страницы.
+"""
+import base64
+import json
+import os
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', '50'))
+ADMIN_MAX_PAGE_SIZE = int(os.environ.get('ADMIN_MAX_PAGE_SIZE', '500'))
+
+
+def encode_cursor(values):
+    """Закодировать значения ключа строки в курсор"""
+    encoded = [{'dt': v.isoformat()} if isinstance(v, datetime) else v for v in values]
+    return base64.urlsafe_b64encode(json.dumps(encoded).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """
+    Decode a cursor produced by encode_cursor
+
+    Returns:
+        list: Key values, or None if the cursor is missing or malformed
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+        return [datetime.fromisoformat(v['dt']) if isinstance(v, dict) else v for v in values]
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+def page_size_from(args):
+    """
+    Get the page size from request arguments
+
+    Returns:
+        int: per_page argument clamped to 1..ADMIN_MAX_PAGE_SIZE, or ADMIN_PAGE_SIZE
+    """
+    try:
+        per_page = int(args.get('per_page', ADMIN_PAGE_SIZE))
+    except ValueError:
+        per_page = ADMIN_PAGE_SIZE
+    return max(1, min(per_page, ADMIN_MAX_PAGE_SIZE))
+
+
+class KeysetPage:
+    """One page of rows with cursors to its neighbours"""
+
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def keyset_paginate(query, sort_column, id_column, descending=True, per_page=ADMIN_PAGE_SIZE,
+                    after=None, before=None):
+    """
+    Fetch one page of a query ordered by (sort_column, id_column)
+
+    Args:
+        query (Query): Filtered query without ORDER BY
+        sort_column: Model attribute the page is sorted by
+        id_column: Unique tiebreaker attribute, normally the primary key
+        descending (bool): Sort direction
+        per_page (int): Rows per page
+        after (str, optional): Cursor of the last row of the previous page
+        before (str, optional): Cursor of the first row of the next page;
+            takes precedence over after
+
+    Returns:
+        KeysetPage: The page
+    """
+    backwards = decode_cursor(before) is not None
+    cursor = decode_cursor(before) if backwards else decode_cursor(after)
+
+    # Назад по убыванию - это вперед по возрастанию, и наоборот
+    scan_descending = descending != backwards
+    key = tuple_(sort_column, id_column)
+    if cursor is not None:
+        query = query.filter(key < tuple_(*cursor) if scan_descending else key > tuple_(*cursor))
+    if scan_descending:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(sort_column.asc(), id_column.asc())
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def row_cursor(row):
+        return encode_cursor([getattr(row, sort_column.key), getattr(row, id_column.key)])
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or backwards:
+            next_cursor = row_cursor(rows[-1])
+        if (has_more and backwards) or (cursor is not None and not backwards):
+            prev_cursor = row_cursor(rows[0])
+
+    return KeysetPage(rows, per_page, next_cursor, prev_cursor)
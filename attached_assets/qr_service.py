@@ -0,0 +1,143 @@
+"""
+QR code rendering and delivery for VPN configurations
+
+PNG рисуется в пуле потоков, чтобы не блокировать event loop бота, и
+кэшируется по sha256 от URI. После первой отправки Telegram возвращает
+file_id фотографии - он запоминается, и повторные запросы того же URI
+отправляются по file_id без загрузки байтов.
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import qrcode
+
+from cache import TTLCache
+from metrics import register_cache
+
+logger = logging.getLogger(__name__)
+
+QR_WORKERS = int(os.environ.get('QR_WORKERS', '2'))
+QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE', '1000'))
+QR_PNG_TTL = int(os.environ.get('QR_PNG_TTL', '3600'))
+QR_FILE_ID_TTL = int(os.environ.get('QR_FILE_ID_TTL', str(30 * 24 * 3600)))
+
+PNG_NS = 'qr_png'
+FILE_ID_NS = 'qr_file_id'
+
+
+def content_key(data):
+    """Ключ кэша: sha256 от содержимого QR-кода"""
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def render_qr_png(data, box_size=8, border=2):
+    """
+    Render a QR code as PNG
+
+    Args:
+        data (str): Content to encode
+        box_size (int): Pixels per module
+        border (int): Quiet zone width in modules
+
+    Returns:
+        bytes: PNG image
+    """
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    buffer = io.BytesIO()
+    qr.make_image().save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class QRService:
+    """Renders, caches and sends QR codes"""
+
+    def __init__(self, max_workers=QR_WORKERS, cache_size=QR_CACHE_SIZE):
+        """
+        Initialize the service
+
+        Args:
+            max_workers (int): Rendering threads
+            cache_size (int): Maximum cached PNGs and file IDs together
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='qr-render')
+        self.cache = TTLCache(
+            max_size=cache_size,
+            ttls={PNG_NS: QR_PNG_TTL, FILE_ID_NS: QR_FILE_ID_TTL}
+        )
+        self._inflight = {}  # {key: asyncio.Future} - один рендер на одинаковый URI
+        self.stats = {'rendered': 0, 'sent_by_file_id': 0, 'uploaded': 0}
+
+    async def get_png(self, data):
+        """
+        Get the PNG for data, rendering it in the worker pool on a miss
+
+        Returns:
+            bytes: PNG image
+        """
+        key = content_key(data)
+        png = self.cache.get(PNG_NS, key)
+        if png is not None:
+            return png
+
+        future = self._inflight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._inflight[key] = loop.run_in_executor(self._executor, render_qr_png, data)
+            try:
+                png = await future
+            finally:
+                del self._inflight[key]
+            self.cache.set(PNG_NS, key, png)
+            self.stats['rendered'] += 1
+            return png
+
+        return await asyncio.shield(future)
+
+    async def reply_qr(self, message, data, caption=None):
+        """
+        Reply to a message with the QR code for data
+
+        Sends by the remembered file_id when there is one; otherwise uploads
+        the PNG and remembers the file_id Telegram returns.
+
+        Args:
+            message (telegram.Message): Message to reply to
+            data (str): Content to encode, normally a share URI
+            caption (str, optional): Photo caption
+        """
+        from telegram.error import BadRequest
+
+        key = content_key(data)
+        file_id = self.cache.get(FILE_ID_NS, key)
+        if file_id is not None:
+            try:
+                await message.reply_photo(photo=file_id, caption=caption)
+                self.stats['sent_by_file_id'] += 1
+                return
+            except BadRequest as e:
+                # file_id больше недействителен - загружаем заново
+                logger.warning(f"Не удалось отправить QR-код по file_id: {e}")
+                self.cache.delete(FILE_ID_NS, key)
+
+        png = await self.get_png(data)
+        sent = await message.reply_photo(photo=png, caption=caption)
+        self.stats['uploaded'] += 1
+        if sent.photo:
+            self.cache.set(FILE_ID_NS, key, sent.photo[-1].file_id)
+            # Байты больше не нужны, пока известен file_id
+            self.cache.delete(PNG_NS, key)
+
+    def shutdown(self):
+        """Остановить пул рендеринга"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+qr_service = QRService()
+register_cache('qr', qr_service.cache)
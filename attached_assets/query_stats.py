@@ -0,0 +1,165 @@
+"""
+Per-update and per-request SQL query accounting
+
+Перехватчики before/after_cursor_execute движка SQLAlchemy считают
+запросы и время в базе для текущей области - обработчика бота или
+маршрута Flask. Область хранится в contextvars; run_db копирует контекст в
+пул потоков, поэтому запросы из потоков бота попадают в область
+обработчика, который их вызвал.
+
+Запросы дольше DB_SLOW_QUERY_MS записываются в лог с именем обработчика
+или маршрута, а области, сделавшие больше DB_QUERY_COUNT_WARN запросов,
+- с предупреждением о возможном N+1.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DB_SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', '200'))
+DB_QUERY_COUNT_WARN = int(os.environ.get('DB_QUERY_COUNT_WARN', '25'))
+# Длина текста запроса в логе медленных запросов
+DB_SLOW_QUERY_MAX_LENGTH = int(os.environ.get('DB_SLOW_QUERY_MAX_LENGTH', '1000'))
+
+DB_QUERIES_PER_SCOPE = REGISTRY.histogram(
+    'db_queries_per_scope', 'SQL statements per bot handler call or Flask request', ['kind', 'name'],
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100)
+)
+DB_TIME_PER_SCOPE = REGISTRY.histogram(
+    'db_time_per_scope_seconds', 'Time spent in SQL per bot handler call or Flask request', ['kind', 'name']
+)
+DB_SLOW_QUERIES = REGISTRY.counter(
+    'db_slow_queries_total', 'SQL statements slower than DB_SLOW_QUERY_MS', ['kind', 'name']
+)
+
+_current_scope = contextvars.ContextVar('query_scope', default=None)
+
+
+class QueryScope:
+    """Query counters of one handler call or request"""
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.queries = 0
+        self.duration = 0.0
+        self.slow = 0
+        self.started_at = time.perf_counter()
+        # Запросы одной области могут идти параллельно из нескольких потоков run_db
+        self._lock = threading.Lock()
+
+    def record(self, elapsed, slow):
+        with self._lock:
+            self.queries += 1
+            self.duration += elapsed
+            if slow:
+                self.slow += 1
+
+    @property
+    def label(self):
+        return f"{self.kind} {self.name}"
+
+
+def current_scope():
+    """Текущая область учета запросов или None"""
+    return _current_scope.get()
+
+
+def begin(kind, name):
+    """
+    Start a scope in the current context
+
+    Returns:
+        tuple: (scope, token) - pass the token to finish()
+    """
+    scope = QueryScope(kind, name)
+    return scope, _current_scope.set(scope)
+
+
+def finish(scope, token):
+    """Закрыть область, записать метрики и предупредить о лишних запросах"""
+    _current_scope.reset(token)
+    DB_QUERIES_PER_SCOPE.observe(scope.queries, kind=scope.kind, name=scope.name)
+    DB_TIME_PER_SCOPE.observe(scope.duration, kind=scope.kind, name=scope.name)
+
+    total_ms = (time.perf_counter() - scope.started_at) * 1000
+    if scope.queries > DB_QUERY_COUNT_WARN:
+        logger.warning(
+            f"{scope.label}: {scope.queries} запросов к БД, {scope.duration * 1000:.1f} мс в БД "
+            f"из {total_ms:.1f} мс - возможен N+1"
+        )
+    elif scope.queries:
+        logger.debug(
+            f"{scope.label}: {scope.queries} запросов к БД, {scope.duration * 1000:.1f} мс в БД "
+            f"из {total_ms:.1f} мс"
+        )
+
+
+@contextmanager
+def scope(kind, name):
+    """Учитывать запросы внутри блока в отдельной области"""
+    query_scope, token = begin(kind, name)
+    try:
+        yield query_scope
+    finally:
+        finish(query_scope, token)
+
+
+def instrument_engine(engine):
+    """Подключить учет запросов и журнал медленных запросов к движку"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_stats_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_stats_started'].pop()
+        elapsed = time.perf_counter() - started
+        slow = elapsed * 1000 >= DB_SLOW_QUERY_MS
+
+        query_scope = _current_scope.get()
+        if query_scope is not None:
+            query_scope.record(elapsed, slow)
+
+        if slow:
+            where = query_scope.label if query_scope is not None else "вне обработчика"
+            DB_SLOW_QUERIES.inc(
+                kind=query_scope.kind if query_scope is not None else 'background',
+                name=query_scope.name if query_scope is not None else '-'
+            )
+            text = ' '.join(statement.split())
+            if len(text) > DB_SLOW_QUERY_MAX_LENGTH:
+                text = text[:DB_SLOW_QUERY_MAX_LENGTH] + '...'
+            logger.warning(f"Медленный запрос ({elapsed * 1000:.1f} мс) в {where}: {text}")
+
+    # Курсор, завершившийся ошибкой, не вызывает after_cursor_execute
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None:
+            stack = connection.info.get('query_stats_started')
+            if stack:
+                stack.pop()
+
+
+def init_app(app):
+    """Открывать область учета запросов на каждый запрос Flask"""
+    from flask import g, request
+
+    @app.before_request
+    def _query_stats_begin():
+        g.query_scope = begin('route', request.endpoint or 'unmatched')
+
+    @app.teardown_request
+    def _query_stats_finish(exc):
+        started = g.pop('query_scope', None)
+        if started is not None:
+            finish(*started)
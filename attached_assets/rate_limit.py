@@ -0,0 +1,116 @@
+"""
+Token-bucket rate limiting
+
+Ведро пополняется со скоростью rate токенов в секунду до capacity. Для
+исходящих сообщений бота используется общий лимит и лимит на каждый чат,
+как того требует Telegram (около 30 сообщений в секунду всего и одно в
+секунду в один чат).
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Token bucket; thread-safe for try_acquire, awaitable via acquire"""
+
+    def __init__(self, rate, capacity=None):
+        """
+        Initialize the bucket
+
+        Args:
+            rate (float): Tokens added per second
+            capacity (float, optional): Maximum burst size. Defaults to rate,
+                but at least 1.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens if available
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise seconds until they
+                would be available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0.0
+            return (tokens - self.tokens) / self.rate
+
+    async def acquire(self, tokens=1):
+        """Дождаться и забрать токены"""
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Опустошить ведро так, чтобы следующий токен появился через seconds"""
+        with self._lock:
+            self.updated_at = time.monotonic()
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+
+class KeyedRateLimiter:
+    """
+    Global bucket plus one bucket per key (e.g. chat ID)
+
+    Per-key buckets are kept in LRU order and the oldest are dropped beyond
+    max_keys; a dropped bucket is simply recreated full. A global_rate of
+    None limits keys only.
+    """
+
+    def __init__(self, global_rate, per_key_rate, per_key_capacity=1, max_keys=10000):
+        self.global_bucket = TokenBucket(global_rate) if global_rate is not None else None
+        self.per_key_rate = per_key_rate
+        self.per_key_capacity = per_key_capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def bucket(self, key):
+        """Получить ведро ключа, создав его при необходимости"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.per_key_rate, self.per_key_capacity)
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    async def acquire(self, key):
+        """Дождаться разрешения на отправку в key с учетом обоих лимитов"""
+        await self.bucket(key).acquire()
+        if self.global_bucket is not None:
+            await self.global_bucket.acquire()
+
+    def try_acquire(self, key):
+        """
+        Take a token for key without waiting
+
+        Returns:
+            float: 0 if allowed, otherwise seconds until the key's next token
+        """
+        wait = self.bucket(key).try_acquire()
+        if wait == 0 and self.global_bucket is not None:
+            wait = self.global_bucket.try_acquire()
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Utility script to replay recorded Telegram updates against the webhook endpoint
+
+Each input file contains either one Update JSON object, a JSON array of
+updates, or JSON Lines with one update per line.
+
+Example:
+    python replay_updates.py updates.jsonl --url http://localhost:5000/telegram/webhook
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+import requests
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+def load_updates(path):
+    """
+    Load updates from a file
+
+    Args:
+        path (str): Path to a JSON or JSON Lines file
+
+    Returns:
+        list: Update dictionaries
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+
+    if not content:
+        return []
+
+    try:
+        data = json.loads(content)
+        return data if isinstance(data, list) else [data]
+    except ValueError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+def main():
+    """
+    Main entry point
+    """
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates to the bot webhook")
+    parser.add_argument('files', nargs='+', help="Files with recorded Update JSON")
+    parser.add_argument('--url', default=os.environ.get('REPLAY_WEBHOOK_URL', 'http://localhost:5000/telegram/webhook'))
+    parser.add_argument('--secret', default=os.environ.get('TELEGRAM_WEBHOOK_SECRET'))
+    args = parser.parse_args()
+
+    headers = {}
+    if args.secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = args.secret
+
+    failed = 0
+    with requests.Session() as session:
+        for path in args.files:
+            for update in load_updates(path):
+                response = session.post(args.url, json=update, headers=headers, timeout=10)
+                if response.status_code == 200:
+                    logger.info(f"Update {update.get('update_id')} accepted")
+                else:
+                    failed += 1
+                    logger.error(f"Update {update.get('update_id')} rejected: {response.status_code} {response.text}")
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+Versioned in-memory snapshot of the Settings table
+
+Таблица Settings читается целиком один раз и хранится в неизменяемом
+объекте. Снимок обновляется только после сохранения настроек в админ-панели,
+поэтому проверки вроде admin_telegram_id становятся поиском в словаре.
+"""
+import logging
+import threading
+from datetime import datetime
+from types import MappingProxyType
+
+from app import app
+from models import Settings
+import cache_bus
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_CHANNEL = 'settings'
+
+
+class SettingsSnapshot:
+    """Immutable view of all settings at a given version"""
+
+    __slots__ = ('_values', 'version', 'loaded_at')
+
+    def __init__(self, values, version):
+        """
+        Initialize the snapshot
+
+        Args:
+            values (dict): Mapping of setting key to value
+            version (int): Snapshot version, increased on every reload
+        """
+        self._values = MappingProxyType(dict(values))
+        self.version = version
+        self.loaded_at = datetime.utcnow()
+
+    def get(self, key, default=None):
+        """
+        Get a setting value
+
+        Empty values are treated as missing, as the handlers always did.
+        """
+        value = self._values.get(key)
+        return value if value else default
+
+    def get_int(self, key, default=None):
+        """Получить настройку как целое число"""
+        value = self.get(key)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            logger.warning(f"Неверный числовой формат настройки {key}: {value}")
+            return default
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def as_dict(self):
+        """Вернуть копию всех настроек"""
+        return dict(self._values)
+
+    @property
+    def admin_telegram_id(self):
+        return self.get_int('admin_telegram_id')
+
+    @property
+    def vpn_server_address(self):
+        return self.get('vpn_server_address', "127.0.0.1")
+
+    @property
+    def vpn_server_port(self):
+        return self.get_int('vpn_server_port', 443)
+
+    @property
+    def welcome_message(self):
+        return self.get('welcome_message')
+
+    def __repr__(self):
+        return f'<SettingsSnapshot v{self.version} ({len(self._values)} keys)>'
+
+
+_snapshot = None
+_lock = threading.Lock()
+
+
+def reload():
+    """
+    Load the Settings table into a new snapshot
+
+    Returns:
+        SettingsSnapshot: The new current snapshot
+    """
+    global _snapshot
+
+    with app.app_context():
+        values = {row.key: row.value for row in Settings.query.all()}
+
+    with _lock:
+        version = _snapshot.version + 1 if _snapshot else 1
+        _snapshot = SettingsSnapshot(values, version)
+
+    logger.info(f"Загружен снимок настроек версии {version}")
+    return _snapshot
+
+
+def get_settings():
+    """
+    Get the current settings snapshot, loading it on first use
+
+    Returns:
+        SettingsSnapshot: Current snapshot
+    """
+    snapshot = _snapshot
+    if snapshot is None:
+        snapshot = reload()
+    return snapshot
+
+
+def publish_reload():
+    """Обновить снимок в текущем процессе и оповестить остальные процессы"""
+    snapshot = reload()
+    cache_bus.get_bus().publish(SETTINGS_CHANNEL, snapshot.version)
+    return snapshot
+
+
+def subscribe(bus):
+    """Перезагружать снимок при сохранении настроек в другом процессе"""
+    bus.subscribe(SETTINGS_CHANNEL, lambda key: reload())
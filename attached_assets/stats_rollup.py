@@ -0,0 +1,178 @@
+"""
+Incrementally maintained counters for the admin dashboard
+
+Счетчики хранятся в таблице StatsCounter по периодам ('total', месяц, день)
+и увеличиваются в той же транзакции, что и изменение заказа или
+конфигурации. Панель управления читает готовые значения одним запросом;
+rebuild() пересчитывает все счетчики из исходных таблиц.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import delete, func, insert, select
+
+from app import db
+from models import Order, StatsCounter, TelegramUser, VPNConfig
+
+logger = logging.getLogger(__name__)
+
+# Метрики
+USERS = 'users'
+ORDERS_COMPLETED = 'orders_completed'  # count и amount, по дате оплаты
+ORDERS_CANCELLED = 'orders_cancelled'  # по дате создания заказа
+CONFIGS_CREATED = 'configs_created'
+CONFIGS_ACTIVE = 'configs_active'  # только 'total'
+
+TOTAL = 'total'
+
+
+def periods_for(when):
+    """Периоды, в которые попадает событие: total, месяц и день"""
+    if when is None:
+        return [TOTAL]
+    return [TOTAL, when.strftime('%Y-%m'), when.strftime('%Y-%m-%d')]
+
+
+def _upsert(conn, rows):
+    """Прибавить count/amount к счетчикам, создавая недостающие строки"""
+    table = StatsCounter.__table__
+    # Колонка count затеняется методом ColumnCollection.count, берем по имени
+    count_col, amount_col = table.c['count'], table.c['amount']
+    dialect = conn.dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        stmt = dialect_insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.metric, table.c.period],
+            set_={
+                'count': count_col + stmt.excluded['count'],
+                'amount': amount_col + stmt.excluded['amount'],
+            }
+        )
+        conn.execute(stmt)
+        return
+
+    for row in rows:
+        result = conn.execute(
+            table.update()
+            .where(table.c.metric == row['metric'], table.c.period == row['period'])
+            .values({count_col: count_col + row['count'], amount_col: amount_col + row['amount']})
+        )
+        if result.rowcount == 0:
+            conn.execute(insert(table).values(**row))
+
+
+def bump(metric, count=1, amount=0.0, when=None):
+    """
+    Add to a counter within the current session transaction
+
+    The change is committed or rolled back together with the caller's
+    changes, so counters never drift from the rows they describe.
+
+    Args:
+        metric (str): Metric name
+        count (int): Count delta, may be negative
+        amount (float): Amount delta
+        when (datetime, optional): Event time; if None only 'total' is updated
+    """
+    rows = [
+        {'metric': metric, 'period': period, 'count': count, 'amount': amount or 0.0}
+        for period in periods_for(when)
+    ]
+    _upsert(db.session.connection(), rows)
+
+
+def dashboard_counters(now=None):
+    """
+    Read the dashboard values with a single query
+
+    Returns:
+        dict: user_count, active_configs, total_revenue and monthly_revenue
+    """
+    month = (now or datetime.utcnow()).strftime('%Y-%m')
+    rows = db.session.execute(
+        select(StatsCounter.metric, StatsCounter.period, StatsCounter.count, StatsCounter.amount)
+        .where(
+            StatsCounter.metric.in_([USERS, CONFIGS_ACTIVE, ORDERS_COMPLETED]),
+            StatsCounter.period.in_([TOTAL, month])
+        )
+    ).all()
+    values = {(metric, period): (count, amount) for metric, period, count, amount in rows}
+
+    def get(metric, period, field):
+        entry = values.get((metric, period))
+        if entry is None:
+            return 0
+        return entry[0] if field == 'count' else entry[1]
+
+    return {
+        'user_count': get(USERS, TOTAL, 'count'),
+        'active_configs': get(CONFIGS_ACTIVE, TOTAL, 'count'),
+        'total_revenue': get(ORDERS_COMPLETED, TOTAL, 'amount'),
+        'monthly_revenue': get(ORDERS_COMPLETED, month, 'amount'),
+    }
+
+
+def _day(value):
+    # SQLite возвращает date() строкой, PostgreSQL - объектом date
+    return str(value) if value is not None else None
+
+
+def rebuild(conn):
+    """
+    Recompute all counters from the source tables
+
+    Args:
+        conn (Connection): Connection inside a transaction
+
+    Returns:
+        int: Number of counter rows written
+    """
+    totals = {}
+
+    def add(metric, day, count, amount=0.0):
+        periods = [TOTAL] if day is None else [TOTAL, day[:7], day]
+        for period in periods:
+            entry = totals.setdefault((metric, period), [0, 0.0])
+            entry[0] += count
+            entry[1] += amount or 0.0
+
+    users = conn.execute(select(func.count(TelegramUser.id))).scalar() or 0
+    add(USERS, None, users)
+
+    active = conn.execute(
+        select(func.count(VPNConfig.id)).where(VPNConfig.is_active == True)
+    ).scalar() or 0
+    add(CONFIGS_ACTIVE, None, active)
+
+    day = func.date(Order.paid_at)
+    for row in conn.execute(
+        select(day, func.count(Order.id), func.sum(Order.amount))
+        .where(Order.status == 'completed').group_by(day)
+    ):
+        add(ORDERS_COMPLETED, _day(row[0]), row[1], row[2])
+
+    day = func.date(Order.created_at)
+    for row in conn.execute(
+        select(day, func.count(Order.id)).where(Order.status == 'cancelled').group_by(day)
+    ):
+        add(ORDERS_CANCELLED, _day(row[0]), row[1])
+
+    day = func.date(VPNConfig.created_at)
+    for row in conn.execute(select(day, func.count(VPNConfig.id)).group_by(day)):
+        add(CONFIGS_CREATED, _day(row[0]), row[1])
+
+    conn.execute(delete(StatsCounter.__table__))
+    rows = [
+        {'metric': metric, 'period': period, 'count': count, 'amount': amount}
+        for (metric, period), (count, amount) in totals.items()
+    ]
+    if rows:
+        conn.execute(insert(StatsCounter.__table__), rows)
+
+    logger.info(f"Счетчики статистики пересчитаны: {len(rows)} строк")
+    return len(rows)
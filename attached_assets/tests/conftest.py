@@ -0,0 +1,47 @@
+"""
+Test setup: a throwaway SQLite database and the admin templates
+
+app.py создает таблицы и применяет миграции при импорте, поэтому
+DATABASE_URL задается до первого импорта модулей приложения.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ASSETS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ASSETS_DIR)
+
+_db_dir = tempfile.mkdtemp(prefix='vpn_bot_tests_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+
+# Шаблоны админки лежат рядом с кодом без общего base.html
+BASE_TEMPLATE = """<!doctype html>
+<title>{% block title %}{% endblock %}</title>
+{% block content %}{% endblock %}
+{% block scripts %}{% endblock %}
+"""
+
+
+@pytest.fixture
+def app():
+    from jinja2 import ChoiceLoader, DictLoader, FileSystemLoader, PrefixLoader
+    from app import app as flask_app, db
+
+    flask_app.config.update(TESTING=True, LOGIN_DISABLED=True)
+    flask_app.jinja_env.loader = ChoiceLoader([
+        DictLoader({'base.html': BASE_TEMPLATE}),
+        PrefixLoader({'admin': FileSystemLoader(ASSETS_DIR)}),
+    ])
+
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
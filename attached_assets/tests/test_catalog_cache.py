@@ -0,0 +1,57 @@
+"""
+Catalog caching in the bot must not outlive a products invalidation
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+# Как в main.py: приложение Flask импортируется раньше бота
+import app  # noqa: F401
+import bot
+
+
+def product(product_id, name):
+    return SimpleNamespace(id=product_id, name=name, description='', price=100.0,
+                           duration_days=30, config_type='vless')
+
+
+@pytest.fixture(autouse=True)
+def empty_catalog_cache():
+    bot.invalidate_catalog()
+    yield
+    bot.invalidate_catalog()
+
+
+def test_view_read_before_invalidation_is_not_cached(monkeypatch):
+    catalogs = [[product(1, 'Old')], [product(1, 'New')]]
+
+    async def run_db(func, *args):
+        products = catalogs.pop(0)
+        if catalogs:
+            # Продукт изменили, пока бот читал старый список
+            bot.invalidate_catalog()
+        return products
+
+    monkeypatch.setattr(bot, 'run_db', run_db)
+
+    first = asyncio.run(bot.get_catalog_view())
+    assert 'Old' in first[0]
+    assert bot.bot_cache.get(bot.PRODUCTS_NS, 'catalog_view') is None
+    assert bot.bot_cache.get(bot.PRODUCTS_NS, 'active_products') is None
+
+    second = asyncio.run(bot.get_catalog_view())
+    assert 'New' in second[0]
+    assert bot.bot_cache.get(bot.PRODUCTS_NS, 'catalog_view') == second
+
+
+def test_bus_invalidation_drops_cached_view(monkeypatch):
+    async def run_db(func, *args):
+        return [product(1, 'Month')]
+
+    monkeypatch.setattr(bot, 'run_db', run_db)
+    view = asyncio.run(bot.get_catalog_view())
+    assert bot.bot_cache.get(bot.PRODUCTS_NS, 'catalog_view') == view
+
+    bot.invalidate_catalog('ignored-key')
+    assert bot.bot_cache.get(bot.PRODUCTS_NS, 'catalog_view') is None
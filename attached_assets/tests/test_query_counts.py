@@ -0,0 +1,120 @@
+"""
+Query counts of list views must not grow with the number of rows
+
+Каждый тест заполняет базу N и затем 2N записями и сравнивает число
+SQL-запросов: разница означает запрос на строку (N+1).
+"""
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+N = 3
+
+
+def seed(count, start=0):
+    """Add count users, each with an order awaiting confirmation, a completed order and a config"""
+    from app import db
+    from models import Order, Product, TelegramUser, VPNConfig
+
+    product = Product.query.first()
+    if product is None:
+        product = Product(name='Month', price=100.0, duration_days=30, config_type='vless')
+        db.session.add(product)
+        db.session.flush()
+
+    now = datetime.utcnow()
+    for number in range(start, start + count):
+        user = TelegramUser(telegram_id=1000 + number, username=f'user{number}', first_name=f'User {number}')
+        db.session.add(user)
+        db.session.flush()
+
+        config = VPNConfig(
+            user_id=user.id,
+            config_type='vless',
+            name=f'Config {number}',
+            config_data=json.dumps({'id': f'uuid-{number}', 'address': 'vpn.example.com', 'port': 443}),
+            valid_until=now + timedelta(days=30)
+        )
+        db.session.add(config)
+        db.session.flush()
+
+        db.session.add_all([
+            Order(user_id=user.id, product_id=product.id, amount=product.price,
+                  status='awaiting_confirmation'),
+            Order(user_id=user.id, product_id=product.id, amount=product.price,
+                  status='completed', paid_at=now, config_id=config.id),
+        ])
+    db.session.commit()
+    # Следующий замер не должен опираться на объекты, загруженные сидингом
+    db.session.expunge_all()
+
+
+@pytest.fixture
+def route_scopes(monkeypatch):
+    """Collect the query scopes of finished Flask requests"""
+    import query_stats
+
+    finished = []
+    original = query_stats.finish
+
+    def finish(scope, token):
+        finished.append(scope)
+        original(scope, token)
+
+    monkeypatch.setattr(query_stats, 'finish', finish)
+    return finished
+
+
+@pytest.fixture(autouse=True)
+def no_xui(monkeypatch):
+    import admin_panel
+
+    monkeypatch.setattr(admin_panel.xui_client, 'get_stats', lambda: {})
+
+
+def count_route_queries(client, route_scopes, url):
+    route_scopes.clear()
+    response = client.get(url)
+    assert response.status_code == 200, response.data[:500]
+    assert len(route_scopes) == 1
+    return route_scopes[0].queries
+
+
+@pytest.mark.parametrize('url', [
+    '/admin/orders',
+    '/admin/configs',
+    '/admin/users',
+    '/admin/dashboard',
+])
+def test_admin_list_query_count_is_constant(app, client, route_scopes, url):
+    seed(N)
+    small = count_route_queries(client, route_scopes, url)
+
+    seed(N, start=N)
+    large = count_route_queries(client, route_scopes, url)
+
+    assert small > 0
+    assert large == small, f'{url}: {small} запросов для {N} строк, {large} для {2 * N}'
+
+
+def test_orders_awaiting_confirmation_query_count_is_constant(app):
+    import query_stats
+    from bot_db import get_orders_awaiting_confirmation
+
+    def count_queries():
+        with query_stats.scope('test', 'get_orders_awaiting_confirmation') as scope:
+            orders = get_orders_awaiting_confirmation()
+            # Обращение к данным, которые бот выводит для каждого заказа
+            for order, user, product in orders:
+                (order.amount, order.created_at, user.telegram_id, user.username, product.name)
+        return len(orders), scope.queries
+
+    seed(N)
+    small_orders, small = count_queries()
+
+    seed(N, start=N)
+    large_orders, large = count_queries()
+
+    assert (small_orders, large_orders) == (N, 2 * N)
+    assert large == small == 1
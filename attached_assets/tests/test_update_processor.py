@@ -0,0 +1,75 @@
+"""
+Per-chat ordering of ChatOrderedUpdateProcessor under the PTB base semaphore
+"""
+import asyncio
+from types import SimpleNamespace
+
+from update_processor import ChatOrderedUpdateProcessor
+
+
+def make_update(chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), effective_user=None)
+
+
+def test_chat_order_and_one_permit_per_chat():
+    async def main():
+        processor = ChatOrderedUpdateProcessor(2)
+        log = []
+        release_a = asyncio.Event()
+
+        async def handle(name, gate=None):
+            log.append(f'start {name}')
+            if gate is not None:
+                await gate.wait()
+            log.append(f'end {name}')
+
+        updates = [
+            (make_update(1), handle('a1', release_a)),
+            (make_update(1), handle('a2')),
+            (make_update(1), handle('a3')),
+            (make_update(2), handle('b1')),
+        ]
+        tasks = [asyncio.create_task(processor.process_update(u, c)) for u, c in updates]
+
+        # Пока a1 ждет, очередь чата 1 занимает одно разрешение - b1 проходит
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert 'end b1' in log
+        assert 'start a2' not in log
+        assert processor.active_chats == 1
+        assert processor.processed == 1
+
+        release_a.set()
+        await asyncio.gather(*tasks)
+        return processor, log
+
+    processor, log = asyncio.run(main())
+
+    chat_a = [entry for entry in log if entry.endswith(('a1', 'a2', 'a3'))]
+    assert chat_a == ['start a1', 'end a1', 'start a2', 'end a2', 'start a3', 'end a3']
+    assert processor.processed == 4
+    assert processor.active_chats == 0
+
+
+def test_failed_update_does_not_stop_chat_queue():
+    async def main():
+        processor = ChatOrderedUpdateProcessor(4)
+        log = []
+
+        async def fail():
+            await asyncio.sleep(0)
+            raise RuntimeError('boom')
+
+        async def ok():
+            log.append('ok')
+
+        await asyncio.gather(
+            processor.process_update(make_update(1), fail()),
+            processor.process_update(make_update(1), ok()),
+        )
+        return processor, log
+
+    processor, log = asyncio.run(main())
+
+    assert log == ['ok']
+    assert processor.processed == 2
@@ -0,0 +1,79 @@
+"""
+Batch client writes against the fake 3x-ui panel
+
+Пакетные изменения клиентов не должны терять клиентов, добавленных
+параллельно, пока пакет ждет ответа панели.
+"""
+import asyncio
+import json
+import threading
+
+import pytest
+
+from async_x_ui_client import AsyncXUIClient
+from xui_fake_server import FaultInjector, create_server
+
+LATENCY_MS = 100
+
+
+@pytest.fixture
+def panel():
+    server = create_server(port=0, faults=FaultInjector(latency_ms=LATENCY_MS))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def panel_clients(server, inbound_id):
+    inbound = server.state.get_inbound(inbound_id)
+    return {client['email']: client for client in json.loads(inbound['settings'])['clients']}
+
+
+async def later(coro):
+    # Запрос приходит в панель между чтением инбаунда пакетом и его записью
+    await asyncio.sleep(LATENCY_MS / 2000)
+    return await coro
+
+
+async def with_client(server, work):
+    host, port = server.server_address
+    async with AsyncXUIClient(f'http://{host}:{port}', 'admin', 'admin') as client:
+        return await work(client)
+
+
+def test_update_clients_keeps_concurrently_added_client(panel):
+    async def work(client):
+        await client.add_client(1, 'old@x', 'vless')
+        return await asyncio.gather(
+            client.update_clients([{'inbound_id': 1, 'email': 'old@x', 'enable': False}]),
+            later(client.add_clients([{'inbound_id': 1, 'email': 'race@x', 'config_type': 'vless'}])),
+        )
+
+    updated, added = asyncio.run(with_client(panel, work))
+
+    assert updated.ok and added.ok
+    clients = panel_clients(panel, 1)
+    assert set(clients) == {'old@x', 'race@x'}
+    assert clients['old@x']['enable'] is False
+
+
+def test_remove_clients_keeps_concurrently_added_client(panel):
+    async def work(client):
+        await client.add_clients([
+            {'inbound_id': 1, 'email': 'gone@x', 'config_type': 'vless'},
+            {'inbound_id': 1, 'email': 'stay@x', 'config_type': 'vless'},
+        ])
+        return await asyncio.gather(
+            client.remove_clients([
+                {'inbound_id': 1, 'email': 'gone@x'},
+                {'inbound_id': 1, 'email': 'missing@x'},
+            ]),
+            later(client.add_client(1, 'race@x', 'vless')),
+        )
+
+    removed, _ = asyncio.run(with_client(panel, work))
+
+    assert [item['ok'] for item in removed.results] == [True, False]
+    assert set(panel_clients(panel, 1)) == {'stay@x', 'race@x'}
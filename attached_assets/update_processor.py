@@ -0,0 +1,98 @@
+"""
+Concurrent update processing with per-chat ordering for the Telegram bot
+
+Обновления разных пользователей обрабатываются параллельно (с общим
+ограничением), а обновления одного чата - строго по очереди, чтобы
+состояния ConversationHandler не гонялись друг с другом.
+"""
+import logging
+import os
+from collections import deque
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_UPDATES = int(os.environ.get('BOT_MAX_CONCURRENT_UPDATES', '32'))
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Update processor that keeps updates of the same chat strictly ordered
+
+    Updates are serialized by chat ID (falling back to user ID). The global
+    limit is the base class semaphore, taken by BaseUpdateProcessor.process_update
+    before do_process_update is called. An update whose chat already has an
+    update in progress is not awaited under that permit: it is queued behind
+    the chat's running update and the permit is released at once. The task
+    running the chat then processes the queue in order, so a burst from one
+    chat occupies at most one permit and never stalls other chats.
+
+    Updates of a chat are processed in the order they enter do_process_update,
+    which is the order the base semaphore grants permits in.
+    """
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._tails = {}  # {key: deque} - обновления, ждущие выполняемого обновления чата
+        self.processed = 0  # Обновлений, обработка которых завершена (в том числе с ошибкой)
+
+    @staticmethod
+    def ordering_key(update):
+        """
+        Get the key updates are serialized by
+
+        Returns:
+            int or None: Chat ID, user ID, or None if the update has neither
+        """
+        chat = getattr(update, 'effective_chat', None)
+        if chat is not None:
+            return chat.id
+        user = getattr(update, 'effective_user', None)
+        if user is not None:
+            return user.id
+        return None
+
+    async def _run(self, coroutine):
+        try:
+            await coroutine
+        except Exception as e:
+            # Ошибка одного обновления не должна останавливать очередь чата
+            logger.error(f"Ошибка при обработке обновления: {e}", exc_info=True)
+        finally:
+            self.processed += 1
+
+    async def do_process_update(self, update, coroutine):
+        key = self.ordering_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        waiting = self._tails.get(key)
+        if waiting is not None:
+            # Чат занят: обновление выполнит задача, обрабатывающая чат
+            waiting.append(coroutine)
+            return
+
+        waiting = self._tails[key] = deque()
+        try:
+            await self._run(coroutine)
+            while waiting:
+                await self._run(waiting.popleft())
+        finally:
+            del self._tails[key]
+            # Остаются только при отмене задачи
+            while waiting:
+                waiting.popleft().close()
+                self.processed += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def active_chats(self):
+        """Количество чатов с обновлениями в обработке или в очереди"""
+        return len(self._tails)
@@ -1,6 +1,7 @@
 """
 Utilities for VPN configuration generation and management
 """
+import ast
 import json
 import base64
 import uuid
@@ -159,32 +160,68 @@ def format_trojan_config(config):
     
     return f"trojan://{password}@{address}:{port}{params_part}#{config.get('name', 'VPN Config')}"
 
-def format_config_for_user(vpn_config):
+def load_config_data(raw):
     """
-    Format a VPN configuration for user display/export
+    Parse stored configuration data
+    
+    Older bot-created rows hold a Python repr of the dict instead of JSON,
+    so that form is accepted as well.
     
     Args:
-        vpn_config: VPNConfig model instance
+        raw (str): Value of VPNConfig.config_data
         
     Returns:
-        str: Formatted configuration string suitable for client import
+        dict: Configuration data
+    """
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return ast.literal_eval(raw)
+
+def build_share_uri(config_type, config_data, name):
     """
-    config_data = json.loads(vpn_config.config_data)
+    Build the share URI for a configuration
+    
+    Args:
+        config_type (str): Type of VPN config (vless, vmess, trojan)
+        config_data (dict): Configuration data
+        name (str): Display name used when the data has none
+        
+    Returns:
+        str: URI suitable for client import (JSON for unknown types)
+    """
+    config_data = dict(config_data)
     
     # Add the name if not present
     if "name" not in config_data:
-        config_data["name"] = vpn_config.name
+        config_data["name"] = name
     
     # Format based on the config type
-    if vpn_config.config_type.lower() == "vmess":
+    if config_type.lower() == "vmess":
         return encode_vmess_config(config_data)
-    elif vpn_config.config_type.lower() == "vless":
+    elif config_type.lower() == "vless":
         return format_vless_config(config_data)
-    elif vpn_config.config_type.lower() == "trojan":
+    elif config_type.lower() == "trojan":
         return format_trojan_config(config_data)
     else:
         return json.dumps(config_data, indent=2)
 
+def format_config_for_user(vpn_config):
+    """
+    Format a VPN configuration for user display/export
+    
+    Args:
+        vpn_config: VPNConfig model instance
+        
+    Returns:
+        str: Formatted configuration string suitable for client import
+    """
+    # URI вычисляется при сохранении конфигурации
+    if vpn_config.share_uri:
+        return vpn_config.share_uri
+    
+    return build_share_uri(vpn_config.config_type, load_config_data(vpn_config.config_data), vpn_config.name)
+
 def parse_imported_config(config_str):
     """
     Parse an imported VPN configuration string
@@ -3,15 +3,274 @@ Client for interacting with the 3x-ui panel API
 """
 import json
 import logging
+import os
+import threading
+import time
 import requests
 from datetime import datetime, timedelta
 from urllib.parse import urljoin
 from uuid import uuid4
 
+from metrics import timed_xui
+
 class XUIClientError(Exception):
     """Exception class for XUI client errors"""
     pass
 
+def expiry_timestamp(days):
+    """Время истечения через days дней в миллисекундах, как его хранит 3x-ui"""
+    return int((datetime.now() + timedelta(days=days)).timestamp() * 1000)
+
+def client_key(client):
+    """Идентификатор клиента в 3x-ui: UUID для vless/vmess, пароль для trojan"""
+    return client.get("id") or client.get("password")
+
+def build_client(config_type, email, uuid=None, expiry_days=30):
+    """
+    Build a 3x-ui client entry for the given protocol
+    
+    Args:
+        config_type (str): Type of VPN config (vless, vmess, trojan)
+        email (str): Email/identifier for the client
+        uuid (str, optional): UUID for the client. If None, one will be generated.
+        expiry_days (int): Number of days until the client expires
+        
+    Returns:
+        dict: Client configuration data
+    """
+    client_uuid = uuid or str(uuid4())
+    
+    # Create new client based on the protocol type
+    new_client = {
+        "email": email,
+        "enable": True,
+        "expiryTime": expiry_timestamp(expiry_days)
+    }
+    
+    if config_type.lower() == "vless":
+        new_client.update({
+            "id": client_uuid,
+            "flow": "",
+            "limitIp": 0,
+            "totalGB": 0
+        })
+    
+    elif config_type.lower() == "vmess":
+        new_client.update({
+            "id": client_uuid,
+            "alterId": 0,
+            "limitIp": 0,
+            "totalGB": 0
+        })
+    
+    elif config_type.lower() == "trojan":
+        new_client.update({
+            "password": client_uuid,
+            "limitIp": 0,
+            "totalGB": 0
+        })
+    
+    else:
+        raise XUIClientError(f"Unsupported protocol: {config_type}")
+        
+    return new_client
+
+def group_by_inbound(items):
+    """
+    Group batch items by inbound, keeping their positions in the input
+    
+    Args:
+        items (list): Dicts with at least an "inbound_id" key
+        
+    Returns:
+        dict: {inbound_id: [(index, item), ...]} in first-seen order
+    """
+    groups = {}
+    for index, item in enumerate(items):
+        groups.setdefault(item["inbound_id"], []).append((index, item))
+    return groups
+
+class BatchResult:
+    """
+    Per-client outcome of a batch operation
+    
+    results holds one dict per input item, in input order:
+    {"inbound_id", "email", "ok", "client", "error"}.
+    """
+    def __init__(self, size):
+        self.results = [None] * size
+    
+    def succeed(self, index, item, client=None):
+        self.results[index] = {
+            "inbound_id": item["inbound_id"],
+            "email": item["email"],
+            "ok": True,
+            "client": client,
+            "error": None
+        }
+    
+    def fail(self, index, item, error):
+        self.results[index] = {
+            "inbound_id": item["inbound_id"],
+            "email": item["email"],
+            "ok": False,
+            "client": None,
+            "error": str(error)
+        }
+    
+    @property
+    def succeeded(self):
+        return [r for r in self.results if r and r["ok"]]
+    
+    @property
+    def failed(self):
+        return [r for r in self.results if r and not r["ok"]]
+    
+    @property
+    def ok(self):
+        """True, если все элементы пакета обработаны успешно"""
+        return not self.failed
+    
+    def __repr__(self):
+        return f'<BatchResult {len(self.succeeded)} ok, {len(self.failed)} failed>'
+
+INBOUND_CATALOG_TTL = float(os.environ.get('XUI_INBOUND_CATALOG_TTL', '300'))
+
+class InboundCatalog:
+    """
+    Cached list of inbounds indexed by ID and by protocol
+    
+    The list is refreshed at most once per TTL or after invalidate(). Client
+    lists are parsed from each inbound's settings JSON lazily, once per inbound.
+    When an inbound's clients change, invalidate_clients() marks only that
+    inbound stale; the ID and protocol index stay valid and the client
+    fetches the single inbound again with refresh_inbound() when its
+    settings are needed.
+    """
+    def __init__(self, ttl=INBOUND_CATALOG_TTL):
+        """
+        Initialize the catalog
+        
+        Args:
+            ttl (float): Seconds the inbound list stays valid
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_protocol = {}
+        self._clients = {}  # {inbound_id: [client, ...]}
+        self._stale = {}  # {inbound_id: generation} - инбаунды с устаревшими settings
+        self._generation = 0
+        self._loaded_at = None
+    
+    def is_fresh(self):
+        """Проверить, не устарел ли каталог"""
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+    
+    def load(self, inbounds):
+        """
+        Replace the catalog contents
+        
+        Args:
+            inbounds (list): Inbounds as returned by the panel
+        """
+        by_id = {}
+        by_protocol = {}
+        for inbound in inbounds:
+            by_id[inbound.get("id")] = inbound
+            by_protocol.setdefault((inbound.get("protocol") or "").lower(), []).append(inbound)
+        
+        with self._lock:
+            self._by_id = by_id
+            self._by_protocol = by_protocol
+            self._clients = {}
+            self._stale = {}
+            self._loaded_at = time.monotonic()
+    
+    def invalidate(self):
+        """Пометить каталог устаревшим (после изменения списка инбаундов)"""
+        with self._lock:
+            self._loaded_at = None
+    
+    def invalidate_clients(self, inbound_id):
+        """
+        Mark an inbound's settings stale after its clients changed
+        
+        Only this inbound is refetched, on next use of its settings; the rest
+        of the catalog stays valid until the TTL.
+        """
+        with self._lock:
+            self._clients.pop(inbound_id, None)
+            self._generation += 1
+            self._stale[inbound_id] = self._generation
+    
+    def stale_generation(self, inbound_id):
+        """
+        Check whether an inbound's settings need refetching
+        
+        Returns:
+            int or None: Token to pass to refresh_inbound(), or None if the
+                cached settings are current
+        """
+        with self._lock:
+            return self._stale.get(inbound_id)
+    
+    def refresh_inbound(self, inbound, generation=None):
+        """
+        Replace one inbound with a freshly fetched copy
+        
+        Args:
+            inbound (dict): Inbound as returned by the panel
+            generation (int, optional): Value of stale_generation() taken
+                before the fetch; if the inbound was invalidated again since,
+                it stays stale
+        """
+        inbound_id = inbound.get("id")
+        with self._lock:
+            previous = self._by_id.get(inbound_id)
+            self._by_id[inbound_id] = inbound
+            protocol = (inbound.get("protocol") or "").lower()
+            matching = self._by_protocol.setdefault(protocol, [])
+            if previous is not None and previous in matching:
+                matching[matching.index(previous)] = inbound
+            else:
+                if previous is not None:
+                    # Протокол инбаунда изменился
+                    old = self._by_protocol.get((previous.get("protocol") or "").lower(), [])
+                    if previous in old:
+                        old.remove(previous)
+                matching.append(inbound)
+            self._clients.pop(inbound_id, None)
+            if generation is None or self._stale.get(inbound_id) == generation:
+                self._stale.pop(inbound_id, None)
+    
+    def get(self, inbound_id):
+        """Получить инбаунд по ID"""
+        return self._by_id.get(inbound_id)
+    
+    def for_protocol(self, protocol):
+        """Получить все инбаунды протокола"""
+        return list(self._by_protocol.get((protocol or "").lower(), []))
+    
+    def all(self):
+        """Получить все инбаунды"""
+        return list(self._by_id.values())
+    
+    def clients(self, inbound_id):
+        """
+        Get the parsed client list of an inbound
+        
+        Returns:
+            list: Clients, or an empty list if the inbound is unknown
+        """
+        with self._lock:
+            clients = self._clients.get(inbound_id)
+            if clients is None:
+                inbound = self._by_id.get(inbound_id)
+                settings = json.loads(inbound.get("settings") or "{}") if inbound else {}
+                clients = self._clients[inbound_id] = settings.get("clients", [])
+            return clients
+
 class XUIClient:
     """Client for interacting with 3x-ui panel"""
     def __init__(self, base_url, username, password):
@@ -29,6 +288,7 @@ class XUIClient:
         self.session = requests.Session()
         self.token = None
         self.logger = logging.getLogger(__name__)
+        self.inbound_catalog = InboundCatalog()
     
     def _login(self):
         """
@@ -47,6 +307,7 @@ class XUIClient:
         # Просто вызываем _login, чтобы вывести в лог сообщение
         self._login()
     
+    @timed_xui
     def get_inbounds(self):
         """
         Get all inbound configurations
@@ -77,6 +338,47 @@ class XUIClient:
             }
         ]
     
+    def _fresh_catalog(self):
+        """Вернуть каталог инбаундов, загрузив его заново, если он устарел"""
+        if not self.inbound_catalog.is_fresh():
+            self.inbound_catalog.load(self.get_inbounds())
+        return self.inbound_catalog
+    
+    def _fresh_inbound(self, inbound_id):
+        """Вернуть каталог с актуальными settings инбаунда, запросив только его"""
+        catalog = self._fresh_catalog()
+        generation = catalog.stale_generation(inbound_id)
+        if generation is not None:
+            catalog.refresh_inbound(self.get_inbound(inbound_id), generation)
+        return catalog
+    
+    def find_inbound(self, protocol):
+        """
+        Find the inbound to provision clients of a protocol on
+        
+        Args:
+            protocol (str): VPN protocol (vless, vmess, trojan)
+            
+        Returns:
+            dict: First inbound with that protocol, or None
+        """
+        matching = self._fresh_catalog().for_protocol(protocol)
+        return matching[0] if matching else None
+    
+    def get_cached_inbound(self, inbound_id):
+        """
+        Get an inbound from the catalog without a panel request when fresh
+        
+        Returns:
+            dict: Inbound configuration, or None if unknown
+        """
+        return self._fresh_inbound(inbound_id).get(inbound_id)
+    
+    def invalidate_inbounds(self):
+        """Сбросить каталог инбаундов (после создания, изменения или удаления инбаунда)"""
+        self.inbound_catalog.invalidate()
+    
+    @timed_xui
     def get_inbound(self, inbound_id):
         """
         Get a specific inbound configuration
@@ -120,6 +422,7 @@ class XUIClient:
                 "settings": json.dumps({"clients": []})
             }
     
+    @timed_xui
     def add_client(self, inbound_id, email, config_type, uuid=None, expiry_days=30):
         """
         Add a client to an inbound
@@ -137,45 +440,11 @@ class XUIClient:
         # ЗАГЛУШКА для тестирования без реальной 3x-ui панели
         self.logger.info(f"[MOCK] Adding client with email {email} and type {config_type}")
         
-        # Generate expiry time
-        expiry_time = int((datetime.now() + timedelta(days=expiry_days)).timestamp() * 1000)
-        client_uuid = uuid or str(uuid4())
-        
-        # Create new client based on the protocol type
-        new_client = {
-            "email": email,
-            "enable": True,
-            "expiryTime": expiry_time
-        }
-        
-        if config_type.lower() == "vless":
-            new_client.update({
-                "id": client_uuid,
-                "flow": "",
-                "limitIp": 0,
-                "totalGB": 0
-            })
-        
-        elif config_type.lower() == "vmess":
-            new_client.update({
-                "id": client_uuid,
-                "alterId": 0,
-                "limitIp": 0,
-                "totalGB": 0
-            })
-        
-        elif config_type.lower() == "trojan":
-            new_client.update({
-                "password": client_uuid,
-                "limitIp": 0,
-                "totalGB": 0
-            })
-        
-        else:
-            raise XUIClientError(f"Unsupported protocol: {config_type}")
-            
+        new_client = build_client(config_type, email, uuid=uuid, expiry_days=expiry_days)
+        self.inbound_catalog.invalidate_clients(inbound_id)
         return new_client
     
+    @timed_xui
     def remove_client(self, inbound_id, email):
         """
         Remove a client from an inbound
@@ -189,8 +458,10 @@ class XUIClient:
         """
         # ЗАГЛУШКА для тестирования
         self.logger.info(f"[MOCK] Removing client with email {email} from inbound {inbound_id}")
+        self.inbound_catalog.invalidate_clients(inbound_id)
         return True
     
+    @timed_xui
     def update_client(self, inbound_id, email, new_expiry_days=None, enable=None):
         """
         Update a client's properties
@@ -220,8 +491,94 @@ class XUIClient:
             "totalGB": 0
         }
         
+        self.inbound_catalog.invalidate_clients(inbound_id)
         return updated_client
     
+    def add_clients(self, items):
+        """
+        Add many clients, one panel request per inbound
+        
+        Args:
+            items (list): Dicts with inbound_id, email, config_type and
+                optionally uuid and expiry_days
+                
+        Returns:
+            BatchResult: Per-client results; clients of a failed group all fail
+        """
+        result = BatchResult(len(items))
+        for inbound_id, group in group_by_inbound(items).items():
+            built = []
+            for index, item in group:
+                try:
+                    client = build_client(item["config_type"], item["email"],
+                                          uuid=item.get("uuid"), expiry_days=item.get("expiry_days", 30))
+                    built.append((index, item, client))
+                except XUIClientError as e:
+                    result.fail(index, item, e)
+            
+            if not built:
+                continue
+            
+            # ЗАГЛУШКА для тестирования: один запрос addClient на инбаунд
+            self.logger.info(f"[MOCK] Adding {len(built)} clients to inbound {inbound_id}")
+            for index, item, client in built:
+                result.succeed(index, item, client)
+            self.inbound_catalog.invalidate_clients(inbound_id)
+        
+        return result
+    
+    def update_clients(self, items):
+        """
+        Update many clients, fetching each inbound once
+        
+        Args:
+            items (list): Dicts with inbound_id, email and optionally
+                new_expiry_days and enable
+                
+        Returns:
+            BatchResult: Per-client results
+        """
+        result = BatchResult(len(items))
+        for inbound_id, group in group_by_inbound(items).items():
+            # ЗАГЛУШКА для тестирования
+            self.logger.info(f"[MOCK] Updating {len(group)} clients in inbound {inbound_id}")
+            for index, item in group:
+                expiry_days = item.get("new_expiry_days")
+                enable = item.get("enable")
+                result.succeed(index, item, {
+                    "email": item["email"],
+                    "enable": enable if enable is not None else True,
+                    "expiryTime": expiry_timestamp(expiry_days if expiry_days is not None else 30),
+                    "id": str(uuid4()),
+                    "flow": "",
+                    "limitIp": 0,
+                    "totalGB": 0
+                })
+            self.inbound_catalog.invalidate_clients(inbound_id)
+        
+        return result
+    
+    def remove_clients(self, items):
+        """
+        Remove many clients, fetching each inbound once
+        
+        Args:
+            items (list): Dicts with inbound_id and email
+            
+        Returns:
+            BatchResult: Per-client results
+        """
+        result = BatchResult(len(items))
+        for inbound_id, group in group_by_inbound(items).items():
+            # ЗАГЛУШКА для тестирования
+            self.logger.info(f"[MOCK] Removing {len(group)} clients from inbound {inbound_id}")
+            for index, item in group:
+                result.succeed(index, item)
+            self.inbound_catalog.invalidate_clients(inbound_id)
+        
+        return result
+    
+    @timed_xui
     def get_stats(self):
         """
         Get system stats
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the 3x-ui panel API
+
+Реализует те же маршруты, что использует AsyncXUIClient (вход, список и
+получение инбаундов, addClient/updateClient/delClient, update инбаунда и
+статус сервера), храня состояние в памяти. Задержки, доля ошибок и лимит
+запросов настраиваются, чтобы нагружать настоящий клиент без панели.
+
+Example:
+    python xui_fake_server.py --port 54321 --latency 50 --jitter 20 --error-rate 0.05 --rate-limit 200
+    XUI_PANEL_URL=http://127.0.0.1:54321 python main.py
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import secrets
+import threading
+import time
+from copy import deepcopy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = '3x-ui'
+
+DEFAULT_INBOUNDS = [
+    {"id": 1, "port": 10000, "protocol": "vless", "remark": "vless", "enable": True},
+    {"id": 2, "port": 20000, "protocol": "vmess", "remark": "vmess", "enable": True},
+    {"id": 3, "port": 30000, "protocol": "trojan", "remark": "trojan", "enable": True},
+]
+
+
+class FakePanelState:
+    """In-memory inbounds and clients of the fake panel"""
+
+    def __init__(self, username, password, inbounds=None):
+        self.username = username
+        self.password = password
+        self.sessions = set()
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._inbounds = {}
+        self._clients = {}  # {inbound_id: [client, ...]}
+        for inbound in inbounds or DEFAULT_INBOUNDS:
+            self._inbounds[inbound["id"]] = dict(inbound)
+            self._clients[inbound["id"]] = []
+
+    def login(self, username, password):
+        """
+        Check credentials and open a session
+
+        Returns:
+            str: Session ID, or None if the credentials are wrong
+        """
+        if username != self.username or password != self.password:
+            return None
+        session_id = secrets.token_hex(16)
+        with self._lock:
+            self.sessions.add(session_id)
+        return session_id
+
+    def _render(self, inbound_id):
+        inbound = dict(self._inbounds[inbound_id])
+        inbound["settings"] = json.dumps({"clients": self._clients[inbound_id]})
+        return inbound
+
+    def list_inbounds(self):
+        with self._lock:
+            return [self._render(inbound_id) for inbound_id in self._inbounds]
+
+    def get_inbound(self, inbound_id):
+        with self._lock:
+            if inbound_id not in self._inbounds:
+                raise KeyError(f"inbound {inbound_id} not found")
+            return self._render(inbound_id)
+
+    def _find(self, clients, key):
+        for position, client in enumerate(clients):
+            if client.get("id") == key or client.get("password") == key:
+                return position
+        return None
+
+    def add_clients(self, inbound_id, clients):
+        with self._lock:
+            if inbound_id not in self._inbounds:
+                raise KeyError(f"inbound {inbound_id} not found")
+            existing = {c.get("email") for clients_ in self._clients.values() for c in clients_}
+            for client in clients:
+                if client.get("email") in existing:
+                    raise ValueError(f"Duplicate email: {client.get('email')}")
+            self._clients[inbound_id].extend(deepcopy(clients))
+
+    def update_client(self, inbound_id, key, client):
+        with self._lock:
+            clients = self._clients.get(inbound_id)
+            if clients is None:
+                raise KeyError(f"inbound {inbound_id} not found")
+            position = self._find(clients, key)
+            if position is None:
+                raise KeyError(f"client {key} not found")
+            clients[position] = deepcopy(client)
+
+    def delete_client(self, inbound_id, key):
+        with self._lock:
+            clients = self._clients.get(inbound_id)
+            if clients is None:
+                raise KeyError(f"inbound {inbound_id} not found")
+            position = self._find(clients, key)
+            if position is None:
+                raise KeyError(f"client {key} not found")
+            del clients[position]
+
+    def update_inbound(self, inbound_id, data):
+        with self._lock:
+            if inbound_id not in self._inbounds:
+                raise KeyError(f"inbound {inbound_id} not found")
+            settings = json.loads(data.pop("settings", None) or '{"clients": []}')
+            data.pop("id", None)
+            self._inbounds[inbound_id].update(data)
+            self._clients[inbound_id] = settings.get("clients", [])
+
+    def status(self):
+        with self._lock:
+            total_clients = sum(len(c) for c in self._clients.values())
+        return {
+            "cpu": round(random.uniform(5, 40), 1),
+            "memory": round(random.uniform(20, 60), 1),
+            "disk": 45.6,
+            "xray": "running",
+            "uptime": int(time.time() - self.started_at),
+            "clients": total_clients,
+        }
+
+
+class FaultInjector:
+    """Latency, error-rate and rate-limit injection"""
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, rate_limit=0):
+        """
+        Args:
+            latency_ms (float): Mean added latency per request
+            jitter_ms (float): Uniform jitter around the mean latency
+            error_rate (float): Share of requests answered with 503 (0..1)
+            rate_limit (int): Requests per second before 429, 0 disables
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self.stats = {'requests': 0, 'injected_errors': 0, 'rate_limited': 0}
+
+    def delay(self):
+        delay_ms = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+    def check(self):
+        """
+        Decide whether to fail the current request
+
+        Returns:
+            int or None: HTTP status to answer with, or None to proceed
+        """
+        with self._lock:
+            self.stats['requests'] += 1
+            if self.rate_limit:
+                now = time.monotonic()
+                if now - self._window_start >= 1.0:
+                    self._window_start = now
+                    self._window_count = 0
+                self._window_count += 1
+                if self._window_count > self.rate_limit:
+                    self.stats['rate_limited'] += 1
+                    return 429
+            if self.error_rate and random.random() < self.error_rate:
+                self.stats['injected_errors'] += 1
+                return 503
+        return None
+
+
+ROUTES = [
+    ('POST', re.compile(r'^/login$'), 'login'),
+    ('GET', re.compile(r'^/panel/api/inbounds/list$'), 'list_inbounds'),
+    ('GET', re.compile(r'^/panel/api/inbounds/get/(\d+)$'), 'get_inbound'),
+    ('POST', re.compile(r'^/panel/api/inbounds/addClient$'), 'add_client'),
+    ('POST', re.compile(r'^/panel/api/inbounds/updateClient/([^/]+)$'), 'update_client'),
+    ('POST', re.compile(r'^/panel/api/inbounds/(\d+)/delClient/([^/]+)$'), 'delete_client'),
+    ('POST', re.compile(r'^/panel/api/inbounds/update/(\d+)$'), 'update_inbound'),
+    ('POST', re.compile(r'^/server/status$'), 'server_status'),
+]
+
+
+class FakePanelHandler(BaseHTTPRequestHandler):
+    """Request handler; state and faults are set on the server object"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    # -- ввод/вывод ---------------------------------------------------------
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if not raw:
+            return {}
+        if 'application/json' in (self.headers.get('Content-Type') or ''):
+            return json.loads(raw)
+        return {k: v[0] for k, v in parse_qs(raw.decode()).items()}
+
+    def _send(self, status, payload=None, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _ok(self, obj=None, msg=''):
+        self._send(200, {'success': True, 'msg': msg, 'obj': obj})
+
+    def _error(self, msg):
+        # 3x-ui сообщает об ошибках операций через success=false при статусе 200
+        self._send(200, {'success': False, 'msg': msg, 'obj': None})
+
+    def _session(self):
+        for part in (self.headers.get('Cookie') or '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == SESSION_COOKIE:
+                return value
+        return None
+
+    # -- диспетчеризация ----------------------------------------------------
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        faults = self.server.faults
+        state = self.server.state
+
+        try:
+            body = self._body()
+        except ValueError:
+            self._send(400, {'success': False, 'msg': 'invalid body', 'obj': None})
+            return
+
+        faults.delay()
+        status = faults.check()
+        if status is not None:
+            self._send(status, headers={'Retry-After': '1'} if status == 429 else None)
+            return
+
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(self.path.split('?', 1)[0])
+            if match and route_method == method:
+                break
+        else:
+            self._send(404)
+            return
+
+        # Без сессии 3x-ui отвечает 404 на маршруты API
+        if name != 'login' and self._session() not in state.sessions:
+            self._send(404)
+            return
+
+        try:
+            getattr(self, f'_route_{name}')(state, body, *match.groups())
+        except (KeyError, ValueError) as e:
+            self._error(str(e).strip("'"))
+
+    # -- маршруты -----------------------------------------------------------
+
+    def _route_login(self, state, body):
+        session_id = state.login(body.get('username'), body.get('password'))
+        if session_id is None:
+            self._error('Wrong username or password')
+            return
+        payload = json.dumps({'success': True, 'msg': 'Login Successfully', 'obj': None}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Set-Cookie', f'{SESSION_COOKIE}={session_id}; Path=/; HttpOnly')
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _route_list_inbounds(self, state, body):
+        self._ok(state.list_inbounds())
+
+    def _route_get_inbound(self, state, body, inbound_id):
+        self._ok(state.get_inbound(int(inbound_id)))
+
+    def _route_add_client(self, state, body):
+        settings = json.loads(body.get('settings') or '{}')
+        state.add_clients(int(body.get('id')), settings.get('clients', []))
+        self._ok(msg='Client(s) added')
+
+    def _route_update_client(self, state, body, key):
+        clients = json.loads(body.get('settings') or '{}').get('clients', [])
+        if len(clients) != 1:
+            raise ValueError('exactly one client expected')
+        state.update_client(int(body.get('id')), key, clients[0])
+        self._ok(msg='Client updated')
+
+    def _route_delete_client(self, state, body, inbound_id, key):
+        state.delete_client(int(inbound_id), key)
+        self._ok(msg='Client deleted')
+
+    def _route_update_inbound(self, state, body, inbound_id):
+        state.update_inbound(int(inbound_id), dict(body))
+        self._ok(state.get_inbound(int(inbound_id)), msg='Inbound updated')
+
+    def _route_server_status(self, state, body):
+        self._ok(state.status())
+
+
+def create_server(host='127.0.0.1', port=54321, username='admin', password='admin', faults=None):
+    """
+    Create the fake panel server without starting it
+
+    Returns:
+        ThreadingHTTPServer: Server with .state and .faults attributes
+    """
+    server = ThreadingHTTPServer((host, port), FakePanelHandler)
+    server.daemon_threads = True
+    server.state = FakePanelState(username, password)
+    server.faults = faults or FaultInjector()
+    return server
+
+
+def main():
+    """
+    Main entry point
+    """
+    parser = argparse.ArgumentParser(description="Run a local fake 3x-ui panel")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=54321)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    parser.add_argument('--latency', type=float, default=0.0, help="Mean added latency, ms")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Latency jitter, ms")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests failed with 503")
+    parser.add_argument('--rate-limit', type=int, default=0, help="Requests per second before 429 (0 = off)")
+    args = parser.parse_args()
+
+    faults = FaultInjector(args.latency, args.jitter, args.error_rate, args.rate_limit)
+    server = create_server(args.host, args.port, args.username, args.password, faults)
+    logger.info(f"Fake 3x-ui panel listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Fake panel stats: {faults.stats}")
+
+
+if __name__ == "__main__":
+    main()